@@ -0,0 +1,142 @@
+# Copyright 2022 Sciforce Ukraine. All rights reserved.
+from __future__ import annotations
+
+from typing import Iterable
+
+import numpy as np
+
+from core import data_model
+from core import hierarchy_index
+
+# Kinds of attribute keys
+_CLASSIC = 1
+_CONCRETE = 2
+
+
+class AttributeSignatureIndex:
+    """Inverted index from defining attributes to the fully defined concepts that require them.
+
+    Only ungroupped attributes of a concept (after single group redefinition) are indexed: every one of them
+    must have a descendant among the attributes of an expression for the concept to subsume it. Given the
+    attributes of an expression, the index tells which concepts can not be its ancestors without running
+    any per-concept checks.
+
+    Keys are stored as parallel arrays (kind, typeId, destinationId, concrete value) with a CSR list of dense
+    concept positions for each key, so the index can be kept in a memory-mapped file.
+    """
+
+    def __init__(self, required_counts: np.ndarray, key_kind: np.ndarray, key_type: np.ndarray,
+                 key_destination: np.ndarray, key_value: np.ndarray, posting_offsets: np.ndarray,
+                 postings: np.ndarray) -> None:
+        self.required_counts = required_counts  # Number of required attributes by dense concept position
+        self.key_kind = key_kind
+        self.key_type = key_type
+        self.key_destination = key_destination  # Destination of classic attributes, 0 for concrete
+        self.key_value = key_value  # Value of concrete attributes, 0 for classic
+        self.posting_offsets = posting_offsets  # Start of each key's concept list, length = key count + 1
+        self.postings = postings  # Dense positions of concepts requiring the key
+        self._keys, self._destinations = self._build_lookup()
+
+    def _build_lookup(self) -> tuple[dict[data_model.MetaRelationship, int], dict[int, set[int]]]:
+        keys: dict[data_model.MetaRelationship, int] = dict()
+        destinations: dict[int, set[int]] = dict()
+        rows = zip(self.key_kind.tolist(), self.key_type.tolist(),
+                   self.key_destination.tolist(), self.key_value.tolist())
+        for i, (kind, type_id, destination_id, value) in enumerate(rows):
+            if kind == _CONCRETE:
+                keys[data_model.ConcreteRelationship(typeId=type_id, concreteValue=value)] = i
+            else:
+                keys[data_model.Relationship(typeId=type_id, destinationId=destination_id)] = i
+                destinations.setdefault(type_id, set()).add(destination_id)
+        return keys, destinations
+
+    def __getstate__(self) -> dict:
+        # Lookups are cheap to rebuild and expensive to pickle
+        state = self.__dict__.copy()
+        del state['_keys']
+        del state['_destinations']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._keys, self._destinations = self._build_lookup()
+
+    def __len__(self) -> int:
+        return len(self.key_kind)
+
+    @classmethod
+    def build(cls, reachability: hierarchy_index.ReachabilityIndex,
+              requirements: Iterable[tuple[int, Iterable[data_model.MetaRelationship]]]) -> AttributeSignatureIndex:
+        """Builds the index from pairs of concept id and attributes required by the concept"""
+        required_counts = np.zeros(len(reachability), dtype=np.uint16)
+        concepts_by_key: dict[data_model.MetaRelationship, list[int]] = dict()
+
+        for concept_id, attributes in requirements:
+            position = reachability.position(concept_id)
+            attributes = set(attributes)
+            required_counts[position] = len(attributes)
+            for attribute in attributes:
+                concepts_by_key.setdefault(attribute, []).append(position)
+
+        keys = sorted(concepts_by_key, key=lambda k: (k.ord, k))
+        classic = [k for k in keys if isinstance(k, data_model.Relationship)]
+        key_kind = np.array([_CLASSIC if isinstance(k, data_model.Relationship) else _CONCRETE for k in keys],
+                            dtype=np.uint8)
+        key_type = np.array([k.typeId for k in keys], dtype=np.int64)
+        key_destination = np.zeros(len(keys), dtype=np.int64)
+        key_destination[:len(classic)] = [k.destinationId for k in classic]
+        key_value = np.zeros(len(keys), dtype=np.float64)
+        key_value[len(classic):] = [float(k.concreteValue) for k in keys[len(classic):]]
+
+        posting_offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum([len(concepts_by_key[k]) for k in keys], out=posting_offsets[1:])
+        postings = np.fromiter((p for k in keys for p in concepts_by_key[k]), dtype=np.int32,
+                               count=int(posting_offsets[-1]))
+
+        return cls(
+                required_counts=required_counts,
+                key_kind=key_kind,
+                key_type=key_type,
+                key_destination=key_destination,
+                key_value=key_value,
+                posting_offsets=posting_offsets,
+                postings=postings,
+                )
+
+    def _satisfied_keys(self, attributes: Iterable[data_model.MetaRelationship],
+                        reachability: hierarchy_index.ReachabilityIndex) -> set[int]:
+        """Returns indices of keys that have a descendant among the given attributes"""
+        satisfied = set()
+        for attribute in attributes:
+            if isinstance(attribute, data_model.ConcreteRelationship):
+                # Concrete values only ever match exactly
+                try:
+                    satisfied.add(self._keys[attribute])
+                except KeyError:
+                    pass
+                continue
+
+            destination_ancestors = reachability.ancestor_set([attribute.destinationId])
+            for type_id in reachability.ancestor_set([attribute.typeId]):
+                indexed_destinations = self._destinations.get(type_id)
+                if not indexed_destinations:
+                    continue
+                for destination_id in indexed_destinations.intersection(destination_ancestors):
+                    satisfied.add(self._keys[data_model.Relationship(typeId=type_id, destinationId=destination_id)])
+
+        return satisfied
+
+    def admitted(self, attributes: Iterable[data_model.MetaRelationship],
+                 reachability: hierarchy_index.ReachabilityIndex) -> np.ndarray:
+        """Returns a boolean mask by dense concept position. Concepts with the mask unset require an attribute
+        that has no descendants among the given ones, so they can not subsume an expression having them."""
+        satisfied = sorted(self._satisfied_keys(attributes, reachability))
+        if satisfied:
+            postings = np.concatenate([self.postings[self.posting_offsets[k]:self.posting_offsets[k + 1]]
+                                       for k in satisfied])
+        else:
+            postings = np.empty(0, dtype=np.int32)
+
+        # Keys are unique per concept, so the count of satisfied keys equals the count of required ones
+        hits = np.bincount(postings, minlength=len(self.required_counts))
+        return hits == self.required_counts
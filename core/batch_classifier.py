@@ -0,0 +1,107 @@
+# Copyright 2022 Sciforce Ukraine. All rights reserved.
+from __future__ import annotations
+
+import multiprocessing
+import os
+from dataclasses import dataclass
+from typing import Iterable, Iterator
+
+from core import classification_cache
+from core import data_model
+from core import expression
+from core import expression_process
+from utils.logger import jacka_logger
+
+batch_logger = jacka_logger.getChild('BatchClassifier')
+
+# Expressions sent to a worker at once; amortizes pickling overhead without stalling ordered results
+CHUNK_SIZE = 8
+
+@dataclass(slots=True)
+class ClassifiedExpression:
+    """Parsed and normalized expression with its classification, or the error that prevented it"""
+    expression: expression.Expression | None = None
+    classification: classification_cache.ClassificationResult | None = None
+    error: str | None = None
+
+
+class _Worker:
+    """Classifies expressions against an ontology, in the calling process or in a pool worker"""
+
+    def __init__(self, ont: data_model.OntologyInterface, processor: type[expression_process.Processor],
+                 cache_path: str | None) -> None:
+        self.ont = ont
+        self.processor = processor
+        # Connections can not be shared with the parent, so each worker opens the cache file anew
+        self.cache = None if cache_path is None else classification_cache.ClassificationCache(cache_path, ont)
+
+    def __call__(self, text: str) -> ClassifiedExpression:
+        try:
+            expr = expression_process.parse(text, self.processor)[0]
+            expr.normal_form(self.ont)
+            if self.cache is not None:
+                classification = self.cache.classify(expr)
+            else:
+                classification = classification_cache.ClassificationResult.classify(expr, self.ont)
+        except Exception as e:
+            # Exceptions may not survive pickling, so only the message is passed back
+            return ClassifiedExpression(error=str(e) or repr(e))
+        return ClassifiedExpression(expression=expr, classification=classification)
+
+
+# Worker of the current pool process; set by the pool initializer, so it is never set in the parent
+_worker: _Worker | None = None
+
+
+def _initialize_worker(ont: data_model.OntologyInterface, processor: type[expression_process.Processor],
+                       cache_path: str | None) -> None:
+    global _worker
+    _worker = _Worker(ont, processor, cache_path)
+
+
+def _classify(text: str) -> ClassifiedExpression:
+    return _worker(text)
+
+
+class BatchClassifier:
+    """Parses, normalizes, classifies and fingerprints expressions in a pool of worker processes.
+
+    Workers are forked once the ontology is loaded, so it is shared with the parent copy-on-write (or through
+    the page cache for memory-mapped ontologies). Nothing is written by the workers: identifiers are assigned
+    and inserts are executed by the parent in the order of the results, so they stay deterministic.
+    Without fork support, or with no workers requested, expressions are classified in the calling process.
+    """
+
+    def __init__(self, ont: data_model.OntologyInterface, processes: int | None = None, parser: str = 'fast',
+                 cache_path: str | None = None) -> None:
+        """
+        @param ont: Ontology to classify against; must be fully loaded before the workers are forked
+        @param processes: Number of worker processes. None uses every CPU, 0 disables the pool
+        @param parser: Key of expression_process.PROCESSORS
+        @param cache_path: Optional path of a ClassificationCache file to consult and fill
+        """
+        processor = expression_process.PROCESSORS[parser]
+        if processes is None:
+            processes = os.cpu_count() or 1
+
+        self._pool = None
+        self._worker = None
+        if processes > 0 and 'fork' in multiprocessing.get_all_start_methods():
+            batch_logger.info(f"Forking {processes} classification workers.")
+            # Forked workers inherit the arguments of the initializer instead of receiving them pickled
+            self._pool = multiprocessing.get_context('fork').Pool(processes, initializer=_initialize_worker,
+                                                                  initargs=(ont, processor, cache_path))
+        else:
+            self._worker = _Worker(ont, processor, cache_path)
+
+    def classify(self, texts: Iterable[str]) -> Iterator[ClassifiedExpression]:
+        """Lazily yields results in the order of the given expressions"""
+        if self._pool is None:
+            return map(self._worker, texts)
+        return self._pool.imap(_classify, texts, chunksize=CHUNK_SIZE)
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
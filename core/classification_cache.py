@@ -0,0 +1,116 @@
+# Copyright 2022 Sciforce Ukraine. All rights reserved.
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+from dataclasses import dataclass
+
+from core import data_model
+from core import expression
+from core import ontology
+from utils.constants import HASH_COMPATIBILITY_VERSION
+from utils.logger import jacka_logger
+
+cache_logger = jacka_logger.getChild('ClassificationCache')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS classification (
+    ontology_version TEXT NOT NULL,
+    hasher TEXT NOT NULL,
+    canonical TEXT NOT NULL,
+    parents TEXT,
+    equivalent_to INTEGER,
+    concept_code TEXT,
+    PRIMARY KEY (ontology_version, hasher, canonical)
+)
+"""
+
+
+@dataclass(frozen=True, slots=True)
+class ClassificationResult:
+    """Outcome of classifying an expression: either immediate parents with the hashed concept code,
+    or the concept the expression is fully equivalent to."""
+    parents: frozenset[int] = frozenset()
+    concept_code: str | None = None
+    equivalent_to: int | None = None
+
+    @classmethod
+    def classify(cls, expr: expression.Expression, ont: data_model.OntologyInterface) -> ClassificationResult:
+        try:
+            parents = ont.expression_hierarchy(expr)
+        except ontology.AccidentalEquivalency as e:
+            return cls(equivalent_to=e.sctid)
+        return cls(parents=frozenset(parents), concept_code=expr.hash_concept_code(ont))
+
+
+def ontology_version(ont: data_model.OntologyInterface) -> str:
+    """Returns a string identifying the release of the ontology by the dates of its modules"""
+    return ';'.join(f"{module}={date.isoformat()}" for module, date in sorted(ont.version.items()))
+
+
+class ClassificationCache:
+    """Persistent store of classification results in a SQLite file, keyed by the canonical string of the
+    normal form of an expression.
+
+    Every entry is also keyed by the ontology version and HASH_COMPATIBILITY_VERSION, so results obtained
+    against another release or with another hasher are never served. Such entries are purged on opening.
+    """
+
+    def __init__(self, path: str, ont: data_model.OntologyInterface) -> None:
+        self.path = path
+        self.ont = ont
+        self._key = (ontology_version(ont), HASH_COMPATIBILITY_VERSION.decode())
+        self.hits = 0
+        self.misses = 0
+
+        # Server handles requests in threads; a single connection is shared under the lock
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(_SCHEMA)
+
+        purged = self._connection.execute(
+                "DELETE FROM classification WHERE ontology_version != ? OR hasher != ?", self._key).rowcount
+        if purged:
+            cache_logger.info(f"Purged {purged} stale classification results from {path}.")
+
+    def __len__(self) -> int:
+        with self._lock:
+            count, = self._connection.execute("SELECT COUNT(*) FROM classification").fetchone()
+        return count
+
+    def get(self, canonical: str) -> ClassificationResult | None:
+        with self._lock:
+            row = self._connection.execute(
+                    "SELECT parents, equivalent_to, concept_code FROM classification "
+                    "WHERE ontology_version = ? AND hasher = ? AND canonical = ?", (*self._key, canonical)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        parents, equivalent_to, concept_code = row
+        return ClassificationResult(parents=frozenset(json.loads(parents)), concept_code=concept_code,
+                                    equivalent_to=equivalent_to)
+
+    def put(self, canonical: str, result: ClassificationResult) -> None:
+        with self._lock:
+            self._connection.execute(
+                    "INSERT OR REPLACE INTO classification VALUES (?, ?, ?, ?, ?, ?)",
+                    (*self._key, canonical, json.dumps(sorted(result.parents)), result.equivalent_to,
+                     result.concept_code))
+
+    def classify(self, expr: expression.Expression) -> ClassificationResult:
+        """Returns the stored result for the expression, classifying and storing it on a miss"""
+        canonical = expr.canonical(self.ont)
+        result = self.get(canonical)
+        if result is None:
+            result = ClassificationResult.classify(expr, self.ont)
+            self.put(canonical, result)
+        return result
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
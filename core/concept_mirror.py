@@ -0,0 +1,153 @@
+# Copyright 2022 Sciforce Ukraine. All rights reserved.
+from __future__ import annotations
+
+from typing import Any, Callable, Iterable
+
+import pandas as pd
+
+from utils.logger import jacka_logger
+
+mirror_logger = jacka_logger.getChild('SnomedMirror')
+
+# CONCEPT columns used while ingesting expressions
+MIRRORED_COLUMNS = (
+        'concept_id',
+        'concept_code',
+        'concept_name',
+        'vocabulary_id',
+        'standard_concept',
+        'domain_id',
+        'concept_class_id',
+        )
+
+
+class SnomedConceptMirror:
+    """Read-through in-memory copy of the SNOMED slice of CONCEPT and of 'Maps to' relationships from it.
+
+    Lookups that miss the mirror are passed to the backend query function, and the results are remembered.
+    Writes made through the vocabulary must be reported with update() and forget() to keep the mirror in sync.
+    """
+
+    def __init__(self, concepts: pd.DataFrame, mappings: pd.DataFrame,
+                 query: Callable[..., pd.DataFrame]) -> None:
+        """
+        @param concepts: CONCEPT rows of the SNOMED vocabulary
+        @param mappings: 'Maps to' rows of CONCEPT_RELATIONSHIP, where concept_id_1 is a SNOMED concept
+        @param query: Backend function with the signature of OmopVocabulary.query_table for read-through
+        """
+        self._query = query
+
+        self._by_id: dict[int, tuple] = dict()
+        self._by_code: dict[str, tuple] = dict()
+        self._remember(concepts)
+
+        # Concepts absent from the dictionary either have no mappings or were never looked up
+        self._maps_to: dict[int, list[int]] = dict()
+        self._mapped_from: dict[int, set[int]] = dict()
+        for source_id, target_id in zip(mappings['concept_id_1'].tolist(), mappings['concept_id_2'].tolist()):
+            self._add_mapping(source_id, target_id)
+
+        mirror_logger.info(f"Mirrored {len(self._by_code)} SNOMED concepts and {len(mappings)} mappings.")
+
+    def __len__(self) -> int:
+        return len(self._by_code)
+
+    def _remember(self, concepts: pd.DataFrame) -> None:
+        # Backends may return frames without columns for empty results
+        if concepts.empty:
+            return
+
+        rows = zip(*(concepts[column].tolist() for column in MIRRORED_COLUMNS))
+        for row in rows:
+            # Missing values come back from pandas as NaN
+            row = tuple(None if isinstance(value, float) and value != value else value for value in row)
+            self._store(row)
+
+    def _store(self, row: tuple) -> None:
+        self._by_id[row[0]] = row
+        if row[3] == 'SNOMED':
+            self._by_code[row[1]] = row
+
+    def _is_snomed(self, concept_id: int) -> bool:
+        return concept_id in self._by_id and self._by_id[concept_id][3] == 'SNOMED'
+
+    def _add_mapping(self, source_id: int, target_id: int) -> None:
+        self._maps_to.setdefault(source_id, []).append(target_id)
+        self._mapped_from.setdefault(target_id, set()).add(source_id)
+
+    def _remove_relationship(self, source_id: int, target_id: int) -> None:
+        try:
+            self._maps_to[source_id].remove(target_id)
+            self._mapped_from[target_id].discard(source_id)
+        except (KeyError, ValueError):
+            pass
+
+    @staticmethod
+    def _frame(rows: Iterable[tuple]) -> pd.DataFrame:
+        return pd.DataFrame.from_records(list(rows), columns=MIRRORED_COLUMNS)
+
+    def concepts_by_code(self, concept_codes: Iterable[str]) -> pd.DataFrame:
+        """Returns SNOMED concepts having the given codes"""
+        concept_codes = list(concept_codes)
+        missing = [code for code in concept_codes if code not in self._by_code]
+        if missing:
+            self._remember(self._query('concept', vocabulary_id=['SNOMED'], concept_code=missing))
+
+        return self._frame(self._by_code[code] for code in dict.fromkeys(concept_codes) if code in self._by_code)
+
+    def concepts_by_id(self, concept_ids: Iterable[int]) -> pd.DataFrame:
+        """Returns concepts of any vocabulary having the given ids"""
+        concept_ids = list(concept_ids)
+        missing = [concept_id for concept_id in concept_ids if concept_id not in self._by_id]
+        if missing:
+            self._remember(self._query('concept', concept_id=missing))
+
+        return self._frame(self._by_id[cid] for cid in dict.fromkeys(concept_ids) if cid in self._by_id)
+
+    def mapping(self, concept_id: int) -> list[int]:
+        """Returns targets of 'Maps to' relationships of the concept"""
+        try:
+            return list(self._maps_to[concept_id])
+        except KeyError:
+            pass
+
+        # All mappings of SNOMED concepts are loaded up front
+        if self._is_snomed(concept_id):
+            return []
+
+        found = self._query('concept_relationship', concept_id_1=[concept_id], relationship_id=['Maps to'])
+        self._maps_to[concept_id] = []
+        for target_id in found['concept_id_2'].tolist() if not found.empty else []:
+            self._add_mapping(concept_id, target_id)
+        return list(self._maps_to[concept_id])
+
+    def update(self, inserts: dict[str, list[dict[str, Any]]]) -> None:
+        """Applies executed inserts to mirrored concepts and mappings"""
+        for insert in inserts.get('concept', []):
+            if insert['concept_id'] in self._by_id or insert.get('vocabulary_id') == 'SNOMED':
+                self._store(tuple(insert.get(column) for column in MIRRORED_COLUMNS))
+
+        for insert in inserts.get('concept_relationship', []):
+            # Relationships are keyed by their type as well, so other types never replace a mapping
+            if insert['relationship_id'] != 'Maps to':
+                continue
+
+            source_id, target_id = insert['concept_id_1'], insert['concept_id_2']
+            # A repeated mapping replaces the existing row
+            self._remove_relationship(source_id, target_id)
+            if source_id in self._maps_to or self._is_snomed(source_id):
+                self._add_mapping(source_id, target_id)
+
+    def forget(self, concept_id: int) -> None:
+        """Drops the concept and all mappings from and to it; the next lookup will read through"""
+        row = self._by_id.pop(concept_id, None)
+        if row is not None and self._by_code.get(row[1]) is row:
+            del self._by_code[row[1]]
+
+        for target_id in self._maps_to.pop(concept_id, []):
+            self._mapped_from.get(target_id, set()).discard(concept_id)
+        for source_id in self._mapped_from.pop(concept_id, set()):
+            try:
+                self._maps_to[source_id].remove(concept_id)
+            except (KeyError, ValueError):
+                pass
@@ -1,9 +1,12 @@
 # Copyright 2022 Sciforce Ukraine. All rights reserved.
 from __future__ import annotations
 
+from dataclasses import FrozenInstanceError
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Iterable, Protocol, Iterator, Any
+import operator
+import weakref
+from typing import Iterable, Protocol, Iterator, Any, Callable, Mapping, Sequence
 import typing
 import pandas as pd
 
@@ -16,6 +19,9 @@ class OntologyInterface(Protocol):
     def is_descendant(self, concept_id: int, ancestor_id: int) -> HierarchicalMatch:
         ...
 
+    def ancestor_distances(self, concept_id: int) -> dict[int, int]:
+        ...
+
     def is_primitive(self, concept_id: int) -> bool:
         ...
 
@@ -42,9 +48,15 @@ class MetaRelationship(Protocol):
     def descends_from(self, rel2: MetaRelationship, ont: OntologyInterface) -> HierarchicalMatch:
         ...
 
+    def descends_from_many(self, candidates: Sequence[MetaRelationship], ont: OntologyInterface) -> list[int]:
+        ...
+
     def substitute_sctid(self, old_id: int, new_id: int) -> MetaRelationship:
         ...
 
+    def substitute_sctids(self, replacements: Mapping[int, int]) -> MetaRelationship:
+        ...
+
     def canonical(self) -> str:
         ...
 
@@ -52,6 +64,14 @@ class MetaRelationship(Protocol):
 RawRelationshipGroup = dict[int, list[MetaRelationship]]
 
 
+def first_descended(distances: Sequence[int]) -> int:
+    """Returns the index of the first candidate matched by descends_from_many, or -1 if there is none"""
+    for i, distance in enumerate(distances):
+        if distance >= 0:
+            return i
+    return -1
+
+
 @dataclass(slots=True, frozen=True, order=True)
 class HierarchicalMatch:
     """Logic package that contains information about hierarchical relation between two entities.
@@ -82,11 +102,106 @@ class HierarchicalMatch:
         return self.distance
 
 
-@dataclass(frozen=True, order=True)
-class Relationship:
+class _InternedRelationship:
+    """Immutable value object shared by all equal instances.
+
+    Constructing a relationship returns the existing instance with the same fields, if there is one, so the
+    ontology holds a single object per distinct attribute. Instances are interned by weak reference, so those
+    built from request input are dropped once no expression holds them. The hash is computed once on creation.
+    Behaves like a frozen, ordered dataclass with an `ord` field, which it replaced.
+    """
+    __slots__ = ('_hash', '__weakref__')
+    ord: int = 0
+
+    # Returns the fields as a tuple, which is also the sort key. Not a descriptor, so it is called with the instance.
+    _astuple: Callable[[Any], tuple]
+
+    def _init_fields(self, type_id: int, value: Any) -> None:
+        raise NotImplementedError
+
+    @classmethod
+    def _intern(cls, type_id: int, value: Any, table: dict) -> Any:
+        # Nested by typeId, so that keys are the very objects held by the instances. Attribute types are few,
+        # so only the inner tables need to forget instances.
+        by_value = table.get(type_id)
+        if by_value is None:
+            by_value = table.setdefault(type_id, weakref.WeakValueDictionary())
+        self = by_value.get(value)
+        if self is not None:
+            return self
+
+        self = object.__new__(cls)
+        self._init_fields(type_id, value)
+        return by_value.setdefault(value, self)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise FrozenInstanceError(f"cannot assign to field {name!r}")
+
+    def __delattr__(self, name: str) -> None:
+        raise FrozenInstanceError(f"cannot delete field {name!r}")
+
+    def __reduce__(self) -> tuple:
+        # Unpickled relationships are interned as well
+        return type(self), self._astuple(self)
+
+    def __repr__(self) -> str:
+        fields = ', '.join(f"{name}={value!r}" for name, value in zip(self.__slots__, self._astuple(self)))
+        return f"{type(self).__name__}({fields}, ord={self.ord})"
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __eq__(self, other: Any) -> bool:
+        if self is other:
+            return True
+        if other.__class__ is self.__class__:
+            return self._astuple(self) == other._astuple(other)
+        return NotImplemented
+
+    def __lt__(self, other: Any) -> bool:
+        if other.__class__ is self.__class__:
+            return self._astuple(self) < other._astuple(other)
+        return NotImplemented
+
+    def __le__(self, other: Any) -> bool:
+        if other.__class__ is self.__class__:
+            return self._astuple(self) <= other._astuple(other)
+        return NotImplemented
+
+    def __gt__(self, other: Any) -> bool:
+        if other.__class__ is self.__class__:
+            return self._astuple(self) > other._astuple(other)
+        return NotImplemented
+
+    def __ge__(self, other: Any) -> bool:
+        if other.__class__ is self.__class__:
+            return self._astuple(self) >= other._astuple(other)
+        return NotImplemented
+
+
+class Relationship(_InternedRelationship):
+    __slots__ = ('typeId', 'destinationId')
+    _interned: dict[int, weakref.WeakValueDictionary[int, Relationship]] = dict()
+    _astuple = operator.attrgetter(*__slots__)
+    ord = 1
+
     typeId: int
     destinationId: int
-    ord: int = 1
+
+    def __new__(cls, typeId: int | None = None, destinationId: int | None = None) -> Relationship:
+        # Arguments are only omitted when unpickling caches written before interning
+        if typeId is None:
+            return object.__new__(cls)
+        return cls._intern(typeId, destinationId, cls._interned)
+
+    def _init_fields(self, type_id: int, destination_id: int) -> None:
+        object.__setattr__(self, 'typeId', type_id)
+        object.__setattr__(self, 'destinationId', destination_id)
+        object.__setattr__(self, '_hash', hash((type_id, destination_id, self.ord)))
+
+    def __setstate__(self, state: dict) -> None:
+        # Caches pickled before interning store instance dictionaries
+        self._init_fields(state['typeId'], state['destinationId'])
 
     def descends_from(self, rel2: MetaRelationship, ont: OntologyInterface) -> HierarchicalMatch:
         # Never true for ConcreteRelationship:
@@ -110,6 +225,23 @@ class Relationship:
 
         return HierarchicalMatch(dist)
 
+    def descends_from_many(self, candidates: Sequence[MetaRelationship], ont: OntologyInterface) -> list[int]:
+        """Batched descends_from: distances to each of the candidates, -1 where it is not a descendant"""
+        type_ancestors = ont.ancestor_distances(self.typeId)
+        destination_ancestors = ont.ancestor_distances(self.destinationId)
+
+        distances = []
+        for candidate in candidates:
+            type_distance = destination_distance = None
+            if type(candidate) is Relationship:
+                type_distance = type_ancestors.get(candidate.typeId)
+                destination_distance = destination_ancestors.get(candidate.destinationId)
+            if type_distance is None or destination_distance is None:
+                distances.append(-1)
+            else:
+                distances.append(type_distance + destination_distance)
+        return distances
+
     def substitute_sctid(self, old_id: int, new_id: int) -> Relationship:
         if self.typeId == old_id:
             return Relationship(new_id, self.destinationId)
@@ -117,15 +249,42 @@ class Relationship:
             return Relationship(self.typeId, new_id)
         return self
 
+    def substitute_sctids(self, replacements: Mapping[int, int]) -> Relationship:
+        type_id = replacements.get(self.typeId, self.typeId)
+        destination_id = replacements.get(self.destinationId, self.destinationId)
+        if type_id == self.typeId and destination_id == self.destinationId:
+            return self
+        return Relationship(type_id, destination_id)
+
     def canonical(self) -> str:
         return str(self.typeId) + '=' + str(self.destinationId)
 
 
-@dataclass(frozen=True, order=True)
-class ConcreteRelationship:
+class ConcreteRelationship(_InternedRelationship):
+    __slots__ = ('typeId', 'concreteValue')
+    _interned: dict[tuple[int, type], weakref.WeakValueDictionary[Any, ConcreteRelationship]] = dict()
+    _astuple = operator.attrgetter(*__slots__)
+    ord = 2
+
     typeId: int
     concreteValue: str | int | float | bool
-    ord: int = 2
+
+    def __new__(cls, typeId: int | None = None,
+                concreteValue: str | int | float | bool | None = None) -> ConcreteRelationship:
+        # Arguments are only omitted when unpickling caches written before interning
+        if typeId is None:
+            return object.__new__(cls)
+        # Equal values of different types, like 1 and True, are written differently in canonical forms
+        return cls._intern((typeId, type(concreteValue)), concreteValue, cls._interned)
+
+    def _init_fields(self, type_key: tuple[int, type], value: str | int | float | bool) -> None:
+        object.__setattr__(self, 'typeId', type_key[0])
+        object.__setattr__(self, 'concreteValue', value)
+        object.__setattr__(self, '_hash', hash((type_key[0], value, self.ord)))
+
+    def __setstate__(self, state: dict) -> None:
+        # Caches pickled before interning store instance dictionaries
+        self._init_fields((state['typeId'], None), state['concreteValue'])
 
     def descends_from(self, rel2: MetaRelationship, *_) -> HierarchicalMatch:
         if not isinstance(rel2, type(self)):
@@ -137,11 +296,21 @@ class ConcreteRelationship:
 
         return HierarchicalMatch(-1)
 
+    def descends_from_many(self, candidates: Sequence[MetaRelationship], *_) -> list[int]:
+        """Batched descends_from: 0 for candidates equal to this relationship, -1 for the rest"""
+        return [0 if candidate == self else -1 for candidate in candidates]
+
     def substitute_sctid(self, old_id: int, new_id: int) -> ConcreteRelationship:
         if self.typeId == old_id:
             return ConcreteRelationship(new_id, self.concreteValue)
         return self
 
+    def substitute_sctids(self, replacements: Mapping[int, int]) -> ConcreteRelationship:
+        type_id = replacements.get(self.typeId, self.typeId)
+        if type_id == self.typeId:
+            return self
+        return ConcreteRelationship(type_id, self.concreteValue)
+
     def canonical(self) -> str:
         if isinstance(self.concreteValue, bool):
             return str(self.typeId) + '=' + str(self.concreteValue).upper()
@@ -174,7 +343,7 @@ class RelationshipGroup:
 
         sorted_rels = []
         for key in all_classes:
-            sorted_rels.extend(sorted(rel_classes[key]))  # type: ignore
+            sorted_rels.extend(sorted(rel_classes[key], key=key._astuple))  # type: ignore
 
         return cls(tuple(sorted_rels))  # type: ignore
 
@@ -188,36 +357,35 @@ class RelationshipGroup:
         We consider match successfull, if all attributes from parent have descendants among self;
         If matches were not found in group, check additional attributes.
         """
-        addl_atrs = addl_atrs or list()
+        addl_atrs = list(addl_atrs) if addl_atrs else list()
+        candidates = relg2.relationships
 
         distance = 0
         matched_from_relg2 = list()
         for relationship_1 in self:
 
-            matched = False
-            for relationship_2 in relg2:
-
-                match = relationship_1.descends_from(relationship_2, ont)
-                if match:
-                    distance += match.distance
-                    matched_from_relg2.append(relationship_2)
-                    matched = True
-                    break
-
-            if not matched:
-                for attribute in addl_atrs:
-                    match = relationship_1.descends_from(attribute, ont)
-                    if match:
-                        # Using ungroupped attributes means that factual distance is at least 1 above the observed
-                        distance += match.distance + 1
-                        matched_from_relg2.append(attribute)
-
-                        try:
-                            set_to_clear.remove(attribute)
-                        except KeyError:
-                            pass
-
-                        break
+            # Each relationship is compared against all candidates at once; the first match is taken
+            if candidates:
+                distances = relationship_1.descends_from_many(candidates, ont)
+                first = first_descended(distances)
+                if first >= 0:
+                    distance += distances[first]
+                    matched_from_relg2.append(candidates[first])
+                    continue
+
+            if addl_atrs:
+                distances = relationship_1.descends_from_many(addl_atrs, ont)
+                first = first_descended(distances)
+                if first >= 0:
+                    attribute = addl_atrs[first]
+                    # Using ungroupped attributes means that factual distance is at least 1 above the observed
+                    distance += distances[first] + 1
+                    matched_from_relg2.append(attribute)
+
+                    try:
+                        set_to_clear.remove(attribute)
+                    except KeyError:
+                        pass
 
         if len(matched_from_relg2) == len(relg2.relationships):
             # Increase hierarchical distance for number of unmatched relationships, to prevent mapping
@@ -233,6 +401,13 @@ class RelationshipGroup:
             new_self.append(relationship.substitute_sctid(old_id, new_id))
         return RelationshipGroup.freeze(new_self)
 
+    def substitute_sctids(self, replacements: Mapping[int, int]) -> RelationshipGroup:
+        """Substitutes all given SCTIDs at once; the group is only rebuilt if any of them is present"""
+        new_self = [relationship.substitute_sctids(replacements) for relationship in self]
+        if all(new is old for new, old in zip(new_self, self)):
+            return self
+        return RelationshipGroup.freeze(new_self)
+
     def canonical(self) -> str:
         s = '{'
         s += ','.join(rel.canonical() for rel in self)
@@ -1,11 +1,18 @@
 # Copyright 2022 Sciforce Ukraine. All rights reserved.
 from __future__ import annotations
 
-from typing import Iterable
+import copy
+from typing import Iterable, Mapping
 
+from utils import caching
 from utils import hashing
 from core import data_model
 
+# Normal forms by ontology and raw canonical form of the expression. Must be cleared when an ontology is loaded,
+# as identifiers of discarded ontologies may be reused.
+NORMAL_FORM_CACHE_SIZE = 16384
+normal_form_cache: caching.LRUCache[tuple[int, str], Expression] = caching.LRUCache(NORMAL_FORM_CACHE_SIZE)
+
 
 class Expression:
     """Structure class to represent expression contents"""
@@ -51,12 +58,29 @@ class Expression:
         self.normalized = None
 
     def normal_form(self, ont: data_model.OntologyInterface) -> Expression:
-        """Infer attribute defintions and proximal primitives from all stated parents and return a new Expression """
+        """Infer attribute defintions and proximal primitives from all stated parents and return a new Expression.
+        Normal forms are shared between expressions with the same raw canonical form and must not be modified."""
 
         # If we have already normalized this expression, return the cached version
         if self.normalized is not None:
             return self.normalized
 
+        key = (id(ont), self.canonical(ont, raw=True))
+        nnf = normal_form_cache.get(key)
+        if nnf is None:
+            nnf = self._normalize(ont)
+            normal_form_cache.put(key, nnf)
+
+        # Share concept_id with the original expression
+        if nnf.concept_id != self.concept_id:
+            nnf = copy.copy(nnf)
+            nnf.concept_id = self.concept_id
+            nnf.normalized = nnf
+
+        self.normalized = nnf
+        return nnf
+
+    def _normalize(self, ont: data_model.OntologyInterface) -> Expression:
         # Collect proximal primitive parents, ungroupped attributes and separated attribute groups
         new_parents: set[int] = set()
         parent_attrs: list[data_model.MetaRelationship] = []
@@ -148,8 +172,7 @@ class Expression:
         nnf.concept_id = self.concept_id
         nnf.definition_status = self.definition_status
 
-        # Remember nnf as normal, both for itself and this expression
-        self.normalized = nnf
+        # Remember nnf as normal for itself
         nnf.normalized = nnf
 
         # Return the completed normalized form
@@ -312,6 +335,16 @@ class Expression:
                                     for group in self.relationship_groups]
         self._cf_cache = None
 
+    def substitute_sctids(self, replacements: Mapping[int, int]) -> None:
+        """Substitutes every SCTID present in the mapping in a single pass over the relationships"""
+        relationship_groups = [group.substitute_sctids(replacements) for group in self.relationship_groups]
+        if all(new is old for new, old in zip(relationship_groups, self.relationship_groups)):
+            return
+
+        self.relationship_groups = relationship_groups
+        self.normalized = None
+        self._cf_cache = None
+
     def get_attribute_counts(self,
                              use_ontology: data_model.OntologyInterface | None = None) -> dict[int, dict[int, int]]:
         """Returns a dictionary of attribute type ids and their counts per group in the expression.
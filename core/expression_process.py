@@ -1,5 +1,7 @@
 # Copyright 2022 Sciforce Ukraine. All rights reserved.
+import copy
 import random
+import re
 from typing import Iterable
 
 import antlr4
@@ -8,6 +10,7 @@ from antlr_generated.SNOMEDLexer import SNOMEDLexer
 from antlr_generated.SNOMEDListener import SNOMEDListener
 from antlr_generated.SNOMEDParser import SNOMEDParser
 from core import data_model
+from utils import caching
 import core.expression
 
 
@@ -58,6 +61,7 @@ class Processor(SNOMEDListener):
         self.concrete_relationship: bool = False
         self.set_counter_stack: list[int] = []
         self.expect_numeric_value: bool = False
+        self.numeric_sign: int = 1
 
         # Initialize error listener that will always raise an exception
         self.error_listener = ErrorListener()
@@ -158,17 +162,19 @@ class Processor(SNOMEDListener):
 
     def enterNumericValue(self, ctx: SNOMEDParser.NumericValueContext):
         self.expect_numeric_value = True
+        # The sign is a token of the numeric value itself, not of the decimal or integer that follows it
+        self.numeric_sign = -1 if ctx.getText().startswith('-') else 1
         return super().enterNumericValue(ctx)
         
     def enterDecimal(self, ctx: SNOMEDParser.DecimalContext):
-        self.current_value = float(ctx.getText())
+        self.current_value = self.numeric_sign * float(ctx.getText())
         self.expect_numeric_value = False
         return super().enterDecimal(ctx)
     
     def enterInteger(self, ctx: SNOMEDParser.IntegerContext):
         # Only process integer values that were not part of decimal definition
         if self.expect_numeric_value:
-            self.current_value = int(ctx.getText())
+            self.current_value = self.numeric_sign * int(ctx.getText())
         return super().enterInteger(ctx)
     
     def enterExpressionValue(self, ctx: SNOMEDParser.ExpressionValueContext):
@@ -201,3 +207,282 @@ class Processor(SNOMEDListener):
         tree = parse(expression)
         walker.walk(self, tree)
         return self.expression_store
+
+
+class _Context:
+    """Stand-in for ANTLR rule contexts passed to listener methods by the hand-written parser"""
+
+    def __init__(self, text: str = '', definition_status: str | None = None) -> None:
+        self._text = text
+        self._definition_status = None if definition_status is None else _Context(definition_status)
+
+    def getText(self) -> str:
+        return self._text
+
+    # noinspection PyPep8Naming
+    def DEFINITIONSTATUS(self):
+        return self._definition_status
+
+
+_WHITESPACE = ' \t\n\r'
+_DIGITS = '0123456789'
+
+
+class FastProcessor(Processor):
+    """Recursive-descent parser for the compositional grammar accepted by SNOMEDParser.
+
+    Instead of building a parse tree, the parser calls the same listener methods as the ANTLR tree walker would,
+    in the same order, so both processors produce identical expressions. Unlike the ANTLR parser, which reports
+    syntax errors to the console and recovers, any syntax error raises SNOMEDExpressionsError. Numeric and string
+    values are read as the compositional grammar defines them, which the generated lexer can not tokenize.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._text = ''
+        self._pos = 0
+
+    # Scanning helpers
+    def _error(self, message: str, pos: int | None = None):
+        pos = self._pos if pos is None else pos
+        line = self._text.count('\n', 0, pos) + 1
+        column = pos - (self._text.rfind('\n', 0, pos) + 1)
+        found = repr(self._text[pos]) if pos < len(self._text) else '<EOF>'
+        raise SNOMEDExpressionsError(
+                message=f"Syntax error at line {line}, column {column}: {message}, found {found}",
+                line=line,
+                column=column,
+                )
+
+    def _skip_whitespace(self) -> None:
+        while self._pos < len(self._text) and self._text[self._pos] in _WHITESPACE:
+            self._pos += 1
+
+    def _peek(self) -> str:
+        self._skip_whitespace()
+        return self._text[self._pos:self._pos + 1]
+
+    def _accept(self, literal: str) -> bool:
+        self._skip_whitespace()
+        if self._text.startswith(literal, self._pos):
+            self._pos += len(literal)
+            return True
+        return False
+
+    def _expect(self, literal: str) -> None:
+        if not self._accept(literal):
+            self._error(f"expected '{literal}'")
+
+    def _digits(self) -> str:
+        start = self._pos
+        while self._pos < len(self._text) and self._text[self._pos] in _DIGITS:
+            self._pos += 1
+        return self._text[start:self._pos]
+
+    def _keyword(self) -> str | None:
+        self._skip_whitespace()
+        for keyword in ('true', 'false'):
+            if self._text[self._pos:self._pos + len(keyword)].lower() == keyword:
+                self._pos += len(keyword)
+                return keyword
+        return None
+
+    # Grammar rules
+    def _expression(self) -> None:
+        definition_status = None
+        for status in ('===', '<<<'):
+            if self._accept(status):
+                definition_status = status
+                break
+
+        self._sub_expression()
+        if self._peek():
+            self._error("expected end of expression")
+        self.exitExpression(_Context(definition_status=definition_status))  # type: ignore
+
+    def _sub_expression(self) -> None:
+        ctx = _Context()
+        self.enterSubExpression(ctx)  # type: ignore
+
+        self.enterFocusConcept(ctx)  # type: ignore
+        self._concept_reference()
+        while self._accept('+'):
+            self._concept_reference()
+        self.exitFocusConcept(ctx)  # type: ignore
+
+        if self._accept(':'):
+            self._refinement()
+
+        self.exitSubExpression(ctx)  # type: ignore
+
+    def _concept_reference(self) -> None:
+        self._skip_whitespace()
+        start = self._pos
+        sctid = self._digits()
+        if len(sctid) < 2 or sctid[0] == '0':
+            self._error("expected SCTID", start)
+        self.enterConceptId(_Context(sctid))  # type: ignore
+
+        # Terms are not used
+        if self._accept('|'):
+            end = self._text.find('|', self._pos)
+            if end <= self._pos:
+                self._error("expected concept term between '|'")
+            self._pos = end + 1
+
+    def _refinement(self) -> None:
+        if self._peek() == '{':
+            self._attribute_group()
+        else:
+            self._attribute_set()
+
+        while True:
+            if self._peek() == '{':
+                self._attribute_group()
+            elif self._peek() == ',':
+                self._accept(',')
+                if self._peek() != '{':
+                    self._error("expected '{'")
+                self._attribute_group()
+            else:
+                return
+
+    def _attribute_group(self) -> None:
+        self._expect('{')
+        self.enterAttributeGroup(_Context())  # type: ignore
+        self._attribute_set()
+        self._expect('}')
+
+    def _attribute_set(self) -> None:
+        ctx = _Context()
+        self.enterAttributeSet(ctx)  # type: ignore
+        self._attribute()
+
+        # Comma followed by a group separates groups, not attributes
+        while self._peek() == ',':
+            saved = self._pos
+            self._accept(',')
+            if self._peek() == '{':
+                self._pos = saved
+                break
+            self._attribute()
+
+        self.exitAttributeSet(ctx)  # type: ignore
+
+    def _attribute(self) -> None:
+        self.enterAttributeName(_Context())  # type: ignore
+        self._concept_reference()
+        self._expect('=')
+        self._attribute_value()
+
+    def _attribute_value(self) -> None:
+        ctx = _Context()
+        next_char = self._peek()
+
+        if next_char == '(' or next_char in _DIGITS and next_char:
+            self.enterExpressionValue(ctx)  # type: ignore
+            if self._accept('('):
+                self._sub_expression()
+                self._expect(')')
+            else:
+                self._concept_reference()
+
+        elif next_char == '"':
+            self._pos += 1
+            end = self._text.find('"', self._pos)
+            if end <= self._pos:
+                self._error("expected string value followed by '\"'")
+            self.enterStringValue(_Context(self._text[self._pos:end]))  # type: ignore
+            self._pos = end + 1
+
+        elif next_char == '#':
+            self._pos += 1
+            self._numeric_value()
+
+        else:
+            keyword = self._keyword()
+            if keyword is None:
+                self._error("expected attribute value")
+            self.enterBooleanValue(_Context(keyword))  # type: ignore
+
+        self.exitAttributeValue(ctx)  # type: ignore
+
+    def _numeric_value(self) -> None:
+        sign = '-' if self._accept('-') else '+' if self._accept('+') else ''
+        self.enterNumericValue(_Context(sign))  # type: ignore
+
+        self._skip_whitespace()
+        start = self._pos
+        integer = self._digits()
+        if not integer or (integer[0] == '0' and len(integer) > 1):
+            self._error("expected integer", start)
+
+        if self._text.startswith('.', self._pos):
+            self._pos += 1
+            if not self._digits():
+                self._error("expected decimal digits")
+            self.enterDecimal(_Context(self._text[start:self._pos]))  # type: ignore
+
+        self.enterInteger(_Context(integer))  # type: ignore
+
+    def process(self, expression: str) -> list[core.expression.Expression]:
+        self._text, self._pos = expression, 0
+        self._expression()
+        return self.expression_store
+
+
+# Processor implementations by name, as used in configuration
+PROCESSORS: dict[str, type[Processor]] = {
+        'antlr': Processor,
+        'fast': FastProcessor,
+        }
+
+
+# Parsed expressions by processor and normalized text, see parse()
+PARSE_CACHE_SIZE = 8192
+parse_cache: caching.LRUCache[tuple[type[Processor], str], list[core.expression.Expression]] = \
+    caching.LRUCache(PARSE_CACHE_SIZE)
+
+# String values are kept verbatim; terms and whitespace are gaps; anything else is significant
+_KEY_TOKENS = re.compile(r'("[^"]*")|(\|[^|]*\||[ \t\n\r]+)|([^"| \t\n\r]+|["|])')
+
+
+def cache_key(expression: str) -> str:
+    """Returns the expression text with terms removed and whitespace collapsed. Texts with the same key
+    are parsed into the same expressions."""
+    pieces: list[str | None] = []
+    for string_value, gap, text in _KEY_TOKENS.findall(expression):
+        if gap:
+            if pieces and pieces[-1] is not None:
+                pieces.append(None)
+        else:
+            pieces.append(string_value or text)
+
+    # A gap only matters where it separates two numbers or words
+    key = ''
+    for i, piece in enumerate(pieces):
+        if piece is None:
+            if 0 < i < len(pieces) - 1 and key[-1:].isalnum() and pieces[i + 1][:1].isalnum():
+                key += ' '
+        else:
+            key += piece
+    return key
+
+
+def parse(expression: str, processor: type[Processor] = FastProcessor) -> list[core.expression.Expression]:
+    """Processes the expression with a new processor, unless the same expression was parsed recently.
+    Expressions are returned as fresh copies, as ingestion modifies them."""
+    key = (processor, cache_key(expression))
+    expression_store = parse_cache.get(key)
+    if expression_store is None:
+        expression_store = processor().process(expression)
+        parse_cache.put(key, expression_store)
+    return [_fresh_copy(e) for e in expression_store]
+
+
+def _fresh_copy(expr: core.expression.Expression) -> core.expression.Expression:
+    # Relationship groups are immutable, only the lists holding them need to be copied
+    fresh = copy.copy(expr)
+    fresh.parent_concepts = list(expr.parent_concepts)
+    fresh.relationship_groups = list(expr.relationship_groups)
+    return fresh
@@ -0,0 +1,259 @@
+# Copyright 2022 Sciforce Ukraine. All rights reserved.
+from __future__ import annotations
+
+from typing import Callable, Iterable
+
+import networkx as nx
+import numpy as np
+
+from core import data_model
+
+
+class ReachabilityIndex:
+    """Precomputed transitive closure of the 'Is a' hierarchy.
+
+    Every concept is assigned a dense index. For each concept, the sorted indices of all its strict ancestors
+    are stored in a CSR layout together with the shortest hierarchical distance to each of them, so that
+    ancestorship can be answered with a single binary search over a short slice.
+    """
+
+    def __init__(self, sctids: np.ndarray, offsets: np.ndarray, ancestors: np.ndarray,
+                 distances: np.ndarray) -> None:
+        self.sctids = sctids  # Sorted SCTIDs; position is the dense index
+        self.offsets = offsets  # Start of each concept's ancestor slice, length = concept count + 1
+        self.ancestors = ancestors  # Dense indices of ancestors, sorted within each slice
+        self.distances = distances  # Shortest path length to each ancestor
+        self._index = self._build_index()
+
+    def _build_index(self) -> dict[int, int]:
+        return dict(zip(self.sctids.tolist(), range(len(self.sctids))))
+
+    def __getstate__(self) -> dict:
+        # Dense index is cheap to rebuild and expensive to pickle
+        state = self.__dict__.copy()
+        del state['_index']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._index = self._build_index()
+
+    def __len__(self) -> int:
+        return len(self.sctids)
+
+    def __contains__(self, concept_id: int) -> bool:
+        return concept_id in self._index
+
+    @classmethod
+    def from_graph(cls, graph: nx.DiGraph) -> ReachabilityIndex:
+        """Builds the index from a graph with edges directed from parents to children"""
+        sctids = np.array(sorted(graph.nodes), dtype=np.int64)
+        index = dict(zip(sctids.tolist(), range(len(sctids))))
+
+        empty_ancestors = np.empty(0, dtype=np.int32)
+        empty_distances = np.empty(0, dtype=np.uint16)
+        node_ancestors: list[np.ndarray] = [empty_ancestors] * len(sctids)
+        node_distances: list[np.ndarray] = [empty_distances] * len(sctids)
+
+        # Parents are always processed before their children, so their closures are complete
+        for node in nx.topological_sort(graph):
+            parents = [index[parent] for parent in graph.predecessors(node)]
+            if not parents:
+                continue
+
+            ancestors = np.concatenate([np.array(parents, dtype=np.int32)] +
+                                       [node_ancestors[p] for p in parents])
+            distances = np.concatenate([np.ones(len(parents), dtype=np.uint16)] +
+                                       [node_distances[p] + 1 for p in parents])
+
+            # Keep a single entry per ancestor with the shortest distance
+            order = np.lexsort((distances, ancestors))
+            ancestors, distances = ancestors[order], distances[order]
+            first = np.ones(len(ancestors), dtype=bool)
+            first[1:] = ancestors[1:] != ancestors[:-1]
+
+            i = index[node]
+            node_ancestors[i], node_distances[i] = ancestors[first], distances[first]
+
+        offsets = np.zeros(len(sctids) + 1, dtype=np.int64)
+        np.cumsum([len(a) for a in node_ancestors], out=offsets[1:])
+
+        return cls(
+                sctids=sctids,
+                offsets=offsets,
+                ancestors=np.concatenate(node_ancestors) if node_ancestors else empty_ancestors,
+                distances=np.concatenate(node_distances) if node_distances else empty_distances,
+                )
+
+    def position(self, concept_id: int) -> int:
+        """Returns the dense index of the concept. Raises KeyError for unknown concepts."""
+        return self._index[concept_id]
+
+    def _slice(self, i: int) -> slice:
+        return slice(self.offsets[i], self.offsets[i + 1])
+
+    def distance(self, concept_id: int, ancestor_id: int) -> data_model.HierarchicalMatch:
+        """Returns the shortest hierarchical distance from the concept up to the ancestor"""
+        if concept_id == ancestor_id:
+            return data_model.HierarchicalMatch(0)
+
+        try:
+            i, j = self._index[concept_id], self._index[ancestor_id]
+        except KeyError:
+            return data_model.HierarchicalMatch(-1)
+
+        span = self._slice(i)
+        ancestors = self.ancestors[span]
+        pos = ancestors.searchsorted(j)
+        if pos < len(ancestors) and ancestors[pos] == j:
+            return data_model.HierarchicalMatch(int(self.distances[span][pos]))
+        return data_model.HierarchicalMatch(-1)
+
+    def ancestor_distances(self, concept_id: int) -> dict[int, int]:
+        """Returns shortest distances from the concept up to each of its ancestors, and 0 to itself"""
+        out = {concept_id: 0}
+        i = self._index.get(concept_id)
+        if i is not None:
+            span = self._slice(i)
+            out.update(zip(self.sctids[self.ancestors[span]].tolist(), self.distances[span].tolist()))
+        return out
+
+    def ancestors_of(self, concept_id: int) -> np.ndarray:
+        """Returns SCTIDs of all strict ancestors of the concept"""
+        try:
+            i = self._index[concept_id]
+        except KeyError:
+            return np.empty(0, dtype=np.int64)
+        return self.sctids[self.ancestors[self._slice(i)]]
+
+    def strict_ancestor_set(self, concept_ids: Iterable[int]) -> set[int]:
+        """Returns the union of strict ancestors of the given concepts"""
+        spans = [self.ancestors[self._slice(self._index[concept_id])]
+                 for concept_id in concept_ids if concept_id in self._index]
+        if not spans:
+            return set()
+        return set(self.sctids[np.unique(np.concatenate(spans))].tolist())
+
+    def ancestor_set(self, concept_ids: Iterable[int]) -> set[int]:
+        """Returns the given concepts together with all of their ancestors"""
+        concept_ids = set(concept_ids)
+        return concept_ids | self.strict_ancestor_set(concept_ids)
+
+
+class PrimitiveParentsIndex:
+    """Precomputed proximal primitive parents of every fully defined concept.
+
+    Sets are stored as sorted SCTIDs in a CSR layout over the dense indices of a ReachabilityIndex.
+    Primitive concepts serve as their own proximal primitive parents, so their slices are left empty.
+    """
+
+    def __init__(self, offsets: np.ndarray, parents: np.ndarray) -> None:
+        self.offsets = offsets  # Start of each concept's slice, length = concept count + 1
+        self.parents = parents  # SCTIDs of proximal primitive parents, sorted within each slice
+
+    @classmethod
+    def from_graph(cls, graph: nx.DiGraph, reachability: ReachabilityIndex,
+                   is_primitive: Callable[[int], bool]) -> PrimitiveParentsIndex:
+        """Builds the index in a single pass over a graph with edges directed from parents to children"""
+        primitive_parents: dict[int, set[int]] = {}
+
+        # Parents are always processed before their children, so their sets are complete
+        for node in nx.topological_sort(graph):
+            if is_primitive(node):
+                continue
+
+            node_parents = set()
+            for parent in graph.predecessors(node):
+                if parent in primitive_parents:
+                    node_parents.update(primitive_parents[parent])
+                else:
+                    node_parents.add(parent)
+            primitive_parents[node] = node_parents
+
+        sets = [sorted(primitive_parents.get(sctid, ())) for sctid in reachability.sctids.tolist()]
+        offsets = np.zeros(len(sets) + 1, dtype=np.int64)
+        np.cumsum([len(entry) for entry in sets], out=offsets[1:])
+        parents = np.fromiter((p for entry in sets for p in entry), dtype=np.int64, count=int(offsets[-1]))
+        return cls(offsets=offsets, parents=parents)
+
+    def parents_of(self, position: int) -> np.ndarray:
+        """Returns SCTIDs of proximal primitive parents of a fully defined concept by its dense index"""
+        return self.parents[self.offsets[position]:self.offsets[position + 1]]
+
+
+class AttributeMatrix:
+    """Dense matrix of shortest distances between concepts of the attribute hierarchy.
+
+    Covers the descendants of the given root together with all of their ancestors, so that every ancestor of
+    a covered concept is covered too. Attribute types are few, so comparing two of them is a lookup in a nested
+    list, and all ancestors of one are found among the related columns of its row.
+    """
+
+    def __init__(self, sctids: np.ndarray, distances: np.ndarray) -> None:
+        self.sctids = sctids  # Sorted SCTIDs; position is the row and column index
+        self.distances = distances  # Distance from row concept up to column concept, -1 if unrelated
+        self._index, self._rows = self._build_lookup()
+
+    def _build_lookup(self) -> tuple[dict[int, int], list[list[int]]]:
+        return dict(zip(self.sctids.tolist(), range(len(self.sctids)))), self.distances.tolist()
+
+    def __getstate__(self) -> dict:
+        # Lookups are cheap to rebuild and expensive to pickle
+        state = self.__dict__.copy()
+        del state['_index']
+        del state['_rows']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._index, self._rows = self._build_lookup()
+
+    def __len__(self) -> int:
+        return len(self.sctids)
+
+    def __contains__(self, concept_id: int) -> bool:
+        return concept_id in self._index
+
+    @classmethod
+    def from_reachability(cls, reachability: ReachabilityIndex, root_id: int) -> AttributeMatrix:
+        """Builds the matrix for the hierarchy under root_id"""
+        members = set()
+        if root_id in reachability:
+            root = reachability.position(root_id)
+            # Concepts owning an ancestor slice entry of the root are its descendants
+            entries = np.flatnonzero(reachability.ancestors == root)
+            descendants = reachability.offsets.searchsorted(entries, side='right') - 1
+            for i in [root, *descendants.tolist()]:
+                members.add(i)
+                members.update(reachability.ancestors[reachability._slice(i)].tolist())
+
+        positions = np.array(sorted(members), dtype=np.int64)
+        local = {int(p): k for k, p in enumerate(positions)}
+        distances = np.full((len(positions), len(positions)), -1, dtype=np.int16)
+        np.fill_diagonal(distances, 0)
+        for k, i in enumerate(positions.tolist()):
+            span = reachability._slice(i)
+            columns = [local[a] for a in reachability.ancestors[span].tolist()]
+            distances[k, columns] = reachability.distances[span]
+
+        return cls(sctids=reachability.sctids[positions], distances=distances)
+
+    def distance(self, concept_id: int, ancestor_id: int) -> int | None:
+        """Returns the shortest distance from the concept up to the ancestor, -1 if unrelated,
+        or None if the concept is not covered by the matrix"""
+        i = self._index.get(concept_id)
+        if i is None:
+            return None
+        j = self._index.get(ancestor_id)
+        # Every ancestor of a covered concept is covered
+        return -1 if j is None else self._rows[i][j]
+
+    def ancestor_distances(self, concept_id: int) -> dict[int, int] | None:
+        """Returns shortest distances from the concept up to each of its ancestors and itself,
+        or None if the concept is not covered by the matrix"""
+        i = self._index.get(concept_id)
+        if i is None:
+            return None
+        row = self.distances[i]
+        related = np.flatnonzero(row >= 0)
+        return dict(zip(self.sctids[related].tolist(), row[related].tolist()))
@@ -0,0 +1,313 @@
+# Copyright 2022 Sciforce Ukraine. All rights reserved.
+"""Compact, memory-mapped on-disk representation of the SNOMED Ontology.
+
+File layout (all integers little-endian):
+    * 8 bytes of magic, 4 bytes of format version, 4 reserved bytes, 8 bytes of header length;
+    * JSON header describing metadata and every stored array (dtype, shape, offset);
+    * raw array buffers, each aligned to 64 bytes.
+
+Arrays are opened with mmap, so loading does not deserialize anything and processes forked after loading
+share the same pages.
+"""
+from __future__ import annotations
+
+import datetime
+import functools
+import json
+import mmap
+import pathlib
+import struct
+import sys
+from typing import Iterator
+
+import numpy as np
+
+from core import attribute_index
+from core import data_model
+from core import expression
+from core import hierarchy_index
+from core import ontology
+from utils.logger import jacka_logger
+import validation.data_atoms
+import validation.mrcm
+
+mapped_logger = jacka_logger.getChild('MappedOntology')
+
+MAGIC = b'JACKONT\x00'
+FORMAT_VERSION = 3
+_PREAMBLE = struct.Struct('<8sIIQ')
+_ALIGNMENT = 64
+
+# Relationship kinds in the relationship table
+_CLASSIC = 1
+_CONCRETE = 2
+
+
+class FormatVersionError(ValueError):
+    """Compact file was written by a different version of the format and must be converted again"""
+
+
+def is_mapped_file(filepath: str | pathlib.Path) -> bool:
+    """Checks whether the file starts with the compact ontology signature"""
+    with open(filepath, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _csr(lists: list[list[int]], dtype) -> tuple[np.ndarray, np.ndarray]:
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum([len(entry) for entry in lists], out=offsets[1:])
+    values = np.fromiter((v for entry in lists for v in entry), dtype=dtype, count=int(offsets[-1]))
+    return offsets, values
+
+
+def _collect_arrays(ont: ontology.OntologyBase) -> dict[str, np.ndarray]:
+    reach = ont.reachability
+    signatures = ont.attribute_index
+    sctids = reach.sctids
+    index = {sctid: i for i, sctid in enumerate(sctids.tolist())}
+
+    definition_status = np.zeros(len(sctids), dtype=np.uint8)
+    parents, children, fsn = [], [], []
+    group_counts = np.zeros(len(sctids), dtype=np.uint16)
+    rel_rows: list[list[tuple]] = []
+
+    for i, sctid in enumerate(sctids.tolist()):
+        definition_status[i] = not ont.is_primitive(sctid)
+        parents.append([index[p] for p in ont.predecessors(sctid)])
+        children.append([index[c] for c in ont.successors(sctid)])
+        fsn.append(ont.full_specified_name(sctid).encode('utf-8'))
+
+        groups = ont.get_relationship_groups(sctid)
+        group_counts[i] = len(groups)
+        rows = []
+        for group_number, group in enumerate(groups):
+            for rel in group:
+                if isinstance(rel, data_model.ConcreteRelationship):
+                    rows.append((group_number, _CONCRETE, rel.typeId, 0, float(rel.concreteValue)))
+                else:
+                    rows.append((group_number, _CLASSIC, rel.typeId, rel.destinationId, 0.))
+        rel_rows.append(rows)
+
+    parent_offsets, parent_values = _csr(parents, np.int32)
+    child_offsets, child_values = _csr(children, np.int32)
+
+    rel_offsets = np.zeros(len(sctids) + 1, dtype=np.int64)
+    np.cumsum([len(rows) for rows in rel_rows], out=rel_offsets[1:])
+    flat_rows = [row for rows in rel_rows for row in rows]
+    rel_group, rel_kind, rel_type, rel_destination, rel_value = (
+            zip(*flat_rows) if flat_rows else ((), (), (), (), ()))
+
+    fsn_offsets = np.zeros(len(sctids) + 1, dtype=np.int64)
+    np.cumsum([len(name) for name in fsn], out=fsn_offsets[1:])
+
+    return {
+            'sctids': sctids,
+            'definition_status': definition_status,
+            'parent_offsets': parent_offsets,
+            'parents': parent_values,
+            'child_offsets': child_offsets,
+            'children': child_values,
+            'group_counts': group_counts,
+            'rel_offsets': rel_offsets,
+            'rel_group': np.array(rel_group, dtype=np.uint16),
+            'rel_kind': np.array(rel_kind, dtype=np.uint8),
+            'rel_type': np.array(rel_type, dtype=np.int64),
+            'rel_destination': np.array(rel_destination, dtype=np.int64),
+            'rel_value': np.array(rel_value, dtype=np.float64),
+            'fsn_offsets': fsn_offsets,
+            'fsn_blob': np.frombuffer(b''.join(fsn), dtype=np.uint8),
+            'reach_offsets': reach.offsets,
+            'reach_ancestors': reach.ancestors,
+            'reach_distances': reach.distances,
+            'ppp_offsets': ont.primitive_parents_index.offsets,
+            'ppp_parents': ont.primitive_parents_index.parents,
+            'sig_required_counts': signatures.required_counts,
+            'sig_key_kind': signatures.key_kind,
+            'sig_key_type': signatures.key_type,
+            'sig_key_destination': signatures.key_destination,
+            'sig_key_value': signatures.key_value,
+            'sig_posting_offsets': signatures.posting_offsets,
+            'sig_postings': signatures.postings,
+            }
+
+
+def _collect_metadata(ont: ontology.OntologyBase) -> dict:
+    rules = []
+    for rule in ont.validator.domain_rules:
+        rules.append({
+                'id': str(rule.id),
+                'attributeId': int(rule.attributeId),
+                'domainId': int(rule.domainId),
+                'grouped': bool(rule.grouped),
+                'attribute_cardinality': list(rule.attribute_cardinality),
+                'attribute_in_group_cardinality': list(rule.attribute_in_group_cardinality),
+                'mandatory': bool(rule.mandatory),
+                })
+
+    return {
+            'version': {module: date.isoformat() for module, date in ont.version.items()},
+            'domain_rules': rules,
+            }
+
+
+def write(ont: ontology.OntologyBase, filepath: str | pathlib.Path) -> None:
+    """Writes any populated ontology in the compact format"""
+    mapped_logger.info(f"Writing compact ontology to {filepath}...")
+    arrays = _collect_arrays(ont)
+
+    # Lay out the arrays after the header; offsets are relative to the start of the data section
+    descriptors, offset = {}, 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        arrays[name] = array
+        descriptors[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // _ALIGNMENT) * _ALIGNMENT
+
+    header = json.dumps({'metadata': _collect_metadata(ont), 'arrays': descriptors}).encode('utf-8')
+    data_start = -(-(_PREAMBLE.size + len(header)) // _ALIGNMENT) * _ALIGNMENT
+
+    with open(filepath, 'wb') as f:
+        f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, 0, len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + descriptors[name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+
+    mapped_logger.info(f"Wrote {len(arrays['sctids'])} concepts.")
+
+
+def convert(ont_path: str | pathlib.Path, mapped_path: str | pathlib.Path) -> None:
+    """Converts a pickled .ont cache into the compact format"""
+    write(ontology.Ontology.load(ont_path), mapped_path)
+
+
+class MappedOntology(ontology.OntologyBase):
+    """Read-only ontology backed by a memory-mapped compact file"""
+
+    def __init__(self, buffer: mmap.mmap, header: dict, data_start: int) -> None:
+        self._buffer = buffer
+        self._arrays = {
+                name: np.frombuffer(buffer, dtype=np.dtype(d['dtype']), count=int(np.prod(d['shape'])),
+                                    offset=data_start + d['offset']).reshape(d['shape'])
+                for name, d in header['arrays'].items()
+                }
+        arrays = self._arrays
+
+        self.sctids = arrays['sctids']
+        self.reachability = hierarchy_index.ReachabilityIndex(
+                sctids=self.sctids,
+                offsets=arrays['reach_offsets'],
+                ancestors=arrays['reach_ancestors'],
+                distances=arrays['reach_distances'],
+                )
+        self.primitive_parents_index = hierarchy_index.PrimitiveParentsIndex(
+                offsets=arrays['ppp_offsets'],
+                parents=arrays['ppp_parents'],
+                )
+        # Few hundred concepts, so it is derived on load rather than stored
+        self.attribute_matrix = self._build_attribute_matrix()
+        self.attribute_index = attribute_index.AttributeSignatureIndex(
+                required_counts=arrays['sig_required_counts'],
+                key_kind=arrays['sig_key_kind'],
+                key_type=arrays['sig_key_type'],
+                key_destination=arrays['sig_key_destination'],
+                key_value=arrays['sig_key_value'],
+                posting_offsets=arrays['sig_posting_offsets'],
+                postings=arrays['sig_postings'],
+                )
+
+        metadata = header['metadata']
+        self.version = {module: datetime.date.fromisoformat(date) for module, date in metadata['version'].items()}
+        self.validator = validation.mrcm.MRCMValidator(self, domain_rules=(
+                validation.data_atoms.DomainRule(
+                        **{**rule,
+                           'attribute_cardinality': tuple(rule['attribute_cardinality']),
+                           'attribute_in_group_cardinality': tuple(rule['attribute_in_group_cardinality'])})
+                for rule in metadata['domain_rules']))
+
+        # Relationship groups are materialized on demand; hot concepts are kept around
+        self._groups_cache = functools.lru_cache(maxsize=100_000)(self._read_relationship_groups)
+        self._reset_caches()
+
+    @classmethod
+    def load(cls, filepath: str | pathlib.Path) -> MappedOntology:
+        with open(filepath, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, _, header_length = _PREAMBLE.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{filepath} is not a compact ontology file.")
+        if version != FORMAT_VERSION:
+            raise FormatVersionError(f"{filepath} has format version {version}, expected {FORMAT_VERSION}. "
+                             f"Convert the .ont cache again.")
+
+        header = json.loads(buffer[_PREAMBLE.size:_PREAMBLE.size + header_length])
+        data_start = -(-(_PREAMBLE.size + header_length) // _ALIGNMENT) * _ALIGNMENT
+
+        loaded = cls(buffer, header, data_start)
+        mapped_logger.info(f"Mapped {cls} object containing {len(loaded)} concept entries.")
+
+        # Normal forms computed against a previous ontology are no longer valid
+        expression.normal_form_cache.clear()
+        return loaded
+
+    def __len__(self) -> int:
+        return len(self.sctids)
+
+    def __contains__(self, concept_id: int) -> bool:
+        return concept_id in self.reachability
+
+    def _neighbours(self, concept_id: int, offsets: str, values: str) -> Iterator[int]:
+        i = self.reachability.position(concept_id)
+        start, end = self._arrays[offsets][i], self._arrays[offsets][i + 1]
+        return iter(self.sctids[self._arrays[values][start:end]].tolist())
+
+    def successors(self, concept_id: int) -> Iterator[int]:
+        return self._neighbours(concept_id, 'child_offsets', 'children')
+
+    def predecessors(self, concept_id: int) -> Iterator[int]:
+        return self._neighbours(concept_id, 'parent_offsets', 'parents')
+
+    def is_primitive(self, concept_id: int) -> bool:
+        return not self._arrays['definition_status'][self.reachability.position(concept_id)]
+
+    def full_specified_name(self, concept_id: int) -> str:
+        i = self.reachability.position(concept_id)
+        start, end = self._arrays['fsn_offsets'][i], self._arrays['fsn_offsets'][i + 1]
+        return self._arrays['fsn_blob'][start:end].tobytes().decode('utf-8')
+
+    def get_relationship_groups(self, concept_id: int) -> tuple[data_model.RelationshipGroup, ...]:
+        return self._groups_cache(concept_id)
+
+    def _read_relationship_groups(self, concept_id: int) -> tuple[data_model.RelationshipGroup, ...]:
+        arrays = self._arrays
+        i = self.reachability.position(concept_id)
+        start, end = arrays['rel_offsets'][i], arrays['rel_offsets'][i + 1]
+
+        groups: list[list[data_model.MetaRelationship]] = [[] for _ in range(int(arrays['group_counts'][i]))]
+        rows = zip(arrays['rel_group'][start:end].tolist(),
+                   arrays['rel_kind'][start:end].tolist(),
+                   arrays['rel_type'][start:end].tolist(),
+                   arrays['rel_destination'][start:end].tolist(),
+                   arrays['rel_value'][start:end].tolist())
+        for group_number, kind, type_id, destination_id, value in rows:
+            if kind == _CONCRETE:
+                groups[group_number].append(data_model.ConcreteRelationship(typeId=type_id, concreteValue=value))
+            else:
+                groups[group_number].append(data_model.Relationship(typeId=type_id, destinationId=destination_id))
+
+        # Rows were written in frozen order
+        return tuple(data_model.RelationshipGroup(tuple(group)) for group in groups)
+
+
+def load(filepath: str | pathlib.Path) -> ontology.OntologyBase:
+    """Opens either a compact or a pickled ontology cache, depending on the file contents"""
+    if is_mapped_file(filepath):
+        return MappedOntology.load(filepath)
+    return ontology.Ontology.load(filepath)
+
+
+if __name__ == '__main__':
+    # Usage: python -m core.mapped_ontology SNOMED.ont SNOMED.jont
+    convert(*sys.argv[1:3])
@@ -1,20 +1,25 @@
 # Copyright 2022 Sciforce Ukraine. All rights reserved.
 from __future__ import annotations
 
+import abc
 import os
 import pickle
 import zipfile
-from typing import Iterable
+from typing import Iterable, Iterator
 import datetime
 import functools
 import pathlib
 
 import networkx as nx
+import numpy as np
 import pandas as pd
 import requests
 
+from core import attribute_index
 from core import expression
 from core import data_model
+from core import hierarchy_index
+from utils.constants import CONCEPT_MODEL_ATTRIBUTE
 from utils.constants import DEFINED
 from utils.constants import FSN
 from utils.constants import ISA
@@ -35,8 +40,303 @@ class AccidentalEquivalency(BaseException):
     def __repr__(self):
         return f"Mapping to {self.sctid} must be done instead."
 
+class OntologyBase(data_model.OntologyInterface):
+    """Classification logic shared by all ontology storage implementations.
 
-class Ontology(nx.DiGraph, data_model.OntologyInterface):
+    Subclasses provide access to the hierarchy and concept definitions through the abstract methods;
+    everything else only relies on them and the precomputed reachability index.
+    """
+    version: dict[str, datetime.date]
+    validator: validation.mrcm.MRCMValidator
+    reachability: hierarchy_index.ReachabilityIndex
+    attribute_index: attribute_index.AttributeSignatureIndex
+    attribute_matrix: hierarchy_index.AttributeMatrix
+    primitive_parents_index: hierarchy_index.PrimitiveParentsIndex
+
+    @abc.abstractmethod
+    def successors(self, concept_id: int) -> Iterator[int]:
+        """Iterate over immediate children of the concept"""
+
+    @abc.abstractmethod
+    def predecessors(self, concept_id: int) -> Iterator[int]:
+        """Iterate over immediate parents of the concept"""
+
+    @abc.abstractmethod
+    def is_primitive(self, concept_id: int) -> bool:
+        ...
+
+    @abc.abstractmethod
+    def get_relationship_groups(self, concept_id: int) -> tuple[data_model.RelationshipGroup, ...]:
+        ...
+
+    @abc.abstractmethod
+    def full_specified_name(self, concept_id: int) -> str:
+        ...
+
+    def is_descendant(self, concept_id: int, ancestor_id: int) -> data_model.HierarchicalMatch:
+        """Look up the shortest hierarchical distance between two concepts in the precomputed reachability
+        index. Concepts absent from the hierarchy are not related to anything but themselves."""
+        distance = self.attribute_matrix.distance(concept_id, ancestor_id)
+        if distance is not None:
+            return data_model.HierarchicalMatch(distance)
+        return self.reachability.distance(concept_id, ancestor_id)
+
+    def _reset_caches(self) -> None:
+        """Creates caches of derived data anew; called whenever the indexes are built or loaded"""
+        # Kept by the instance, so that they neither outlive it nor survive re-population
+        self._ancestor_distances_cache = functools.lru_cache(maxsize=100_000)(self._read_ancestor_distances)
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state.pop('_ancestor_distances_cache', None)
+        return state
+
+    def ancestor_distances(self, concept_id: int) -> dict[int, int]:
+        """Returns shortest distances from the concept up to each of its ancestors, and 0 to itself"""
+        return self._ancestor_distances_cache(concept_id)
+
+    def _read_ancestor_distances(self, concept_id: int) -> dict[int, int]:
+        distances = self.attribute_matrix.ancestor_distances(concept_id)
+        if distances is None:
+            distances = self.reachability.ancestor_distances(concept_id)
+        return distances
+
+    def _build_attribute_matrix(self) -> hierarchy_index.AttributeMatrix:
+        return hierarchy_index.AttributeMatrix.from_reachability(self.reachability, CONCEPT_MODEL_ATTRIBUTE)
+
+    def primitive_parents(self, concept_id: int) -> set[int]:
+        # Primitive concepts serve as their own PPP
+        if self.is_primitive(concept_id):
+            return {concept_id}
+
+        return set(self.primitive_parents_index.parents_of(self.reachability.position(concept_id)).tolist())
+
+    def _build_primitive_parents_index(self) -> hierarchy_index.PrimitiveParentsIndex:
+        return hierarchy_index.PrimitiveParentsIndex.from_graph(self, self.reachability, self.is_primitive)
+
+    def remove_redundant_parents(self, concept_ids: Iterable[int]) -> set[int]:
+        """Keeps the most specific concepts: those that are not ancestors of any other given concept"""
+        concept_ids = set(concept_ids)
+        return concept_ids - self.reachability.strict_ancestor_set(concept_ids)
+
+    def remove_redundant_children(self, concept_ids: Iterable[int]) -> set[int]:
+        """Keeps the most general concepts: those that are not descendants of any other given concept"""
+        concept_ids = set(concept_ids)
+        return {concept_id for concept_id in concept_ids
+                if concept_ids.isdisjoint(self.reachability.ancestors_of(concept_id).tolist())}
+
+    def _defining_groups(self, concept_id: int) -> list[data_model.RelationshipGroup]:
+        """Returns relationship groups of the concept, the first one holding the ungroupped attributes"""
+        rel_groups = list(self.get_relationship_groups(concept_id))
+
+        # Redefine for concepts that only have one group and no ungroupped_attributes:
+        if rel_groups[0] == data_model.RelationshipGroup.freeze(list()) and len(rel_groups) == 2:
+            rel_groups.pop(0)
+
+        return rel_groups
+
+    def _build_attribute_index(self) -> attribute_index.AttributeSignatureIndex:
+        """Indexes ungroupped attributes of all fully defined concepts"""
+        defined = (sctid for sctid in self.reachability.sctids.tolist() if not self.is_primitive(sctid))
+        return attribute_index.AttributeSignatureIndex.build(
+                self.reachability,
+                ((sctid, self._defining_groups(sctid)[0].relationships) for sctid in defined))
+
+    def _validate_ancestorship(self, expr: expression.Expression,
+                               concept_id: int) -> data_model.HierarchicalMatch:
+        """Expression is considered a descendant of a given concept if:
+            - All ungroupped attributes in the concept have descendants among any attributes in the expression
+            - All concept groups are ancestors of groups in the expression
+        """
+
+        # If the concept is a parent of one of the stated parents:
+        for parent in expr.parent_concepts:
+            matched = self.is_descendant(parent, concept_id)
+            if matched:
+                return matched + 1
+
+        # Primitive concepts do not get descendants assignment,
+        if self.is_primitive(concept_id):
+            return data_model.HierarchicalMatch(-1)
+
+        # Check if all the concepts primitive parents are ancestors of at least one expression primitive parent:
+        for c_parent in self.primitive_parents(concept_id):
+            has_ancestor = any(self.is_descendant(e_parent, c_parent) for e_parent in expr.parent_concepts)
+            if not has_ancestor:
+                return data_model.HierarchicalMatch(-1)
+
+        rel_groups = self._defining_groups(concept_id)
+
+        hierarchical_distance = 0
+        ungroupped_attributes = rel_groups[0].relationships
+        unmatched_concept_attributes = set(ungroupped_attributes)
+        unmatched_expression_attributes = set(expr.relationship_groups[0].relationships)
+
+        # Traverse Expression attributes:
+        all_attrs = []
+        for group in expr.relationship_groups:
+            all_attrs.extend(group.relationships)
+
+        if ungroupped_attributes and all_attrs:
+            # Rows are expression attributes, columns are concept attributes they descend from
+            distances = np.stack([e_rel.descends_from_many(ungroupped_attributes, self) for e_rel in all_attrs])
+            for j, c_rel in enumerate(ungroupped_attributes):
+                if c_rel not in unmatched_concept_attributes:
+                    continue
+
+                i = data_model.first_descended(distances[:, j])
+                if i >= 0:
+                    hierarchical_distance += int(distances[i, j])
+                    unmatched_concept_attributes.remove(c_rel)
+                    try:
+                        unmatched_expression_attributes.remove(all_attrs[i])
+                    except KeyError:
+                        pass
+
+        if unmatched_concept_attributes:
+            return data_model.HierarchicalMatch(-1)
+
+        # Work with groupped relationships, if there are any:
+        try:
+            groups: list[data_model.RelationshipGroup] = list(rel_groups[1:])
+        except IndexError:
+            return data_model.HierarchicalMatch(hierarchical_distance)
+
+        unmatched_groups = set(groups)
+        matched_expression_groups = set()
+
+        # Traverse Expression groups:
+        for c_grp in groups:
+            for e_grp in expr.relationship_groups:  # This does include group 0
+                match = e_grp.descends_from(c_grp,
+                                            self,
+                                            addl_atrs=ungroupped_attributes,
+                                            set_to_clear=unmatched_expression_attributes)
+                if match:
+                    matched_expression_groups.add(e_grp)
+                    hierarchical_distance += match.distance
+                    unmatched_groups.remove(c_grp)
+                    break
+
+        # Check if unmatched_groups can be cleaned up by inhering from the ungroupped attributes
+        # This is, once again, approximation to avoid having to process the MRCM and will be rewritten
+        for c_grp in unmatched_groups.copy():
+            rel_count = len(c_grp.relationships)
+
+            for rel in c_grp.relationships:
+                if not ungroupped_attributes:
+                    break
+
+                first = data_model.first_descended(rel.descends_from_many(ungroupped_attributes, self))
+                if first >= 0:
+                    rel_count -= 1
+
+                    try:
+                        unmatched_expression_attributes.remove(ungroupped_attributes[first])
+                    except KeyError:
+                        pass
+            if rel_count == 0:
+                unmatched_groups.remove(c_grp)
+
+        if unmatched_groups:
+            return data_model.HierarchicalMatch(-1)
+        else:
+            # Unmatched groups & attributes add points of hierarchical distance
+            if len(expr.relationship_groups) >= 2:
+                hierarchical_distance += len(expr.relationship_groups) - len(matched_expression_groups)
+            hierarchical_distance += len(unmatched_expression_attributes)
+            return data_model.HierarchicalMatch(hierarchical_distance)
+
+    def _subsumes(self, normal_form: expression.Expression, concept_id: int) -> bool:
+        """Validates the concept as an ancestor of the expression, reporting a full equivalency if found"""
+        matches = self._validate_ancestorship(normal_form, concept_id)
+        if matches.mapped and normal_form.definition_status:
+            raise AccidentalEquivalency(concept_id)
+        return bool(matches)
+
+    def _may_subsume(self, concept_id: int, known_ancestors: set[int], admitted: np.ndarray) -> bool:
+        """Cheap necessary condition for a concept outside the known ancestors of the expression to subsume it:
+        it must be fully defined, all of its ungroupped attributes must be matched by the expression, and all of
+        its proximal primitive parents must be known ancestors"""
+        if self.is_primitive(concept_id):
+            return False
+        if not admitted[self.reachability.position(concept_id)]:
+            return False
+        return self.primitive_parents(concept_id) <= known_ancestors
+
+    def _check_concept_ancestorship(
+            self,
+            normal_form: expression.Expression,
+            node: int,
+            validated_nodes: dict[int, bool],
+            ancestors: set[int],
+            known_ancestors: set[int] | None = None,
+            admitted: np.ndarray | None = None) -> bool:
+        """Depth-first search for the most specific concepts subsuming the expression, collected in ancestors.
+        Returns True if the node itself subsumes the expression.
+
+        If known_ancestors of the expression are given, they are accepted without validation, and concepts
+        that can not possibly subsume the expression are rejected without validation. The admitted mask from the
+        attribute index must be given together with known_ancestors."""
+
+        # If the node was already reached by another path, reuse the result
+        try:
+            return validated_nodes[node]
+        except KeyError:
+            pass
+
+        if known_ancestors is None:
+            subsumes = self._subsumes(normal_form, node)
+        elif node in known_ancestors:
+            subsumes = True
+        else:
+            subsumes = self._may_subsume(node, known_ancestors, admitted) and self._subsumes(normal_form, node)
+
+        validated_nodes[node] = subsumes
+        if not subsumes:
+            return False
+
+        # The node is one of the closest ancestors if none of its children subsume the expression.
+        # All children are checked, as every subsuming branch must be explored
+        children_subsume = [
+                self._check_concept_ancestorship(
+                        normal_form, child, validated_nodes, ancestors, known_ancestors, admitted)
+                for child in self.successors(node)
+                ]
+        if not any(children_subsume):
+            ancestors.add(node)
+
+        return True
+
+    def expression_hierarchy(self, expr: expression.Expression, bottom_up: bool = True) -> set[int]:
+        """Returns the position in hierarchy of the given expression as a list of immediate parents.
+
+        In bottom-up mode, every ancestor of the proximal primitive parents of the expression is known to
+        subsume it, so the search only validates concepts hanging off this ancestor set, skipping the ones
+        whose ungroupped attributes are not matched by the expression according to the attribute index. Top-down mode validates
+        every visited concept starting from the root; both modes return the same parents."""
+        # Despite our concepts being usually Fully defined, we don't want to build descendants for them (yet)
+        ancestral_nodes = set()
+        normal_form = expr.normal_form(self)
+
+        known_ancestors, admitted = None, None
+        if bottom_up:
+            known_ancestors = self.reachability.ancestor_set(normal_form.parent_concepts)
+            attributes = [rel for group in normal_form.relationship_groups for rel in group]
+            admitted = self.attribute_index.admitted(attributes, self.reachability)
+
+        # Find all ancestors starting from the root node
+        self._check_concept_ancestorship(normal_form=normal_form, node=SNOMED_ROOT, validated_nodes=dict(),
+                                         ancestors=ancestral_nodes, known_ancestors=known_ancestors,
+                                         admitted=admitted)
+
+        # Remove redundant ancestors
+        clean_list = self.remove_redundant_parents(ancestral_nodes)
+
+        return clean_list
+
+
+class Ontology(nx.DiGraph, OntologyBase):
     concept_df: pd.DataFrame
     description_df: pd.DataFrame
     inferred_df: pd.DataFrame
@@ -45,8 +345,6 @@ class Ontology(nx.DiGraph, data_model.OntologyInterface):
     mrcm_domain_df: pd.DataFrame
     module_dependency_df: pd.DataFrame
     concept_count: int
-    version: dict[str, datetime.date]
-    validator: validation.mrcm.MRCMValidator
 
     def _drop_frames(self):
         """Frees memory by relinquishing pandas DataFrame objects"""
@@ -78,29 +376,28 @@ class Ontology(nx.DiGraph, data_model.OntologyInterface):
             loaded = pickle.load(f)
             onto_logger.info(f"Loaded {cls} object containing {len(loaded)} concept entries.")
 
-            return loaded
+            # Caches written before the reachability index was introduced need it built once
+            if not hasattr(loaded, 'reachability'):
+                onto_logger.info("Building reachability index for a legacy cache...")
+                loaded.reachability = hierarchy_index.ReachabilityIndex.from_graph(loaded)
 
-    @functools.cache
-    def is_descendant(self, concept_id: int, ancestor_id: int) -> data_model.HierarchicalMatch:
-        """Recursively look for a degree of relation between two concepts.
-        Check is performed depth first, so the shortest path is not guaranteed. However, immediate ancestors are
-        checked explicitly, so the result is always correct."""
+            if not hasattr(loaded, 'primitive_parents_index'):
+                onto_logger.info("Building primitive parents index for a legacy cache...")
+                loaded.primitive_parents_index = loaded._build_primitive_parents_index()
 
-        # Check equivalence
-        if concept_id == ancestor_id:
-            return data_model.HierarchicalMatch(0)
+            if not hasattr(loaded, 'attribute_matrix'):
+                loaded.attribute_matrix = loaded._build_attribute_matrix()
 
-        # Check if a path exists
-        if not nx.has_path(self, ancestor_id, concept_id):
-            return data_model.HierarchicalMatch(-1)
+            if not hasattr(loaded, 'attribute_index'):
+                onto_logger.info("Building attribute index for a legacy cache...")
+                loaded.attribute_index = loaded._build_attribute_index()
 
-        # Check immediate ancestorship
-        if concept_id in self.successors(ancestor_id):
-            return data_model.HierarchicalMatch(1)
+            if not hasattr(loaded.validator, '_parents_memo'):
+                loaded.validator = validation.mrcm.MRCMValidator(loaded, domain_rules=loaded.validator.domain_rules)
 
-        # Check if the concept is a descendant of the ancestor
-        path_len = len(next(nx.all_simple_paths(self, ancestor_id, concept_id)))
-        return data_model.HierarchicalMatch(path_len)
+            loaded._reset_caches()
+            expression.normal_form_cache.clear()
+            return loaded
 
     @staticmethod
     def build(rf2_path: str | pathlib.Path) -> Ontology:
@@ -173,23 +470,49 @@ class Ontology(nx.DiGraph, data_model.OntologyInterface):
 
         return snomed
 
+    @staticmethod
+    def _group_fsn(description_df: pd.DataFrame) -> dict[int, str]:
+        """Maps every concept to its first listed Fully Specified Name"""
+        fsn_df = description_df.loc[description_df["typeId"] == FSN, ["conceptId", "term"]]
+        fsn_df = fsn_df.drop_duplicates(subset="conceptId", keep="first")
+        return dict(zip(fsn_df["conceptId"].tolist(), fsn_df["term"].tolist()))
+
+    @staticmethod
+    def _group_by_source(frame: pd.DataFrame, *columns: str) -> dict[int, list[tuple]]:
+        """Groups rows of a relationship table by sourceId, preserving the row order inside each group"""
+        grouped: dict[int, list[tuple]] = dict()
+        for source_id, *values in zip(frame["sourceId"].tolist(), *(frame[c].tolist() for c in columns)):
+            grouped.setdefault(source_id, []).append(tuple(values))
+        return grouped
+
     def populate(self, dump_filename=None, isa_to_hierarchy: bool = True) -> None:
         """Populates the graph with concepts from the stored tables."""
         onto_logger.info("Populating the graph:")
 
-        for rownum, concept in self.concept_df.iterrows():
+        # Group names and relationships by their source concept in a single pass over each table
+        fsn_by_concept = self._group_fsn(self.description_df)
+        inferred_by_concept = self._group_by_source(
+                self.inferred_df, 'destinationId', 'typeId', 'relationshipGroup')
+        concrete_by_concept = self._group_by_source(
+                self.concrete_df, 'value', 'typeId', 'relationshipGroup')
+        onto_logger.info("Grouped descriptions and relationships by concept.")
+
+        concept_rows = zip(
+                self.concept_df["id"].tolist(),
+                self.concept_df["definitionStatusId"].tolist(),
+                self.concept_df["moduleId"].tolist(),
+                )
+
+        for rownum, (cid, definition_status_id, module_id) in enumerate(concept_rows):
 
-            cid = concept["id"]
             # Counter:
-            if rownum % 10000 == 0 or rownum == self.concept_count:  # type: ignore
+            if rownum % 10000 == 0 or rownum == self.concept_count:
                 onto_logger.debug(f"On row {rownum} of {self.concept_count}...")
 
-            # Get all names of the concept, extract the FSN
-            names = self.description_df[self.description_df["conceptId"] == cid][["term", "typeId"]]
-
+            # Extract the FSN
             try:
-                fsn = names.query(f"typeId == {FSN}").iloc[0, 0]
-            except IndexError:
+                fsn = fsn_by_concept[cid]
+            except KeyError:
                 onto_logger.warning(f"WARNING: No FSN found for {cid}")
                 fsn = "No FSN found"
 
@@ -197,26 +520,26 @@ class Ontology(nx.DiGraph, data_model.OntologyInterface):
             rel = dict()
 
             # Classic relationships:
-            for _, relationship in self.inferred_df[self.inferred_df["sourceId"] == cid].iterrows():
+            for destination_id, type_id, group in inferred_by_concept.get(cid, ()):
                 r = data_model.Relationship(
-                    destinationId=relationship['destinationId'],
-                    typeId=relationship['typeId']
+                    destinationId=destination_id,
+                    typeId=type_id
                     )
 
                 # If required, add the 'Is a' as a node instead of is a relationship
-                if isa_to_hierarchy and relationship.typeId == ISA:
+                if isa_to_hierarchy and type_id == ISA:
                     self.add_edge(r.destinationId, cid)
                 else:
-                    rel[relationship["relationshipGroup"]] = rel.get(relationship["relationshipGroup"], list()) + [r]
+                    rel.setdefault(group, []).append(r)
 
             # Literal relationships:
-            for _, relationship in self.concrete_df[self.concrete_df['sourceId'] == cid].iterrows():
+            for value, type_id, group in concrete_by_concept.get(cid, ()):
                 r = data_model.ConcreteRelationship(
-                    typeId=relationship['typeId'],
-                    concreteValue=float(relationship['value'][1:])
+                    typeId=type_id,
+                    concreteValue=float(value[1:])
                     )
 
-                rel[relationship["relationshipGroup"]] = rel.get(relationship["relationshipGroup"], list()) + [r]
+                rel.setdefault(group, []).append(r)
 
             # If there are no 0-group relationships, add an empty group
             if 0 not in rel:
@@ -231,18 +554,35 @@ class Ontology(nx.DiGraph, data_model.OntologyInterface):
             concept_properties = {
                 "full_specified_name": fsn,
                 "relationships": frozen_rel,
-                "definitionStatus": concept["definitionStatusId"] == DEFINED,
-                "moduleId": concept["moduleId"],
+                "definitionStatus": definition_status_id == DEFINED,
+                "moduleId": module_id,
                 }
 
             self.add_node(cid, **concept_properties)
 
         onto_logger.info(f"Nodes added!")
 
+        # Precompute transitive closure of the hierarchy
+        self.reachability = hierarchy_index.ReachabilityIndex.from_graph(self)
+        onto_logger.info(f"Reachability index built!")
+
+        self.primitive_parents_index = self._build_primitive_parents_index()
+        onto_logger.info(f"Primitive parents index built!")
+
+        self.attribute_matrix = self._build_attribute_matrix()
+        onto_logger.info(f"Attribute matrix built!")
+
+        self.attribute_index = self._build_attribute_index()
+        onto_logger.info(f"Attribute index built!")
+        self._reset_caches()
+
         # Add MRCM constraints to the ontology
         self.validator = validation.mrcm.MRCMValidator(self)
         onto_logger.info("MRCM constraints added!")
 
+        # Normal forms computed against a previous ontology are no longer valid
+        expression.normal_form_cache.clear()
+
         # If cache filename is specified, dump self to file
         if dump_filename is not None:
             self.dump(dump_filename)
@@ -254,213 +594,12 @@ class Ontology(nx.DiGraph, data_model.OntologyInterface):
     def is_primitive(self, concept_id: int) -> bool:
         return not self.nodes[concept_id]['definitionStatus']
 
-    @functools.lru_cache(maxsize=10_000)
-    def primitive_parents(self, concept_id: int) -> set[int]:
-
-        # Primitive concepts serve as their own PPP
-        if self.is_primitive(concept_id):
-            return {concept_id}
-
-        proximal_primitive_parents = set()
-        for node in self.predecessors(concept_id):
-            if self.is_primitive(node):
-                proximal_primitive_parents.add(node)
-
-            else:
-                proximal_primitive_parents.update(self.primitive_parents(node))
-
-        return proximal_primitive_parents
-
-    def remove_redundant_parents(self, concept_ids: Iterable[int]) -> set[int]:
-
-        def is_redundant(parent) -> bool:
-            for other_parent in concept_ids:
-                if other_parent == parent:
-                    continue
-
-                if self.is_descendant(other_parent, parent):
-                    return True
-
-            return False
-
-        new_parents = set(filter(lambda x: not is_redundant(x), concept_ids))
-        return new_parents
-
-    def remove_redundant_children(self, concept_ids: Iterable[int]) -> set[int]:
-
-        def is_redundant(child) -> bool:
-            for other_child in concept_ids:
-                if other_child == child:
-                    continue
-
-                if self.is_descendant(child, other_child):
-                    return True
-
-            return False
-
-        new_children = set(filter(lambda x: not is_redundant(x), concept_ids))
-        return new_children
-
-    def _validate_ancestorship(self, expr: expression.Expression,
-                               concept_id: int) -> data_model.HierarchicalMatch:
-        """Expression is considered a descendant of a given concept if:
-            - All ungroupped attributes in the concept have descendants among any attributes in the expression
-            - All concept groups are ancestors of groups in the expression
-        """
-
-        # If the concept is a parent of one of the stated parents:
-        for parent in expr.parent_concepts:
-            matched = self.is_descendant(parent, concept_id)
-            if matched:
-                return matched + 1
-
-        # Primitive concepts do not get descendants assignment,
-        if self.is_primitive(concept_id):
-            return data_model.HierarchicalMatch(-1)
-
-        # Check if all the concepts primitive parents are ancestors of at least one expression primitive parent:
-        for c_parent in self.primitive_parents(concept_id):
-            has_ancestor = any(self.is_descendant(e_parent, c_parent) for e_parent in expr.parent_concepts)
-            if not has_ancestor:
-                return data_model.HierarchicalMatch(-1)
-
-        rel_groups = list(self.nodes[concept_id]['relationships'])
-
-        # Redefine for concepts that only have one group and no ungroupped_attributes:
-        if rel_groups[0] == data_model.RelationshipGroup.freeze(list()) and len(rel_groups) == 2:
-            rel_groups.pop(0)
-
-        hierarchical_distance = 0
-        ungroupped_attributes = rel_groups[0].relationships
-        unmatched_concept_attributes = set(ungroupped_attributes)
-        unmatched_expression_attributes = set(expr.relationship_groups[0].relationships)
-
-        # Traverse Expression attributes:
-        all_attrs = []
-        for group in expr.relationship_groups:
-            all_attrs.extend(group.relationships)
-
-        for c_rel in ungroupped_attributes:
-            for e_rel in all_attrs:
-                if c_rel in unmatched_concept_attributes:
-                    match = e_rel.descends_from(c_rel, self)
-
-                    if match:
-                        hierarchical_distance += match.distance
-                        unmatched_concept_attributes.remove(c_rel)
-                        try:
-                            unmatched_expression_attributes.remove(e_rel)
-                        except KeyError:
-                            pass
-                        break
-
-        if unmatched_concept_attributes:
-            return data_model.HierarchicalMatch(-1)
-
-        # Work with groupped relationships, if there are any:
-        try:
-            groups: list[data_model.RelationshipGroup] = list(rel_groups[1:])
-        except IndexError:
-            return data_model.HierarchicalMatch(hierarchical_distance)
-
-        unmatched_groups = set(groups)
-        matched_expression_groups = set()
-
-        # Traverse Expression groups:
-        for c_grp in groups:
-            for e_grp in expr.relationship_groups:  # This does include group 0
-                match = e_grp.descends_from(c_grp,
-                                            self,
-                                            addl_atrs=ungroupped_attributes,
-                                            set_to_clear=unmatched_expression_attributes)
-                if match:
-                    matched_expression_groups.add(e_grp)
-                    hierarchical_distance += match.distance
-                    unmatched_groups.remove(c_grp)
-                    break
-
-        # Check if unmatched_groups can be cleaned up by inhering from the ungroupped attributes
-        # This is, once again, approximation to avoid having to process the MRCM and will be rewritten
-        for c_grp in unmatched_groups.copy():
-            rel_count = len(c_grp.relationships)
-
-            for rel in c_grp.relationships:
-                for u_rel in ungroupped_attributes:
-                    if rel.descends_from(u_rel, self):
-                        rel_count -= 1
-
-                        try:
-                            unmatched_expression_attributes.remove(u_rel)
-                        except KeyError:
-                            pass
-
-                        break
-            if rel_count == 0:
-                unmatched_groups.remove(c_grp)
-
-        if unmatched_groups:
-            return data_model.HierarchicalMatch(-1)
-        else:
-            # Unmatched groups & attributes add points of hierarchical distance
-            if len(expr.relationship_groups) >= 2:
-                hierarchical_distance += len(expr.relationship_groups) - len(matched_expression_groups)
-            hierarchical_distance += len(unmatched_expression_attributes)
-            return data_model.HierarchicalMatch(hierarchical_distance)
-
-    def _check_concept_ancestorship(
-            self,
-            normal_form: expression.Expression,
-            node: int,
-            visited_nodes: set[int],
-            ancestors: set[int],
-            breadcrumb: None | list[int] = None) -> None:
-        if breadcrumb is None:
-            breadcrumb = list()
-
-        # If the node was already reached by another breadcrumb trace, abort this one
-        if node in visited_nodes:
-            return
-        visited_nodes.add(node)
-
-        # If the node validates (is clean ancestor of the expression), continue to children;
-        # otherwise, write the last reached node
-        matches = self._validate_ancestorship(normal_form, node)
-        if matches.mapped and normal_form.definition_status:
-            raise AccidentalEquivalency(node)
-
-        if matches:
-
-            if self.successors(node):
-                # Pass the breadcrumb trail to all descendants:
-                breadcrumb.append(node)
-                for child in self.successors(node):
-                    self._check_concept_ancestorship(normal_form, child, visited_nodes, ancestors, breadcrumb)
-
-            else:
-                # Add current node as ancestor:
-                ancestors.add(node)
-
-        else:
-            # Add previous node as ancestor:
-            ancestors.add(breadcrumb[-1])
-
-    def expression_hierarchy(self, expr: expression.Expression) -> set[int]:
-        """Returns the position in hierarchy of the given expression as a list of immediate parents"""
-        # Despite our concepts being usually Fully defined, we don't want to build descendants for them (yet)
-        ancestral_nodes = set()
-
-        # Find all ancestors starting from the root node
-        self._check_concept_ancestorship(normal_form=expr.normal_form(self), node=SNOMED_ROOT,
-                                         visited_nodes=set(), ancestors=ancestral_nodes)
-
-        # Remove redundant ancestors
-        clean_list = self.remove_redundant_parents(ancestral_nodes)
-
-        return clean_list
-
-    def get_relationship_groups(self, concept_id: int) -> list[data_model.RelationshipGroup]:
+    def get_relationship_groups(self, concept_id: int) -> tuple[data_model.RelationshipGroup, ...]:
         return self.nodes[concept_id]['relationships']
 
+    def full_specified_name(self, concept_id: int) -> str:
+        return self.nodes[concept_id]['full_specified_name']
+
     @staticmethod
     def download_snomed_us(month: int, year: int, api_key: str, path: str | pathlib.Path) -> None:
         """Downloads the US edition of SNOMED CT from the UMLS website using the user API key"""
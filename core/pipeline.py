@@ -0,0 +1,187 @@
+# Copyright 2022 Sciforce Ukraine. All rights reserved.
+"""Ingests a mapping file in the use_cases_icd.csv layout directly into the vocabulary, without the REST server.
+
+Rows are processed as rest_client.client does it through the API: a source concept is added for every row, and its
+post-coordinated expression is ingested and mapped to it. Instead of a few requests per row, expressions are
+classified by a BatchClassifier, and inserts of `transaction_size` rows are executed at once.
+"""
+from __future__ import annotations
+
+import copy
+import pathlib
+from dataclasses import dataclass
+
+import pandas as pd
+
+from core import batch_classifier
+from core import data_model
+from core import vocab
+from utils.logger import jacka_logger
+
+pipeline_logger = jacka_logger.getChild('Pipeline')
+
+# Defaults of rest_client.client
+VOCABULARY_ID = 'SciForce'
+DOMAIN_ID = 'Condition'
+CONCEPT_CLASS_ID = 'ICD10 code'
+
+
+@dataclass
+class PipelineStats:
+    rows: int = 0
+    mapped: int = 0
+    created: int = 0
+    failed: int = 0
+
+
+class Pipeline:
+    """Ingests rows of a mapping file, deferring inserts until `transaction_size` rows are prepared.
+
+    Ingestion reads the vocabulary in two cases only, and both would miss deferred rows: when an expression
+    matches the fingerprint of a concept created by an earlier row, and when it references temporary ids of
+    earlier expressions. Deferred inserts are executed before such rows are ingested.
+    """
+
+    def __init__(self, voc: vocab.OmopVocabulary, ont: data_model.OntologyInterface,
+                 classifier: batch_classifier.BatchClassifier, transaction_size: int = 1000) -> None:
+        """
+        @param voc: Vocabulary to write to
+        @param ont: Ontology to classify expressions against
+        @param classifier: Batch classifier created for the same ontology
+        @param transaction_size: Number of rows whose inserts are executed at once
+        """
+        self.voc = voc
+        self.ont = ont
+        self.classifier = classifier
+        self.transaction_size = transaction_size
+        self.stats = PipelineStats()
+        self._pending: list[tuple[int, bool, vocab.VocabularyInsert]] = []  # Row number, whether a concept is created
+        self._pending_codes: set[str] = set()
+
+    def add_vocabulary(self, vid: str = VOCABULARY_ID) -> None:
+        self.voc.execute_inserts(self.voc.add_vocabulary(
+                vid=vid,
+                name=vid,
+                version='1.0',
+                reference='https://sciforce.solutions/industries/medtech',
+                ))
+
+    def run(self, rows: pd.DataFrame) -> PipelineStats:
+        """Ingests every row and executes all inserts. Failed rows are logged and skipped."""
+        texts = dict.fromkeys(rows['post_coordination_expression'])
+        pending = self.classifier.classify(texts)
+        classified: dict[str, batch_classifier.ClassifiedExpression] = dict()
+
+        for row_number, row in enumerate(rows.itertuples(index=False), start=1):
+            self.stats.rows += 1
+            text = row.post_coordination_expression
+            if text not in classified:
+                classified[text] = next(pending)
+            try:
+                self._ingest_row(row_number, row, classified[text])
+            except Exception as e:
+                self.stats.failed += 1
+                pipeline_logger.error(f"Row {row_number} failed: {e!r}. Skipping {row.concept_code} {row.concept_name}")
+
+            if len(self._pending) >= self.transaction_size:
+                self.flush()
+        self.flush()
+
+        pipeline_logger.info(f"Done! {self.stats}")
+        return self.stats
+
+    def _ingest_row(self, row_number: int, row, item: batch_classifier.ClassifiedExpression) -> None:
+        pipeline_logger.debug(f"Processing {row.concept_code} {row.concept_name}: {row.post_coordination_expression}")
+        if item.error is not None:
+            raise ValueError(item.error)
+
+        # Ingestion substitutes identifiers in the expression, so every row gets its own copy
+        expression = copy.deepcopy(item.expression)
+        substituted = copy.copy(expression)
+        substituted.substitute_sctids(self.voc.sctid_replacements)
+        if (substituted.relationship_groups is not expression.relationship_groups
+                or item.classification.concept_code in self._pending_codes):
+            self.flush()
+
+        # Source concepts are always created anew, so unlike the rest client there is nothing to unmap
+        concept_insert = self.voc.add_source_concept(
+                concept_code=row.concept_code,
+                vocabulary_id=row.vocabulary_id or VOCABULARY_ID,
+                concept_name=row.concept_name,
+                domain_id=DOMAIN_ID,
+                concept_class_id=CONCEPT_CLASS_ID,
+                )
+        source_id = concept_insert['concept'][0]['concept_id']
+
+        # The source concept is not written yet, so its name is given instead of being looked up
+        expression_insert = self.voc.ingest_expression(
+                expression,
+                self.ont,
+                source_id=source_id,
+                given_name=row.concept_name,
+                report_parents=False,
+                classification=item.classification,
+                )
+
+        created = 'concept' in expression_insert
+        if created:
+            new_concept = expression_insert['concept'][0]
+            self._pending_codes.add(new_concept['concept_code'])
+            self.stats.created += 1
+            pipeline_logger.info(f"Row {row_number}: new concept {new_concept['concept_id']} "
+                                 f"'{new_concept['concept_code']}' for source concept {source_id}")
+        else:
+            targets = [r['concept_id_2'] for r in expression_insert.get('concept_relationship', [])
+                       if r['relationship_id'] == 'Maps to']
+            pipeline_logger.info(f"Row {row_number}: source concept {source_id} mapped to {targets}")
+        self.stats.mapped += 1
+
+        self._pending.append((row_number, created, _merge([concept_insert, expression_insert])))
+
+    def flush(self) -> None:
+        """Executes deferred inserts in a single transaction. If it fails, rows are retried one by one,
+        so that only the failing ones are skipped."""
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, []
+        self._pending_codes.clear()
+        try:
+            self.voc.execute_inserts(_merge(insert for _, _, insert in pending))
+            return
+        except Exception as e:
+            pipeline_logger.warning(f"Transaction of {len(pending)} rows failed: {e!r}. Retrying rows one by one.")
+
+        for row_number, created, insert in pending:
+            try:
+                self.voc.execute_inserts(insert)
+            except Exception as e:
+                self.stats.mapped -= 1
+                self.stats.created -= created
+                self.stats.failed += 1
+                pipeline_logger.error(f"Row {row_number} failed: {e!r}")
+
+
+def _merge(inserts) -> vocab.VocabularyInsert:
+    # Unlike OmopVocabulary.join_inserts, does not look for duplicates, which are not expected between rows
+    out: vocab.VocabularyInsert = dict()
+    for insert in inserts:
+        for tablename, rows in insert.items():
+            out.setdefault(tablename, []).extend(rows)
+    return out
+
+
+def read_rows(filename: str | pathlib.Path) -> pd.DataFrame:
+    """Reads a mapping file in the use_cases_icd.csv layout, keeping codes as they are written"""
+    rows = pd.read_csv(filename, dtype=str, keep_default_na=False)
+    if 'vocabulary_id' not in rows:
+        rows['vocabulary_id'] = VOCABULARY_ID
+    return rows
+
+
+def run_file(filename: str | pathlib.Path, voc: vocab.OmopVocabulary, ont: data_model.OntologyInterface,
+             classifier: batch_classifier.BatchClassifier, transaction_size: int = 1000) -> PipelineStats:
+    pipeline = Pipeline(voc, ont, classifier, transaction_size=transaction_size)
+    pipeline_logger.info(f"Adding {VOCABULARY_ID} vocabulary for examples.")
+    pipeline.add_vocabulary()
+    return pipeline.run(read_rows(filename))
@@ -4,18 +4,23 @@ from __future__ import annotations
 import pandas as pd
 
 import core.expression
+from core import classification_cache
+from core import concept_mirror
 from core import data_model
-from core import ontology
 from utils.constants import ENGLISH
 from utils.constants import EXPRESSION_LANGUAGE
 from utils.constants import JACKALOPE_SPACE
 from utils.constants import MANUAL_SPACE
 from utils.constants import VALID_DOMAINS
 from utils.logger import jacka_logger
-from typing import Iterable, Any
+from typing import Callable, Iterable, Iterator, Mapping, Any
 import abc
+import contextlib
 import copy
 import datetime
+import os
+import threading
+import weakref
 
 VocabularyInsert = dict[str, list[dict[str, str | float | int | None]]]
 
@@ -23,27 +28,252 @@ VocabularyInsert = dict[str, list[dict[str, str | float | int | None]]]
 vocabulary_logger = jacka_logger.getChild('Vocabulary')
 
 
+class SctidReplacements(Mapping[int, int]):
+    """Map of temporary concept ids of ingested expressions to the concepts they were ingested as.
+
+    Dependent expressions reference nested subexpressions by their temporary ids. The map keeps only the latest
+    `limit` replacements, and replacements made inside scope() are dropped on exit, so that its size does not
+    grow over the lifetime of the server. Within scope(), the calling thread works on its own copy of the map,
+    so that concurrent requests do not see each other's temporary ids.
+    """
+    limit = 10_000
+
+    def __init__(self) -> None:
+        # Insertion order doubles as the eviction order
+        self._replacements: dict[int, int] = dict()
+        self._local = threading.local()
+        # Serializes writers only; readers rely on single lookups instead
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        return {'_replacements': self._replacements}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def _active(self) -> dict[int, int]:
+        return getattr(self._local, 'replacements', self._replacements)
+
+    def __len__(self) -> int:
+        return len(self._active)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._active)
+
+    def __contains__(self, sctid: int) -> bool:
+        return sctid in self._active
+
+    def __getitem__(self, sctid: int) -> int:
+        return self._active[sctid]
+
+    def get(self, sctid: int, default: int | None = None) -> int | None:
+        """Returns the final replacement of the SCTID, following replacements of replacements"""
+        # Other threads may add or evict replacements in between, so every key is looked up only once
+        replacements = self._active
+        replacement = replacements.get(sctid)
+        if replacement is None:
+            return default
+
+        seen = {sctid}
+        while replacement is not None and replacement not in seen:
+            sctid = replacement
+            seen.add(sctid)
+            replacement = replacements.get(sctid)
+        return sctid
+
+    def add(self, old_sctid: int, new_sctid: int) -> None:
+        replacements = self._active
+        with self._lock:
+            # Temporary ids are reused, the latest replacement wins
+            replacements.pop(old_sctid, None)
+            replacements[old_sctid] = new_sctid
+            if len(replacements) > self.limit:
+                del replacements[next(iter(replacements))]
+
+    def clear(self) -> None:
+        self._active.clear()
+
+    @contextlib.contextmanager
+    def scope(self) -> Iterator[SctidReplacements]:
+        """Discards replacements made within the block, e.g. for expressions of a single batch"""
+        saved = getattr(self._local, 'replacements', None)
+        self._local.replacements = self._active.copy()
+        try:
+            yield self
+        finally:
+            if saved is None:
+                del self._local.replacements
+            else:
+                self._local.replacements = saved
+
+
+class IdAllocator:
+    """Hands out identifiers of named sequences from blocks leased through a callback.
+
+    lease(sequence, count) must reserve count consecutive identifiers and return the first one. Identifiers of a
+    block that are not handed out before the process exits are skipped, so sequences may have gaps.
+    A forked process drops the blocks inherited from its parent and leases its own, so that the two never hand
+    out the same identifier.
+    """
+    block_size = 100
+
+    def __init__(self, lease: Callable[[str, int], int]) -> None:
+        self._lease = lease
+        self._blocks: dict[str, Iterator[int]] = dict()
+        self._lock = threading.Lock()
+        _allocators.add(self)
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        _allocators.add(self)
+
+    def _reset(self) -> None:
+        # The lock may have been held by a thread of the parent, which does not exist in the child
+        self._blocks = dict()
+        self._lock = threading.Lock()
+
+    def next(self, sequence: str) -> int:
+        with self._lock:
+            identifier = next(self._blocks.get(sequence, iter(())), None)
+            if identifier is None:
+                first = self._lease(sequence, self.block_size)
+                block = iter(range(first, first + self.block_size))
+                identifier = next(block)
+                self._blocks[sequence] = block
+            return identifier
+
+
+_allocators: weakref.WeakSet[IdAllocator] = weakref.WeakSet()
+
+
+def _reset_allocators() -> None:
+    for allocator in list(_allocators):
+        allocator._reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_allocators)
+
+
 class OmopVocabulary(abc.ABC):
     logger = vocabulary_logger
+    snomed_mirror: concept_mirror.SnomedConceptMirror | None = None
+    classification_cache: classification_cache.ClassificationCache | None = None
 
     def __init__(self, *args, **kwargs):
-        self._current_omop_code: int = self._last_omop_code()
-        self._current_manual_id: int = self._last_id_in_range(range_start=MANUAL_SPACE)
-        self._current_jackalope_id: int = self._last_id_in_range(range_start=JACKALOPE_SPACE[0],
-                                                                 range_end=JACKALOPE_SPACE[1])
-        self.sctid_replacements: list[tuple[int, int]] = []
+        self._leased_ids: dict[str, int] = dict()
+        self.id_allocator = IdAllocator(self._lease_ids)
+        self.sctid_replacements = SctidReplacements()
+
+        # Serializes changes: identifier substitution, deduplication and inserts of ingested concepts
+        self.commit_lock = threading.RLock()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state['commit_lock']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.commit_lock = threading.RLock()
+
+    def enable_snomed_mirror(self) -> None:
+        """Loads the SNOMED slice of CONCEPT in memory to serve lookups made while ingesting expressions"""
+        self.logger.info("Loading SNOMED concepts and mappings into memory...")
+        concepts, mappings = self._snomed_slice()
+        self.snomed_mirror = concept_mirror.SnomedConceptMirror(concepts, mappings, self.query_table)
+
+    def enable_classification_cache(self, path: str, ont: data_model.OntologyInterface) -> None:
+        """Persists classification results of expressions against the given ontology in a SQLite file"""
+        self.logger.info(f"Opening classification cache at {path}...")
+        self.classification_cache = classification_cache.ClassificationCache(path, ont)
+
+    def _classify(self, expression: core.expression.Expression,
+                  ont: data_model.OntologyInterface) -> classification_cache.ClassificationResult:
+        if self.classification_cache is not None and self.classification_cache.ont is ont:
+            return self.classification_cache.classify(expression)
+        return classification_cache.ClassificationResult.classify(expression, ont)
+
+    def classify_expression(self, expression: core.expression.Expression,
+                            ont: data_model.OntologyInterface) -> classification_cache.ClassificationResult | None:
+        """Classifies the expression ahead of ingest_expression, without changing the vocabulary, so that
+        it may run outside of commit_lock. Returns None for expressions referencing temporary ids of other
+        expressions: those can only be classified after substitution, when they are ingested."""
+        substituted = copy.copy(expression)
+        substituted.substitute_sctids(self.sctid_replacements)
+        if substituted.relationship_groups is not expression.relationship_groups:
+            return None
+        return self._classify(expression, ont)
+
+    def _snomed_slice(self) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """Returns all SNOMED concepts and all 'Maps to' relationships from them.
+        May be overriden by backends that can filter relationships more efficiently."""
+        concepts = self.query_table('concept', vocabulary_id=['SNOMED'])
+        mappings = self.query_table('concept_relationship', relationship_id=['Maps to'])
+        mappings = mappings[mappings['concept_id_1'].isin(concepts['concept_id'])]
+        return concepts, mappings
+
+    def _update_mirror(self, inserts_dict: VocabularyInsert) -> None:
+        """Should be called by backends after executing inserts"""
+        if self.snomed_mirror is not None:
+            self.snomed_mirror.update(inserts_dict)
+
+    def _forget_in_mirror(self, concept_id: int) -> None:
+        """Should be called by backends after changing a concept or its mappings in place"""
+        if self.snomed_mirror is not None:
+            self.snomed_mirror.forget(concept_id)
+
+    def _snomed_concepts(self, concept_codes: list[str]) -> pd.DataFrame:
+        if self.snomed_mirror is not None:
+            return self.snomed_mirror.concepts_by_code(concept_codes)
+        return self.query_table('concept', vocabulary_id=['SNOMED'], concept_code=concept_codes)
+
+    def _concepts(self, concept_ids: list[int]) -> pd.DataFrame:
+        if self.snomed_mirror is not None:
+            return self.snomed_mirror.concepts_by_id(concept_ids)
+        return self.query_table('concept', concept_id=concept_ids)
+
+    def _mapping(self, concept_id: int) -> list[int]:
+        if self.snomed_mirror is not None:
+            return self.snomed_mirror.mapping(concept_id)
+        return self.get_mapping(concept_id)
+
+    def _first_free_id(self, sequence: str) -> int:
+        """Returns the identifier following the last one of the sequence that is present in the vocabulary"""
+        if sequence == 'omop_code':
+            last = self._last_omop_code()
+            return int(last) + 1 if pd.notna(last) else 1
+        if sequence == 'manual_id':
+            return self._last_id_in_range(range_start=MANUAL_SPACE) + 1
+        if sequence == 'jackalope_id':
+            return self._last_id_in_range(range_start=JACKALOPE_SPACE[0], range_end=JACKALOPE_SPACE[1]) + 1
+        raise ValueError(f"Unknown identifier sequence: {sequence}")
+
+    def _lease_ids(self, sequence: str, count: int) -> int:
+        """Reserves count consecutive identifiers of the sequence and returns the first one.
+        Reservations are only remembered by this instance; backends that can be written by several processes
+        should override it to reserve identifiers atomically in the database."""
+        first = max(self._first_free_id(sequence), self._leased_ids.get(sequence, 0))
+        self._leased_ids[sequence] = first + count
+        return first
 
     def next_omop_code(self) -> str:
-        self._current_omop_code += 1
-        return 'OMOP' + str(self._current_omop_code)
+        return 'OMOP' + str(self.id_allocator.next('omop_code'))
 
     def next_manual_id(self) -> int:
-        self._current_manual_id += 1
-        return self._current_manual_id
+        return self.id_allocator.next('manual_id')
 
     def next_jackalope_id(self) -> int:
-        self._current_jackalope_id += 1
-        return self._current_jackalope_id
+        return self.id_allocator.next('jackalope_id')
 
     def add_source_concept(
             self,
@@ -141,8 +371,10 @@ class OmopVocabulary(abc.ABC):
             vocabulary_id: str = 'Jackalope',
             report_parents: bool = True,
             generate_ids: bool = True,
+            classification: classification_cache.ClassificationResult | None = None,
             ) -> VocabularyInsert:
-        """Prepares SNOMED expression to be ingested by writing DELTA files on disc
+        """Prepares SNOMED expression to be ingested by writing DELTA files on disc.
+        When the vocabulary is shared between threads, hold commit_lock until the inserts are executed.
         @param input_expression: data_model.Expression object to be evaluated
         @param ont: ont.Ontology to evaluate against
         @param source_id: Optional concept_id of a source concept
@@ -150,6 +382,8 @@ class OmopVocabulary(abc.ABC):
         @param vocabulary_id: Custom vocabulary_id to be assigned. Must be already present in VOCABULARY table
         @param report_parents: Flag whether to log found parents to the concole.
         @param generate_ids: Flag whether to generate new concept_ids for the new concepts
+        @param classification: Optional result of classifying the expression elsewhere, e.g. in a worker process.
+        Ignored if identifiers in the expression are substituted.
         """
 
         inserts: VocabularyInsert = dict()
@@ -159,24 +393,25 @@ class OmopVocabulary(abc.ABC):
 
         # Substitute the SCTID in the expression:
         expression = copy.copy(input_expression)
-        for old_sctid, new_sctid in self.sctid_replacements:
-            expression.substitute_sctid(old_sctid, new_sctid)
+        expression.substitute_sctids(self.sctid_replacements)
 
         # Process the expression, finding its parents and hash-fingerprinted CONCEPT_CODE
-        try:
-            expression_parents = ont.expression_hierarchy(expression)
-            if generate_ids:
-                expression_id: int = self.next_jackalope_id()
-            else:
-                expression_id: int = 0
-            expression_fingerprint = expression.hash_concept_code(ont)
-        except ontology.AccidentalEquivalency as e:
+        if classification is None or expression.relationship_groups is not input_expression.relationship_groups:
+            classification = self._classify(expression, ont)
+        if classification.equivalent_to is not None:
             # Return a mapping instead
-            target_id, = self._find_concepts(vocabulary_id=["SNOMED"], concept_code=[str(e.sctid)])
+            target_id, = self._snomed_concepts([str(classification.equivalent_to)])['concept_id'].tolist()
 
-            self.sctid_replacements.append((expression.concept_id, e.sctid))
+            self.sctid_replacements.add(expression.concept_id, classification.equivalent_to)
             return self.map_to(source_id, target_id)
 
+        expression_parents = classification.parents
+        if generate_ids:
+            expression_id: int = self.next_jackalope_id()
+        else:
+            expression_id: int = 0
+        expression_fingerprint = classification.concept_code
+
         # If the fingerprint matches an existing concept, return a mapping instead
         existing_concept = self._find_concepts(vocabulary_id=[vocabulary_id], concept_code=[expression_fingerprint])
         if existing_concept:
@@ -189,20 +424,16 @@ class OmopVocabulary(abc.ABC):
             expression_name = expression_name[:252] + '...'
 
         # Remember substituted concept_id for dependent expressions
-        self.sctid_replacements.append((expression.concept_id, expression_id))
+        self.sctid_replacements.add(expression.concept_id, expression_id)
 
         # Get a slice of CONCEPT containing parent data
-        query = {
-                'vocabulary_id': ['SNOMED'],
-                'concept_code': [str(p) for p in expression_parents]
-                }
-        parents_concepts: pd.DataFrame = self.query_table('concept', **query)
+        parents_concepts: pd.DataFrame = self._snomed_concepts([str(p) for p in expression_parents])
 
         remapped = []
         # replace non-standard parents
         for _, parent_row in parents_concepts[parents_concepts["standard_concept"].isnull()].iterrows():
-            for target in self.get_mapping(parent_row['concept_id']):
-                remapped.append(self.query_table('concept', concept_id=[target]))
+            for target in self._mapping(parent_row['concept_id']):
+                remapped.append(self._concepts([target]))
         parents_concepts = pd.concat(
                 (*remapped, parents_concepts[~parents_concepts["standard_concept"].isnull()])).drop_duplicates()
 
@@ -215,7 +446,7 @@ class OmopVocabulary(abc.ABC):
         expression_domain = VALID_DOMAINS[min(VALID_DOMAINS.index(d) for d in parents_concepts['domain_id'])]
 
         # Take first concept class: it's not as relevant
-        expression_class = parents_concepts.loc[0:0, 'concept_class_id']
+        expression_class = parents_concepts['concept_class_id'].iloc[0]
 
         # Work on the inserts:
         insert_shared: dict[str, [int | str | float | None]] = {
@@ -334,7 +565,7 @@ class OmopVocabulary(abc.ABC):
 
     def map_to(self, source_id: int, target_id: int, follow_mapping: bool = True) -> VocabularyInsert:
         if follow_mapping:
-            new_target_ids = self.get_mapping(target_id)
+            new_target_ids = self._mapping(target_id)
             # Prevent endless recursion:
             mapping_dicts = [self.map_to(source_id, new_target, follow_mapping=False) for new_target in new_target_ids]
             return self.join_inserts(*mapping_dicts)
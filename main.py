@@ -9,33 +9,29 @@ PROFILING = False
 
 
 def _main():
-    from rest_client import client
-    import subprocess
-    from time import sleep
-
-    # If filename is provided, start the server & client
+    # If filename is provided, ingest it in-process
     if len(sys.argv) > 1:
-        server = subprocess.Popen(
-                ['python3', 'rest_server/server.py', '--not-stateless'],
-                stdout=subprocess.PIPE,
-                cwd=pathlib.Path().absolute())
-        while True:
-            stdout_line = server.stdout.readline().decode('utf-8')
-            if stdout_line.startswith('SERVER ONLINE'):
-                break
-            # We use print instead of logging: it is raw Flask output
-            print(stdout_line, end='')
-        sleep(1)
+        import json
+        from core import pipeline
+        from rest_server import server
+
+        with open('config.json') as f:
+            options = json.load(f)
+        # Changes are always made in this mode
+        options['stateless'] = False
 
+        jack = server.JackalopeREST(**options)
+        jack.startup()
         try:
-            client.main(pathlib.Path(sys.argv[1]).absolute())
+            pipeline.run_file(pathlib.Path(sys.argv[1]).absolute(), jack.voc, jack.ont, jack.classifier,
+                              transaction_size=options.get('transaction_size', 1000))
         finally:
-            server.kill()
+            jack.classifier.close()
+            jack.voc.close_connection()
     else:
         # Otherwise start the server only and respond to requests
-        import rest_server.server
-        rest_server.server.main()
-
+        import rest_server.prefork
+        rest_server.prefork.main()
 
 if __name__ == '__main__':
     ROUTINE = _main
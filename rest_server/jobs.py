@@ -0,0 +1,405 @@
+# Copyright 2022 Sciforce Ukraine. All rights reserved.
+"""Asynchronous ingestion of mapping files too large for a single request.
+
+Submitted files are spooled to the jobs directory and processed by a small pool of background threads, one job
+per thread. State and results of every job are kept in files next to the input, so that any server process
+can report on a job, whichever process runs it. Each row is processed like the rest client does it: a source
+concept is added, and its expression is ingested and mapped to it.
+
+Batch work yields to interactive requests: before each row, a job waits until no interactive request is in flight.
+"""
+from __future__ import annotations
+
+import contextlib
+import copy
+import csv
+import datetime
+import io
+import json
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+from typing import IO, Iterator, TYPE_CHECKING
+
+from rest_server import request_model
+from utils.logger import jacka_logger
+
+if TYPE_CHECKING:
+    from rest_server import server
+
+jobs_logger = jacka_logger.getChild('Jobs')
+
+# Seconds between updates of the progress of a running job
+PROGRESS_INTERVAL = 1.
+# Longest a job waits for interactive requests to finish before processing its next row anyway
+MAX_YIELD = 1.
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+# Vocabulary of source concepts of rows that do not name one, as in rest_client.client
+VOCABULARY_ID = 'SciForce'
+
+REQUIRED_COLUMNS = ('concept_code', 'concept_name', 'post_coordination_expression')
+RESULT_COLUMNS = ('row', 'concept_code', 'source_concept_id', 'concept_id', 'new_concept_code',
+                  'parent_concepts', 'mapped_concepts', 'error')
+
+_JOB_ID = re.compile('[0-9a-f]{32}')
+
+
+class JobsFull(Exception):
+    """Raised when no more jobs can be queued"""
+
+
+class Interrupted(Exception):
+    """Raised in a running job when the server stops"""
+
+
+class InteractivePriority:
+    """Counts interactive requests in flight, so that batch work can wait for them"""
+
+    def __init__(self) -> None:
+        self._pending = 0
+        self._idle = threading.Condition()
+
+    @contextlib.contextmanager
+    def interactive(self) -> Iterator[None]:
+        with self._idle:
+            self._pending += 1
+        try:
+            yield
+        finally:
+            with self._idle:
+                self._pending -= 1
+                if not self._pending:
+                    self._idle.notify_all()
+
+    def yield_to_interactive(self, timeout: float = MAX_YIELD) -> None:
+        """Waits until no interactive request is in flight. The timeout keeps batch work from starving."""
+        with self._idle:
+            self._idle.wait_for(lambda: not self._pending, timeout)
+
+
+def read_rows(file: IO[str], fmt: str) -> Iterator[tuple[int, dict[str, str] | Exception]]:
+    """Yields 1-based positions of the records in a CSV or JSONL file in the use_cases_icd.csv layout,
+    with each record or the error that makes it unusable"""
+    if fmt == 'csv':
+        records = csv.DictReader(file)
+    else:
+        records = (line for line in file if line.strip())
+
+    for row, record in enumerate(records, start=1):
+        try:
+            if fmt != 'csv':
+                record = json.loads(record)
+            # The layout of the rest of the API is accepted as well
+            if 'post_coordination_expression' not in record and 'post_coordinated_expression' in record:
+                record['post_coordination_expression'] = record['post_coordinated_expression']
+            missing = [column for column in REQUIRED_COLUMNS if not record.get(column)]
+            if missing:
+                raise ValueError(f"Missing values of {', '.join(missing)}")
+        except Exception as e:
+            yield row, e
+        else:
+            yield row, record
+
+
+def _status_file(path: str, job_id: str) -> str:
+    return os.path.join(path, job_id + '.json')
+
+
+def _save(path: str, status: request_model.JobStatus) -> None:
+    # Readers in other processes must never see a partially written file
+    filename = _status_file(path, status.job_id)
+    with open(filename + '.tmp', 'w') as f:
+        f.write(status.json())
+    os.replace(filename + '.tmp', filename)
+
+
+def _fail(path: str, status: request_model.JobStatus, error: str) -> None:
+    status.status = FAILED
+    status.error = error
+    status.finished = datetime.datetime.now()
+    _save(path, status)
+
+
+def _statuses(path: str) -> Iterator[request_model.JobStatus]:
+    for filename in os.listdir(path):
+        job_id, extension = os.path.splitext(filename)
+        if extension != '.json' or not _JOB_ID.fullmatch(job_id):
+            continue
+        try:
+            yield request_model.JobStatus.parse_file(os.path.join(path, filename))
+        except (OSError, ValueError):
+            # Removed or replaced in the meantime
+            continue
+
+
+def fail_orphaned(path: str, worker: int | None = None) -> int:
+    """Fails jobs left queued or running by a server process that is gone: the given one, or any process if None.
+    Queues are kept in memory, so nothing else would ever finish them. Returns the number of failed jobs."""
+    failed = 0
+    for status in _statuses(path):
+        if status.status in (QUEUED, RUNNING) and (worker is None or status.worker == worker):
+            jobs_logger.warning(f"Job {status.job_id} was {status.status} in a stopped server process.")
+            _fail(path, status, "Server stopped before the job was finished.")
+            failed += 1
+    return failed
+
+
+def remove_expired(path: str, max_age: float) -> int:
+    """Removes all files of jobs finished more than max_age seconds ago. Returns the number of removed jobs."""
+    cutoff = datetime.datetime.now() - datetime.timedelta(seconds=max_age)
+    removed = 0
+    for status in _statuses(path):
+        if status.status not in (DONE, FAILED) or status.finished is None or status.finished > cutoff:
+            continue
+        # The status file goes last, so that a job is never left without one while its other files exist
+        for suffix in ('.' + status.format, '.ndjson', '.json.tmp', '.json'):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(path, status.job_id + suffix))
+        removed += 1
+    if removed:
+        jobs_logger.info(f"Removed {removed} expired jobs from {path}.")
+    return removed
+
+
+def results_to_csv(lines: Iterator[str]) -> Iterator[str]:
+    """Converts NDJSON lines of JobResult objects to CSV rows, lists of concepts joined with spaces"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush() -> str:
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+
+    writer.writerow(RESULT_COLUMNS)
+    yield flush()
+    for line in lines:
+        result = request_model.JobResult.parse_raw(line)
+        mapping = result.result or request_model.AddPCEResponse.from_inserts({})
+        writer.writerow([result.row, result.concept_code, result.source_concept_id, mapping.concept_id,
+                         mapping.concept_code, ' '.join(map(str, mapping.parent_concepts or [])),
+                         ' '.join(map(str, mapping.mapped_concepts or [])), result.error])
+        yield flush()
+
+
+class JobManager:
+    """Queues submitted jobs and runs them in background threads of the current process"""
+
+    def __init__(self, jack: server.JackalopeREST, path: str, workers: int = 1, max_queued: int = 16,
+                 retention: float | None = None) -> None:
+        """
+        @param jack: Server whose vocabulary, ontology and classifier are used
+        @param path: Directory to keep inputs, state and results of jobs in; shared by all server processes
+        @param workers: Number of jobs run at once by this process
+        @param max_queued: Number of jobs waiting to run in this process above which submissions are refused
+        @param retention: Seconds after which files of finished jobs are removed; None keeps them
+        """
+        self.jack = jack
+        self.path = path
+        self.workers = workers
+        self.retention = retention
+        self.priority = InteractivePriority()
+        self._queue: queue.Queue[str] = queue.Queue(max_queued)
+        self._threads: list[threading.Thread] = []
+        self._closing = threading.Event()
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    @property
+    def busy(self) -> bool:
+        # Jobs are only done with once they are finished, so there is no gap between leaving the queue and running
+        return self._queue.unfinished_tasks > 0
+
+    def drain(self, stop: threading.Event) -> None:
+        """Waits until the queued and running jobs are finished, or until stop is set"""
+        while self.busy and not stop.wait(PROGRESS_INTERVAL):
+            pass
+
+    def _file(self, job_id: str, suffix: str) -> str:
+        return os.path.join(self.path, job_id + suffix)
+
+    def results_file(self, job_id: str) -> str:
+        return self._file(job_id, '.ndjson')
+
+    def submit(self, stream: IO[bytes], fmt: str) -> request_model.JobStatus:
+        """Spools the submitted file to disk and queues it to be processed
+        @raise JobsFull: if the queue of this process is full
+        """
+        if self._queue.full():
+            raise JobsFull(f"{self._queue.maxsize} jobs are already queued, try again later.")
+        if self.retention is not None:
+            remove_expired(self.path, self.retention)
+
+        job_id = uuid.uuid4().hex
+        with open(self._file(job_id, '.' + fmt), 'wb') as f:
+            while chunk := stream.read(1 << 16):
+                f.write(chunk)
+        status = request_model.JobStatus(job_id=job_id, format=fmt, status=QUEUED, submitted=datetime.datetime.now(),
+                                         worker=os.getpid())
+        self._save(status)
+
+        try:
+            self._queue.put_nowait(job_id)
+        except queue.Full:
+            self._fail(status, "Too many jobs queued.")
+            raise JobsFull(f"{self._queue.maxsize} jobs are already queued, try again later.")
+        self._start_workers()
+        jobs_logger.info(f"Queued job {job_id}.")
+        return status
+
+    def status(self, job_id: str) -> request_model.JobStatus | None:
+        if not _JOB_ID.fullmatch(job_id):
+            return None
+        try:
+            return request_model.JobStatus.parse_file(_status_file(self.path, job_id))
+        except FileNotFoundError:
+            return None
+
+    def close(self) -> None:
+        """Stops the running jobs after the row in hand and fails the queued ones"""
+        self._closing.set()
+        for thread in self._threads:
+            # Wakes up idle workers
+            with contextlib.suppress(queue.Full):
+                self._queue.put_nowait('')
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+        while not self._queue.empty():
+            status = self.status(self._queue.get_nowait())
+            if status is not None:
+                self._fail(status, "Server stopped before the job was started.")
+            self._queue.task_done()
+
+    def _save(self, status: request_model.JobStatus) -> None:
+        _save(self.path, status)
+
+    def _fail(self, status: request_model.JobStatus, error: str) -> None:
+        _fail(self.path, status, error)
+
+    def _start_workers(self) -> None:
+        # Threads are started on demand, so that nothing runs in a server process before it forks
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name=f'JobWorker-{len(self._threads)}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self) -> None:
+        while not self._closing.is_set():
+            try:
+                job_id = self._queue.get(timeout=PROGRESS_INTERVAL)
+            except queue.Empty:
+                continue
+
+            try:
+                self._process(job_id)
+            finally:
+                self._queue.task_done()
+
+    def _process(self, job_id: str) -> None:
+        status = self.status(job_id)
+        if status is None:
+            return
+        try:
+            self._run(status)
+        except Interrupted:
+            jobs_logger.warning(f"Job {job_id} interrupted.")
+            self._fail(status, "Server stopped before the job was finished.")
+        except Exception as e:
+            jobs_logger.exception(f"Job {job_id} failed.")
+            self._fail(status, str(e) or repr(e))
+
+    def _run(self, status: request_model.JobStatus) -> None:
+        jack = self.jack
+        jobs_logger.info(f"Running job {status.job_id}.")
+        status.status = RUNNING
+        with open(self._file(status.job_id, '.' + status.format), newline='', encoding='utf-8') as f:
+            rows = list(read_rows(f, status.format))
+        status.total = len(rows)
+        status.parsed = sum(not isinstance(data, Exception) for _, data in rows)
+        self._save(status)
+
+        # Like the rest client does for a file, the default vocabulary of source concepts is registered, unless it
+        # is already. Registering it again would orphan the concept of the vocabulary registered before.
+        with jack.voc.commit_lock:
+            if jack.voc.query_table('vocabulary', vocabulary_id=[VOCABULARY_ID]).empty:
+                jack.voc.execute_inserts(jack.voc.add_vocabulary(
+                        vid=VOCABULARY_ID,
+                        name=VOCABULARY_ID,
+                        version='1.0',
+                        reference='https://sciforce.solutions/industries/medtech',
+                        ))
+
+        # Results come in the order of first occurrence, which is the order they are needed in
+        texts = dict.fromkeys(data['post_coordination_expression'] for _, data in rows if isinstance(data, dict))
+        pending = jack.classifier.classify(texts)
+        classified = dict()
+
+        published = time.monotonic()
+        # Temporary ids of nested subexpressions are only meaningful within the job, and are private to its thread
+        with jack.voc.sctid_replacements.scope(), open(self.results_file(status.job_id), 'w') as out:
+            for row, data in rows:
+                if self._closing.is_set():
+                    raise Interrupted()
+                self.priority.yield_to_interactive()
+
+                result = request_model.JobResult(row=row)
+                try:
+                    if isinstance(data, Exception):
+                        raise data
+                    result.concept_code = data['concept_code']
+
+                    text = data['post_coordination_expression']
+                    if text not in classified:
+                        classified[text] = next(pending)
+                    item = classified[text]
+                    if item.error is not None:
+                        raise ValueError(item.error)
+                    status.classified += 1
+
+                    with jack.voc.commit_lock:
+                        # Source concepts are always created anew, so unlike the rest client there is nothing to unmap
+                        concept_insert = jack.voc.add_source_concept(
+                                concept_code=data['concept_code'],
+                                vocabulary_id=data.get('vocabulary_id') or VOCABULARY_ID,
+                                concept_name=data['concept_name'],
+                                domain_id=data.get('domain_id') or 'Condition',
+                                concept_class_id=data.get('concept_class_id') or 'ICD10 code',
+                                )
+                        jack.voc.execute_inserts(concept_insert)
+                        result.source_concept_id = concept_insert['concept'][0]['concept_id']
+
+                        # Ingestion substitutes identifiers in the expression, so every row gets its own copy
+                        expression_insert = jack.voc.ingest_expression(
+                                copy.deepcopy(item.expression),
+                                jack.ont,
+                                source_id=result.source_concept_id,
+                                report_parents=False,
+                                classification=item.classification,
+                                )
+                        jack.voc.execute_inserts(expression_insert)
+                    result.result = request_model.AddPCEResponse.from_inserts(expression_insert)
+                    status.mapped += 1
+
+                except Exception as e:
+                    # A failed row must not abort the rest of the job
+                    status.failed += 1
+                    result.error = str(e) or repr(e)
+
+                out.write(result.json() + '\n')
+                if time.monotonic() - published > PROGRESS_INTERVAL:
+                    out.flush()
+                    self._save(status)
+                    published = time.monotonic()
+
+        status.status = DONE
+        status.finished = datetime.datetime.now()
+        self._save(status)
+        jobs_logger.info(f"Job {status.job_id} done: {status.mapped} of {status.total} rows mapped.")
@@ -0,0 +1,252 @@
+# Copyright 2022 Sciforce Ukraine. All rights reserved.
+"""Production entry point: loads the ontology once and serves requests from forked worker processes.
+
+The master process loads the ontology, prepares the vocabulary and binds the listening socket, then releases
+its connections and forks the workers. Workers share the ontology with the master copy-on-write (or through
+the page cache for memory-mapped ontologies) and accept connections from the shared socket.
+The master only supervises: it replaces workers that exit, whether they crashed or were recycled after
+serving `max_requests` requests, and reports readiness once all of them are accepting connections.
+If workers keep crashing right after they are started, the master stops the server and exits with an error.
+
+Signals to the master: SIGTERM or SIGINT stop the server, SIGHUP gracefully recycles all workers.
+Recycled workers stop accepting connections but finish their batch jobs before exiting, however long they take;
+stopping workers are given `GRACEFUL_TIMEOUT` seconds, and their jobs are interrupted.
+"""
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import os
+import select
+import signal
+import socket
+import threading
+import time
+
+from werkzeug import serving
+
+from rest_server import jobs
+from rest_server import server
+from utils.logger import jacka_logger
+
+prefork_logger = jacka_logger.getChild('Prefork')
+
+# Seconds a stopping worker is given to finish requests in flight before it is killed. Recycled workers are not.
+GRACEFUL_TIMEOUT = 30
+# Workers that crash within this many seconds of being started count as failing to start
+STARTUP_FAILURE_WINDOW = 10.
+# Number of workers in a row failing to start after which the server is stopped
+MAX_STARTUP_FAILURES = 5
+
+
+class WorkersFailing(Exception):
+    """Raised in the master when workers keep crashing on start-up"""
+
+
+class PreforkServer:
+    """Supervises worker processes serving the REST API from a socket bound by the master"""
+
+    def __init__(self, jack: server.JackalopeREST) -> None:
+        self.jack = jack
+        self.workers: dict[int, int] = dict()  # Process id -> generation it was started in
+        self._started: dict[int, float] = dict()  # Process id -> time it was started at
+        self._startup_failures = 0
+        self._generation = 0
+        self._running = False
+        self._ready = False
+        self._ready_workers = 0
+        self._socket: socket.socket | None = None
+        self._ready_pipe: tuple[int, int] | None = None
+
+    def run(self) -> None:
+        jack = self.jack
+        if jack.workers > 1 and jack.backend == 'csv' and not jack.stateless:
+            raise ValueError("CSV backend keeps changes in memory of a single process. Use one worker or SQL backend.")
+
+        jack.startup()
+
+        self._socket = socket.create_server((jack.host, jack.port), backlog=128)
+        self._socket.set_inheritable(True)
+        self._ready_pipe = os.pipe()
+
+        # Nothing holding threads, processes or connections may be inherited by the workers
+        jack.detach()
+
+        self._running = True
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._recycle)
+
+        prefork_logger.info(f"Forking {jack.workers} workers serving http://{jack.host}:{jack.port}.")
+        try:
+            for _ in range(jack.workers):
+                self._spawn()
+            while self._running:
+                self._supervise()
+        finally:
+            self._shutdown()
+
+    def _spawn(self) -> None:
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self._serve()
+                status = 0
+            except BaseException:
+                prefork_logger.exception("Worker failed.")
+            finally:
+                # Never return into the supervision loop of the master
+                os._exit(status)
+
+        self.workers[pid] = self._generation
+        self._started[pid] = time.monotonic()
+
+    def _supervise(self) -> None:
+        readable, _, _ = select.select([self._ready_pipe[0]], [], [], 1.)
+        if readable:
+            self._ready_workers += len(os.read(self._ready_pipe[0], 64))
+            if not self._ready and self._ready_workers >= self.jack.workers:
+                self._ready = True
+                server.signal_ready(self.jack.ready_file)
+
+        # Replace workers that have exited
+        while self.workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            generation = self.workers.pop(pid, None)
+            started = self._started.pop(pid, None)
+            if generation is None:
+                continue
+            # Jobs are queued in memory of the worker that accepted them, so nothing else would finish them
+            jobs.fail_orphaned(self.jack.jobs_path, worker=pid)
+            if not self._running:
+                continue
+
+            # Workers exit cleanly when recycled; any other exit of a current worker is a failure
+            recycled = generation != self._generation or os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+            if recycled or time.monotonic() - started > STARTUP_FAILURE_WINDOW:
+                self._startup_failures = 0
+            else:
+                self._startup_failures += 1
+                if self._startup_failures >= MAX_STARTUP_FAILURES:
+                    raise WorkersFailing(f"{self._startup_failures} workers in a row failed to start, giving up.")
+            if not recycled:
+                prefork_logger.warning(f"Worker {pid} exited unexpectedly with status {status}, replacing it.")
+            self._spawn()
+
+    def _stop(self, *_) -> None:
+        self._running = False
+
+    def _recycle(self, *_) -> None:
+        prefork_logger.info("Recycling all workers.")
+        self._generation += 1
+        for pid in self.workers:
+            os.kill(pid, signal.SIGHUP)
+
+    def _shutdown(self) -> None:
+        prefork_logger.info("Stopping workers.")
+        server.clear_ready(self.jack.ready_file)
+        for pid in self.workers:
+            os.kill(pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + GRACEFUL_TIMEOUT
+        while self.workers and time.monotonic() < deadline:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                time.sleep(.1)
+            else:
+                self.workers.pop(pid, None)
+
+        for pid in self.workers:
+            prefork_logger.warning(f"Killing worker {pid} that did not stop in time.")
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.workers.clear()
+        self._started.clear()
+        jobs.fail_orphaned(self.jack.jobs_path)
+
+        if self._socket is not None:
+            self._socket.close()
+        prefork_logger.info("Goodbye.")
+
+    def _serve(self) -> None:
+        """Runs in the forked worker"""
+        jack = self.jack
+        os.close(self._ready_pipe[0])
+
+        wsgi_server: serving.BaseWSGIServer | None = None
+        served = itertools.count(1)
+
+        stopping = threading.Event()
+        # Set when the worker is stopped rather than recycled, and its jobs must not be waited for
+        terminated = threading.Event()
+
+        def stop() -> None:
+            stopping.set()
+            if wsgi_server is not None:
+                # Shutting down waits for the serving loop, so it must not be called from the thread running it
+                threading.Thread(target=wsgi_server.shutdown, daemon=True).start()
+
+        def terminate() -> None:
+            terminated.set()
+            stop()
+
+        def application(environ, start_response):
+            # Recycling is put off while the worker runs batch jobs, which it would wait for without serving requests
+            if next(served) >= jack.max_requests > 0 and not jack.jobs.busy and not stopping.is_set():
+                prefork_logger.info(f"Worker {os.getpid()} served {jack.max_requests} requests, recycling.")
+                stop()
+            return server.app(environ, start_response)
+
+        # Replaces the handlers inherited from the master
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # Interrupts are handled by the master
+        signal.signal(signal.SIGHUP, lambda *_: stop())
+        signal.signal(signal.SIGTERM, lambda *_: terminate())
+
+        jack.attach()
+        wsgi_server = serving.make_server(jack.host, jack.port, application, threaded=True,
+                                          fd=self._socket.fileno())
+        # Requests in flight are completed before the worker exits
+        wsgi_server.daemon_threads = False
+        wsgi_server.block_on_close = True
+        if stopping.is_set():
+            # Signalled before the server existed; shutting down ahead of serving makes it return at once
+            stop()
+
+        os.write(self._ready_pipe[1], b'.')
+        os.close(self._ready_pipe[1])
+        try:
+            wsgi_server.serve_forever()
+        finally:
+            wsgi_server.server_close()
+            if jack.jobs.busy and not terminated.is_set():
+                prefork_logger.info(f"Worker {os.getpid()} finishing its jobs before exiting.")
+                jack.jobs.drain(terminated)
+            jack.detach()
+
+
+def serve(**kwargs) -> None:
+    PreforkServer(server.JackalopeREST(**kwargs)).run()
+
+
+def main() -> None:
+    with open('config.json') as f:
+        options = json.load(f)
+
+    parser = argparse.ArgumentParser(description="Serve the Jackalope REST API from pre-forked worker processes.")
+    parser.add_argument('--not-stateless', action='store_true', help="Make changes to the vocabulary")
+    parser.add_argument('--ready-file', help="Path of the file to create once the server accepts requests")
+    args = parser.parse_args()
+    if args.not_stateless:
+        options['stateless'] = False
+    if args.ready_file is not None:
+        options['ready_file'] = args.ready_file
+
+    serve(**options)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
 # Copyright 2022 Sciforce Ukraine. All rights reserved.
-from typing import Optional
+from typing import Literal, Optional
 from pydantic import BaseModel
 import datetime
 
@@ -38,6 +38,7 @@ class AddSourceConceptRequest(BaseModel):
 class AddPCERequest(BaseModel):
     post_coordinated_expression: str
     source_id: int
+    given_name: Optional[str] = None
 
 
 class ConceptId(BaseModel):
@@ -50,6 +51,69 @@ class AddPCEResponse(BaseModel):
     parent_concepts: Optional[list[int]]
     mapped_concepts: Optional[list[int]]
 
+    @classmethod
+    def from_inserts(cls, expression_insert: dict[str, list[dict]]) -> 'AddPCEResponse':
+        """Summarizes executed inserts of an ingested expression"""
+        response = {
+                'concept_id': None,
+                'concept_code': None,
+                'parent_concepts': None,
+                'mapped_concepts': None,
+            }
+        if 'concept' in expression_insert:
+            response['concept_id'] = expression_insert['concept'][0]['concept_id']
+            response['concept_code'] = expression_insert['concept'][0]['concept_code']
+
+        # Add references to found parent or mapped concepts
+        if 'concept_relationship' in expression_insert:
+            response['parent_concepts'] = []
+            response['mapped_concepts'] = []
+            for cr in expression_insert['concept_relationship']:
+                if cr['relationship_id'] == 'Maps to':
+                    response['mapped_concepts'].append(cr['concept_id_2'])
+                elif cr['relationship_id'] == 'Is a':
+                    response['parent_concepts'].append(cr['concept_id_2'])
+        return cls(**response)
+
+
+class AddPCEBatchResult(BaseModel):
+    line: int
+    error: Optional[str] = None
+    result: Optional[AddPCEResponse] = None
+    inserts: Optional[dict[str, list[dict[str, str | int | float | datetime.date | None]]]] = None
+
+
+class SubmitJobRequest(BaseModel):
+    format: Literal['csv', 'jsonl'] = 'csv'
+
+
+class JobResultsRequest(BaseModel):
+    format: Literal['ndjson', 'csv'] = 'ndjson'
+
+
+class JobStatus(BaseModel):
+    job_id: str
+    format: str
+    status: str
+    submitted: datetime.datetime
+    finished: Optional[datetime.datetime] = None
+    total: Optional[int] = None
+    parsed: int = 0
+    classified: int = 0
+    mapped: int = 0
+    failed: int = 0
+    error: Optional[str] = None
+    # Process id of the server process that runs the job
+    worker: Optional[int] = None
+
+
+class JobResult(BaseModel):
+    row: int
+    concept_code: Optional[str] = None
+    source_concept_id: Optional[int] = None
+    error: Optional[str] = None
+    result: Optional[AddPCEResponse] = None
+
 
 class BoolResponse(BaseModel):
     changes_made: bool
@@ -1,19 +1,30 @@
 # Copyright 2022 Sciforce Ukraine. All rights reserved.
 from __future__ import annotations
 
+import contextlib
+import copy
 import datetime
 import json
+import os
+import socket
 import sys
 from datetime import datetime
+from typing import Iterator
 
 from flask import Flask
+from flask import Response
 from flask import jsonify
 from flask import request
+from flask import send_file
 from flask_pydantic import validate
 
+from core import batch_classifier
+from core import expression
 from core import expression_process
+from core import mapped_ontology
 from core import ontology
 from core import vocab
+from rest_server import jobs
 from rest_server import request_model
 from utils.constants import HASH_COMPATIBILITY_VERSION
 from utils.constants import JACKALOPE_HOST
@@ -35,7 +46,7 @@ class JackalopeREST:
     instance: JackalopeREST | None = None
     ont_version: datetime.date
     voc_version: datetime.date
-    ont: ontology.Ontology
+    ont: ontology.OntologyBase
     voc: vocab.OmopVocabulary
 
     def __new__(cls, **kwargs):
@@ -55,18 +66,41 @@ class JackalopeREST:
         self.snomed_path: str = kwargs.get('snomed_path', None)
         self.vocabs_path: str = kwargs.get('vocabs_path', None)
         self.pickled_ont_path: str = kwargs.get('pickle_ont', None)
+        self.mapped_ont_path: str = kwargs.get('mapped_ont', None)
         self.host: str = kwargs.get('host', JACKALOPE_HOST)
         self.port: int = kwargs.get('port', JACKALOPORT)
         self.sql_connection_options: str = kwargs.get('connection_properties', None)
         self.stateless: bool = kwargs.get('stateless', False)
+        self.snomed_mirror: bool = kwargs.get('snomed_mirror', False)
+        self.parser: str = kwargs.get('parser', 'fast')
+        self.classification_cache_path: str | None = kwargs.get('classification_cache', None)
+        self.classification_workers: int | None = kwargs.get('classification_workers', 0)
+        self.workers: int = kwargs.get('workers', 1)
+        self.max_requests: int = kwargs.get('max_requests', 0)
+        self.ready_file: str | None = kwargs.get('ready_file', None)
+        # Shared by all server processes, and kept across restarts so that finished jobs can still be downloaded
+        self.jobs_path: str = kwargs.get('jobs_path', None) or 'jobs'
+        self.job_workers: int = kwargs.get('job_workers', 1)
+        self.max_queued_jobs: int = kwargs.get('max_queued_jobs', 16)
+        retention_days: float | None = kwargs.get('job_retention_days', 7)
+        self.job_retention: float | None = None if retention_days is None else retention_days * 24 * 3600
 
     def startup(self):
         server_logger.info(f"Starting up Jackalope REST server version {JACKALOPE_VERSION}.")
 
         self._load_ontology()
 
+        # Fork before connecting the backend, so that workers do not inherit its connections
+        self.classifier = batch_classifier.BatchClassifier(self.ont, processes=self.classification_workers,
+                                                           parser=self.parser,
+                                                           cache_path=self.classification_cache_path)
+
         server_logger.info(f"Connecting to {self.backend.upper()} backend.")
         self._connect_backend()
+        if self.snomed_mirror:
+            self.voc.enable_snomed_mirror()
+        if self.classification_cache_path is not None:
+            self.voc.enable_classification_cache(self.classification_cache_path, self.ont)
         server_logger.info("Done.")
 
         server_logger.info("Checking SNOMED US versions in both databases.")
@@ -79,10 +113,37 @@ class JackalopeREST:
                 concept_id=self.voc.next_jackalope_id()
                 ))
 
-        sys.stdout.write("SERVER ONLINE")
+        self.jobs = self._job_manager()
+        # No process runs jobs yet, so any left queued or running were abandoned by a previous run
+        jobs.fail_orphaned(self.jobs_path)
+        if self.job_retention is not None:
+            jobs.remove_expired(self.jobs_path, self.job_retention)
+
         server_logger.info("Jackalope is running. Make sure to wear stovepipes.")
         server_logger.info(f"API is available at http://{JACKALOPE_HOST}:{JACKALOPORT}/jackalope/v1.0/")
 
+    def detach(self) -> None:
+        """Releases worker processes and connections, which can not be shared with forked processes"""
+        self.jobs.close()
+        self.classifier.close()
+        if self.voc.classification_cache is not None:
+            self.voc.classification_cache.close()
+        self.voc.close_connection()
+
+    def attach(self) -> None:
+        """Recreates resources released by detach() in a forked process. Requests are already served by several
+        processes, so expressions are classified in each of them instead of a pool of their own.
+        Backend connections are opened again on first use."""
+        self.classifier = batch_classifier.BatchClassifier(self.ont, processes=0, parser=self.parser,
+                                                           cache_path=self.classification_cache_path)
+        if self.classification_cache_path is not None:
+            self.voc.enable_classification_cache(self.classification_cache_path, self.ont)
+        self.jobs = self._job_manager()
+
+    def _job_manager(self) -> jobs.JobManager:
+        return jobs.JobManager(self, self.jobs_path, workers=self.job_workers, max_queued=self.max_queued_jobs,
+                               retention=self.job_retention)
+
     def compare_versions(self):
         server_logger.info("Checking SNOMED US versions in both databases.")
         self.ont_version = self.ont.version["SNOMED CT US"]
@@ -110,6 +171,24 @@ class JackalopeREST:
             raise ValueError(f"{self.backend} is not a known backend option.")
 
     def _load_ontology(self):
+        if self.mapped_ont_path is not None:
+            server_logger.info("Mapping compact SNOMED Ontology.")
+            try:
+                self.ont = mapped_ontology.MappedOntology.load(self.mapped_ont_path)
+                return
+            except FileNotFoundError:
+                server_logger.warning("Specified compact ontology file not found! It will be created.")
+            except mapped_ontology.FormatVersionError:
+                server_logger.warning("Specified compact ontology file is outdated! It will be recreated.")
+
+        self._load_pickled_ontology()
+
+        # Convert to the compact format, so that next startups can map it instead
+        if self.mapped_ont_path is not None:
+            mapped_ontology.write(self.ont, self.mapped_ont_path)
+            self.ont = mapped_ontology.MappedOntology.load(self.mapped_ont_path)
+
+    def _load_pickled_ontology(self):
         if self.pickled_ont_path is not None:
             server_logger.debug("Pickle file provided. Loading from pickle. Ignoring SNOMED path.")
             server_logger.info("Unpickling saved SNOMED Ontology.")
@@ -130,6 +209,30 @@ class JackalopeREST:
         server_logger.info("Done.")
 
 
+def signal_ready(ready_file: str | None) -> None:
+    """Reports that the server accepts requests: creates the ready file, if any, containing the process id,
+    and notifies systemd when run as a service of Type=notify"""
+    if ready_file is not None:
+        # Readers must never see a partially written file
+        with open(ready_file + '.tmp', 'w') as f:
+            f.write(str(os.getpid()))
+        os.replace(ready_file + '.tmp', ready_file)
+
+    address = os.environ.get('NOTIFY_SOCKET')
+    if address:
+        if address.startswith('@'):
+            address = '\0' + address[1:]
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify:
+            notify.connect(address)
+            notify.sendall(b'READY=1')
+
+
+def clear_ready(ready_file: str | None) -> None:
+    if ready_file is not None:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(ready_file)
+
+
 @app.route('/jackalope/v1.0/get/version', methods=['GET'])
 @validate()
 def version():
@@ -158,19 +261,22 @@ def concept_info():
 def add_vocab():
     if request.method == 'POST':
         data = request.get_json()
-        vocab_inserts = _get_instance().voc.add_vocabulary(
-                vid=data['vocabulary_id'],
-                name=data['vocabulary_name'],
-                reference=data['vocabulary_reference'],
-                version=data['vocabulary_version'],
-                generate_id=not _get_instance().stateless,
-            )
+        with _get_instance().voc.commit_lock:
+            vocab_inserts = _get_instance().voc.add_vocabulary(
+                    vid=data['vocabulary_id'],
+                    name=data['vocabulary_name'],
+                    reference=data['vocabulary_reference'],
+                    version=data['vocabulary_version'],
+                    generate_id=not _get_instance().stateless,
+                )
+            if not _get_instance().stateless:
+                _get_instance().voc.execute_inserts(vocab_inserts)
+
         if _get_instance().stateless:
             return request_model.OMOPTableInserts(
                     inserts=vocab_inserts
                 )
         else:
-            _get_instance().voc.execute_inserts(vocab_inserts)
             return jsonify({})
 
 
@@ -179,24 +285,32 @@ def add_vocab():
 def add_source_concept():
     if request.method == 'POST':
         data = request.get_json()
-        concept_insert = _get_instance().voc.add_source_concept(
-                concept_code=data['concept_code'],
-                concept_name=data['concept_name'],
-                vocabulary_id=data['vocabulary_id'],
-                concept_class_id=data['concept_class_id'],
-                domain_id=data['domain_id'],
-                synonyms=data.get('synonyms', None),
-                generate_id=not _get_instance().stateless
-            )
+        with _get_instance().jobs.priority.interactive(), _get_instance().voc.commit_lock:
+            concept_insert = _get_instance().voc.add_source_concept(
+                    concept_code=data['concept_code'],
+                    concept_name=data['concept_name'],
+                    vocabulary_id=data['vocabulary_id'],
+                    concept_class_id=data['concept_class_id'],
+                    domain_id=data['domain_id'],
+                    synonyms=data.get('synonyms', None),
+                    generate_id=not _get_instance().stateless
+                )
+            if not _get_instance().stateless:
+                _get_instance().voc.execute_inserts(concept_insert)
+
         if _get_instance().stateless:
             return request_model.OMOPTableInserts(
                     inserts=concept_insert
                 )
         else:
-            _get_instance().voc.execute_inserts(concept_insert)
             return request_model.ConceptId(concept_id=concept_insert['concept'][0]['concept_id'])
 
 
+def _parse_expression(text: str) -> expression.Expression:
+    """Deserializes a post-coordinated expression, reusing recent parses of the same text"""
+    return expression_process.parse(text, expression_process.PROCESSORS[_get_instance().parser])[0]
+
+
 @app.route('/jackalope/v1.0/add/pce', methods=['POST'])
 @validate(body=request_model.AddPCERequest)
 def add_post_coordinated_expression():
@@ -205,47 +319,153 @@ def add_post_coordinated_expression():
 
         # Deserialize the expression
         try:
-            pce_processor = expression_process.Processor()
-            pce = pce_processor.process(data['post_coordinated_expression'])[0]
+            pce = _parse_expression(data['post_coordinated_expression'])
         except expression_process.SNOMEDExpressionsError as e:
             # Return a 400 error if the expression is invalid
             return jsonify({'error': str(e)}), 400
 
-        expression_insert = _get_instance().voc.ingest_expression(
-                pce,
-                _get_instance().ont,
-                source_id=data['source_id'],
-                given_name=data.get('given_name', None),
-                generate_ids=not _get_instance().stateless
-                )
+        # Batch jobs wait while the request is in flight
+        with _get_instance().jobs.priority.interactive():
+            # Classification only reads the ontology, so requests do it in parallel; only the commit is serialized
+            classification = _get_instance().voc.classify_expression(pce, _get_instance().ont)
+
+            with _get_instance().voc.commit_lock:
+                expression_insert = _get_instance().voc.ingest_expression(
+                        pce,
+                        _get_instance().ont,
+                        source_id=data['source_id'],
+                        given_name=data.get('given_name', None),
+                        generate_ids=not _get_instance().stateless,
+                        classification=classification,
+                        )
+                if not _get_instance().stateless:
+                    _get_instance().voc.execute_inserts(expression_insert)
 
         if _get_instance().stateless:
             return request_model.OMOPTableInserts(
                     inserts=expression_insert
                 )
 
-        _get_instance().voc.execute_inserts(expression_insert)
-
-        response = {
-                'concept_id': None,
-                'concept_code': None,
-                'parent_concepts': None,
-                'mapped_concepts': None,
-            }
-        if 'concept' in expression_insert:
-            response['concept_id'] = expression_insert['concept'][0]['concept_id']
-            response['concept_code'] = expression_insert['concept'][0]['concept_code']
-
-        # Add references to found parent or mapped concepts
-        if 'concept_relationship' in expression_insert:
-            response['parent_concepts'] = []
-            response['mapped_concepts'] = []
-            for cr in expression_insert['concept_relationship']:
-                if cr['relationship_id'] == 'Maps to':
-                    response['mapped_concept'] = cr['concept_id_2']
-                elif cr['relationship_id'] == 'Is a':
-                    response['parent_concepts'].append(cr['concept_id_2'])
-        return request_model.AddPCEResponse(**response)
+        return request_model.AddPCEResponse.from_inserts(expression_insert)
+
+
+def _ingest_batch(lines: list[str]) -> Iterator[str]:
+    """Ingests expressions one by one, yielding an NDJSON line with the result of each.
+    Expressions are parsed and classified by the batch classifier ahead of ingestion; identical
+    expressions in the batch are processed only once."""
+    jack = _get_instance()
+
+    items: list[tuple[int, request_model.AddPCERequest | Exception]] = []
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            items.append((line_number, request_model.AddPCERequest.parse_raw(line)))
+        except Exception as e:
+            items.append((line_number, e))
+
+    # Results come in the order of first occurrence, which is the order they are needed in
+    texts = dict.fromkeys(data.post_coordinated_expression for _, data in items
+                          if isinstance(data, request_model.AddPCERequest))
+    pending = jack.classifier.classify(texts)
+    classified: dict[str, batch_classifier.ClassifiedExpression] = dict()
+
+    # Temporary ids of nested subexpressions are only meaningful within the batch, and are private to its thread
+    with jack.voc.sctid_replacements.scope():
+        for line_number, data in items:
+            result = request_model.AddPCEBatchResult(line=line_number)
+            try:
+                if isinstance(data, Exception):
+                    raise data
+
+                text = data.post_coordinated_expression
+                if text not in classified:
+                    classified[text] = next(pending)
+                item = classified[text]
+                if item.error is not None:
+                    raise ValueError(item.error)
+
+                # Ingestion substitutes identifiers in the expression, so every item gets its own copy
+                with jack.voc.commit_lock:
+                    expression_insert = jack.voc.ingest_expression(
+                            copy.deepcopy(item.expression),
+                            jack.ont,
+                            source_id=data.source_id,
+                            given_name=data.given_name,
+                            generate_ids=not jack.stateless,
+                            report_parents=False,
+                            classification=item.classification,
+                            )
+                    if not jack.stateless:
+                        jack.voc.execute_inserts(expression_insert)
+
+                if jack.stateless:
+                    result.inserts = expression_insert
+                else:
+                    result.result = request_model.AddPCEResponse.from_inserts(expression_insert)
+
+            except Exception as e:
+                # A failed item must not abort the rest of the stream
+                server_logger.warning(f"Batch item on line {line_number} failed: {e!r}")
+                result.error = str(e) or repr(e)
+
+            yield result.json() + '\n'
+
+
+@app.route('/jackalope/v1.0/add/pce_batch', methods=['POST'])
+def add_post_coordinated_expression_batch():
+    """Accepts AddPCERequest objects as JSON lines and streams back one AddPCEBatchResult line per item,
+    in the same order, as soon as each of them is processed"""
+    if request.method == 'POST':
+        lines = request.get_data(as_text=True).splitlines()
+        return Response(_ingest_batch(lines), mimetype='application/x-ndjson')
+
+
+@app.route('/jackalope/v1.0/jobs', methods=['POST'])
+@validate(query=request_model.SubmitJobRequest, on_success_status=202)
+def submit_job():
+    """Accepts a CSV or JSONL file in the use_cases_icd.csv layout as the request body, to be ingested in background"""
+    if request.method == 'POST':
+        # If server is stateless, return an error
+        if _get_instance().stateless:
+            return jsonify({'error': 'Server is stateless!'}), 400
+
+        try:
+            return _get_instance().jobs.submit(request.stream, request.args.get('format', 'csv'))
+        except jobs.JobsFull as e:
+            return jsonify({'error': str(e)}), 503
+
+
+@app.route('/jackalope/v1.0/jobs/<job_id>', methods=['GET'])
+@validate()
+def job_status(job_id: str):
+    if request.method == 'GET':
+        status = _get_instance().jobs.status(job_id)
+        if status is None:
+            return jsonify({'error': f"Job {job_id} not found."}), 404
+        return status
+
+
+def _read_lines(path: str) -> Iterator[str]:
+    with open(path) as f:
+        yield from f
+
+
+@app.route('/jackalope/v1.0/jobs/<job_id>/results', methods=['GET'])
+@validate(query=request_model.JobResultsRequest)
+def job_results(job_id: str):
+    """Returns one JobResult per row of the submitted file, in the same order, as NDJSON or CSV"""
+    if request.method == 'GET':
+        status = _get_instance().jobs.status(job_id)
+        if status is None:
+            return jsonify({'error': f"Job {job_id} not found."}), 404
+        if status.status != jobs.DONE:
+            return jsonify({'error': f"Job {job_id} is {status.status}."}), 409
+
+        path = _get_instance().jobs.results_file(job_id)
+        if request.args.get('format', 'ndjson') == 'csv':
+            return Response(jobs.results_to_csv(_read_lines(path)), mimetype='text/csv')
+        return send_file(path, mimetype='application/x-ndjson')
 
 
 @app.route('/jackalope/v1.0/delete/mapping', methods=['DELETE'])
@@ -257,7 +477,8 @@ def unmap_concept():
             return jsonify({'error': 'Server is stateless!'}), 400
 
         concept_id = request.args['concept_id']
-        changes = _get_instance().voc.unmap(concept_id)
+        with _get_instance().jobs.priority.interactive(), _get_instance().voc.commit_lock:
+            changes = _get_instance().voc.unmap(concept_id)
         return request_model.BoolResponse(changes_made=changes)
 
 
@@ -270,17 +491,25 @@ def delete_vocabulary():
             return jsonify({'error': 'Server is stateless!'}), 400
 
         vid = request.args['vocabulary_id']
-        _get_instance().voc.drop_vocabulary(vid)
+        with _get_instance().voc.commit_lock:
+            _get_instance().voc.drop_vocabulary(vid)
         return jsonify({})
 
 
 def start_server(**kwargs):
     jack = JackalopeREST(**kwargs)
     jack.startup()
+    signal_ready(jack.ready_file)
     try:
-        app.run(host=jack.host, port=jack.port)
+        # Requests are served in threads: classification runs in parallel, commits are serialized by the vocabulary
+        app.run(host=jack.host, port=jack.port, threaded=True)
     finally:
         server_logger.info("Shutting down.")
+        clear_ready(jack.ready_file)
+        jack.jobs.close()
+        server_logger.info(f"Parse cache: {expression_process.parse_cache.cache_info()}")
+        server_logger.info(f"Normal form cache: {expression.normal_form_cache.cache_info()}")
+        jack.classifier.close()
         jack.voc.close_connection()
         server_logger.info("Goodbye.")
 
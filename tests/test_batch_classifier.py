@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+
+from core import batch_classifier
+from core import classification_cache
+from tests.test_ontology import build_test_ontology
+
+TEXTS = [
+        '301: {363698007 = 102, 116676008 = 201}',
+        '301: {363698007 = 102}',
+        '301: {363698007 = ',
+        '<<< 305: {363698007 = 101}',
+        ]
+
+
+class BatchClassifier(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.ont = build_test_ontology()
+
+    def classify(self, processes: int) -> list[batch_classifier.ClassifiedExpression]:
+        classifier = batch_classifier.BatchClassifier(self.ont, processes=processes)
+        self.addCleanup(classifier.close)
+        return list(classifier.classify(TEXTS * 5))
+
+    def test_in_process(self):
+        results = self.classify(0)
+        self.assertEqual(results[0].classification.parents, {303, 304})
+        self.assertEqual(results[0].classification.concept_code,
+                         results[0].expression.hash_concept_code(self.ont))
+        self.assertEqual(results[1].classification, classification_cache.ClassificationResult(equivalent_to=303))
+        self.assertIsNone(results[2].expression)
+        self.assertIsNotNone(results[2].error)
+        self.assertEqual(results[3].classification.parents, {302, 305})
+
+    def test_pool_keeps_order(self):
+        self.assertEqual([(r.classification, r.error) for r in self.classify(2)],
+                         [(r.classification, r.error) for r in self.classify(0)])
+
+    def test_independent_classifiers(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'classification.sqlite')
+        uncached = batch_classifier.BatchClassifier(self.ont, processes=0)
+        cached = batch_classifier.BatchClassifier(self.ont, processes=0, cache_path=path)
+        results = classification_cache.ClassificationCache(path, self.ont)
+        self.addCleanup(results.close)
+
+        # The cache of the second classifier is not used by the first
+        list(uncached.classify(TEXTS))
+        self.assertEqual(len(results), 0)
+        list(cached.classify(TEXTS))
+        self.assertEqual(len(results), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+import unittest
+
+from utils import caching
+
+
+class LRUCache(unittest.TestCase):
+    def test_eviction(self):
+        cache = caching.LRUCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+
+    def test_info(self):
+        cache = caching.LRUCache(maxsize=10)
+        cache.put('a', 1)
+        cache.get('a')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.cache_info(), caching.CacheInfo(hits=1, misses=1, maxsize=10, currsize=1, evictions=0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import datetime
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from core import classification_cache
+from tests.test_ontology import FINDING_SITE
+from tests.test_ontology import MORPHOLOGY
+from tests.test_ontology import build_test_ontology
+from tests.test_ontology import make_expression
+
+
+class ClassificationCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.ont = build_test_ontology()
+        self.ont.version = {'SNOMED CT US': datetime.date(2022, 3, 1)}
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'test.classification')
+
+    def open(self) -> classification_cache.ClassificationCache:
+        cache = classification_cache.ClassificationCache(self.path, self.ont)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_warm_run(self):
+        expr = make_expression([301], [(FINDING_SITE, 102), (MORPHOLOGY, 201)])
+        cold = self.open().classify(expr)
+        self.assertEqual(cold.parents, {303, 304})
+        self.assertEqual(cold.concept_code, expr.hash_concept_code(self.ont))
+
+        warm_cache = self.open()
+        with mock.patch.object(self.ont, 'expression_hierarchy') as classify:
+            warm = warm_cache.classify(make_expression([301], [(FINDING_SITE, 102), (MORPHOLOGY, 201)]))
+        classify.assert_not_called()
+        self.assertEqual(warm, cold)
+        self.assertEqual((warm_cache.hits, warm_cache.misses), (1, 0))
+
+    def test_equivalency(self):
+        self.open().classify(make_expression([301], [(FINDING_SITE, 102)]))
+        result = self.open().classify(make_expression([301], [(FINDING_SITE, 102)]))
+        self.assertEqual(result, classification_cache.ClassificationResult(equivalent_to=303))
+
+    def test_stale_entries(self):
+        self.open().classify(make_expression([301], [(FINDING_SITE, 102), (MORPHOLOGY, 201)]))
+        self.ont.version = {'SNOMED CT US': datetime.date(2022, 9, 1)}
+        cache = self.open()
+        self.assertEqual(len(cache), 0)
+
+        with mock.patch.object(classification_cache, 'HASH_COMPATIBILITY_VERSION', b'OTHER'):
+            self.open().classify(make_expression([301], [(FINDING_SITE, 102), (MORPHOLOGY, 201)]))
+        self.assertIsNone(cache.get(make_expression([301], [(FINDING_SITE, 102), (MORPHOLOGY, 201)])
+                                    .canonical(self.ont)))
+
+
+if __name__ == '__main__':
+    unittest.main()
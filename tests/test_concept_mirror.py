@@ -0,0 +1,71 @@
+import unittest
+
+import pandas as pd
+
+from core import concept_mirror
+
+
+def concept(concept_id: int, code: str, vocabulary_id: str = 'SNOMED', standard: str | None = 'S') -> dict:
+    return {'concept_id': concept_id, 'concept_code': code, 'concept_name': f'Concept {code}',
+            'vocabulary_id': vocabulary_id, 'standard_concept': standard, 'domain_id': 'Condition',
+            'concept_class_id': 'Clinical Finding'}
+
+
+def relationship(concept_id_1: int, concept_id_2: int, relationship_id: str = 'Maps to') -> dict:
+    return {'concept_id_1': concept_id_1, 'concept_id_2': concept_id_2, 'relationship_id': relationship_id}
+
+
+class SnomedConceptMirror(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tables = {
+                'concept': pd.DataFrame([concept(1, '100'), concept(2, '200', standard=None), concept(3, '300'),
+                                         concept(10, 'X', vocabulary_id='Custom', standard=None)]),
+                'concept_relationship': pd.DataFrame([relationship(2, 3), relationship(10, 1)]),
+                }
+        self.queries = []
+
+        concepts = self.tables['concept'].iloc[:2]
+        mappings = self.tables['concept_relationship'].iloc[:1]
+        self.mirror = concept_mirror.SnomedConceptMirror(concepts, mappings, self.query)
+
+    def query(self, tablename: str, **conditions) -> pd.DataFrame:
+        self.queries.append(tablename)
+        frame = self.tables[tablename]
+        idx = pd.DataFrame({k: frame[k].isin(v) for k, v in conditions.items()}).all(axis=1)
+        return frame[idx]
+
+    def test_lookup(self):
+        found = self.mirror.concepts_by_code(['200', '100'])
+        self.assertEqual(found['concept_id'].tolist(), [2, 1])
+        self.assertTrue(found['standard_concept'].isnull().tolist()[0])
+        self.assertEqual(self.mirror.mapping(2), [3])
+        self.assertEqual(self.mirror.mapping(1), [])
+        self.assertEqual(self.queries, [])
+
+    def test_read_through(self):
+        self.assertEqual(self.mirror.concepts_by_code(['300'])['concept_id'].tolist(), [3])
+        self.assertEqual(self.mirror.concepts_by_id([3, 10])['concept_id'].tolist(), [3, 10])
+        self.assertEqual(self.mirror.mapping(10), [1])
+        self.assertEqual(self.mirror.mapping(10), [1])
+        self.assertEqual(self.queries, ['concept', 'concept', 'concept_relationship'])
+
+    def test_missing(self):
+        self.assertTrue(self.mirror.concepts_by_code(['404']).empty)
+
+    def test_update(self):
+        self.mirror.update({'concept_relationship': [relationship(1, 50), relationship(2, 3, 'Is a'),
+                                                     relationship(1, 50)]})
+        self.assertEqual(self.mirror.mapping(1), [50])
+        # Rows of other types between mapped concepts do not replace the mapping
+        self.assertEqual(self.mirror.mapping(2), [3])
+
+    def test_forget(self):
+        self.mirror.forget(3)
+        self.assertEqual(self.mirror.mapping(2), [])
+        self.mirror.forget(1)
+        self.assertEqual(self.mirror.concepts_by_code(['100'])['concept_id'].tolist(), [1])
+        self.assertEqual(self.queries, ['concept'])
+
+
+if __name__ == '__main__':
+    unittest.main()
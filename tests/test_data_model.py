@@ -1,3 +1,7 @@
+import copy
+import dataclasses
+import gc
+import pickle
 import unittest
 from core import data_model
 
@@ -35,5 +39,37 @@ class HierarchyMatch(unittest.TestCase):
         self.assertIsNot(test_match_copy, test_match_original)
 
 
+class Relationships(unittest.TestCase):
+    def test_interned(self):
+        self.assertIs(data_model.Relationship(1, 2), data_model.Relationship(typeId=1, destinationId=2))
+        self.assertIs(copy.deepcopy(data_model.Relationship(1, 2)), data_model.Relationship(1, 2))
+        self.assertIs(pickle.loads(pickle.dumps(data_model.ConcreteRelationship(1, 'a'))),
+                      data_model.ConcreteRelationship(1, 'a'))
+        # Canonical forms of equal values of different types differ
+        self.assertIsNot(data_model.ConcreteRelationship(1, 1), data_model.ConcreteRelationship(1, True))
+
+    def test_unused_are_released(self):
+        relationship = data_model.ConcreteRelationship(1, 'only used here')
+        self.assertIn('only used here', data_model.ConcreteRelationship._interned[1, str])
+        del relationship
+        gc.collect()
+        self.assertNotIn('only used here', data_model.ConcreteRelationship._interned[1, str])
+
+    def test_value_semantics(self):
+        self.assertLess(data_model.Relationship(1, 2), data_model.Relationship(1, 3))
+        self.assertNotEqual(data_model.Relationship(1, 2), data_model.ConcreteRelationship(1, 2))
+        self.assertEqual(data_model.Relationship(1, 2).ord, data_model.Relationship.ord)
+        self.assertEqual(repr(data_model.Relationship(1, 2)), 'Relationship(typeId=1, destinationId=2, ord=1)')
+        with self.assertRaises(dataclasses.FrozenInstanceError):
+            data_model.Relationship(1, 2).typeId = 3
+
+    def test_legacy_state(self):
+        # Caches written by the dataclass implementation are unpickled through __setstate__
+        legacy = data_model.Relationship.__new__(data_model.Relationship)
+        legacy.__setstate__({'typeId': 1, 'destinationId': 2, 'ord': 1})
+        self.assertEqual(legacy, data_model.Relationship(1, 2))
+        self.assertEqual(hash(legacy), hash(data_model.Relationship(1, 2)))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -24,3 +24,17 @@ class Expression(unittest.TestCase):
         self.assertTrue(self.expression.definition_status)
         self.expression.set_definition_status(False)
         self.assertFalse(self.expression.definition_status)
+
+    def test_substitute_sctids(self):
+        untouched = data_model.RelationshipGroup.freeze([data_model.Relationship(10, 20)])
+        self.expression.add_relationship_group(untouched)
+        self.expression.add_relationship_group(data_model.RelationshipGroup.freeze([
+                data_model.Relationship(-5, -7), data_model.ConcreteRelationship(-5, 1)]))
+        self.expression.substitute_sctids({-5: 30, -7: 40})
+        self.assertIs(self.expression.relationship_groups[0], untouched)
+        self.assertEqual(self.expression.relationship_groups[1], data_model.RelationshipGroup.freeze([
+                data_model.Relationship(30, 40), data_model.ConcreteRelationship(30, 1)]))
+
+        groups = self.expression.relationship_groups
+        self.expression.substitute_sctids({-5: 50})
+        self.assertIs(self.expression.relationship_groups, groups)
@@ -0,0 +1,153 @@
+import random
+import unittest
+
+import antlr4
+
+from antlr_generated.SNOMEDLexer import SNOMEDLexer
+from antlr_generated.SNOMEDParser import SNOMEDParser
+from core import expression_process
+
+EXPRESSIONS = [
+        '404684003',
+        '=== 404684003 |Clinical finding|: 363698007 = 123037004',
+        '<<< 404684003 + 64572001: {363698007 = 123037004}, {116676008 = 49755003, 246454002 = 255604002}',
+        '404684003: 363698007 = 123037004, {116676008 = 49755003} {42752001 = 22298006}',
+        '404684003: 363698007 = (123037004: 272741003 = 7771000), 116676008 = 49755003',
+        '404684003: 363698007 = (123037004 + 7771000)',
+        '373873005: 1142139005 = #0, 411116001 = #-7, 762949000 = true, 1142140007 = FALSE',
+        ]
+
+
+class _CollectingListener(antlr4.error.ErrorListener.ErrorListener):
+    def __init__(self) -> None:
+        self.errors = []
+
+    def syntaxError(self, recognizer, offendingSymbol, line, column, msg, e):
+        self.errors.append(msg)
+
+
+def antlr_process(text: str) -> tuple[list, list]:
+    """Parses the text with ANTLR, collecting syntax errors the parser would otherwise recover from"""
+    processor = expression_process.Processor()
+    lexer = SNOMEDLexer(antlr4.InputStream(text))
+    lexer.removeErrorListeners()
+    lexer.addErrorListener(processor.error_listener)
+    parser = SNOMEDParser(antlr4.CommonTokenStream(lexer))
+    parser.removeErrorListeners()
+    listener = _CollectingListener()
+    parser.addErrorListener(listener)
+    antlr4.ParseTreeWalker().walk(processor, parser.expression())
+    return processor.expression_store, listener.errors
+
+
+def signature(store: list) -> list:
+    return [(e.concept_id, e.definition_status, e.parent_concepts, e.relationship_groups) for e in store]
+
+
+def random_expression(rnd: random.Random, depth: int = 0) -> str:
+    def ws():
+        return rnd.choice(['', ' ', '\n', '\t '])
+
+    def concept():
+        sctid = rnd.choice(['404684003', '363698007', '123037004', '116676008', '49755003'])
+        return sctid + (ws() + '|Some term|' if rnd.random() < .3 else '')
+
+    def value():
+        kind = rnd.random()
+        if kind < .15 and depth < 2:
+            return '(' + ws() + random_expression(rnd, depth + 1) + ws() + ')'
+        if kind < .3:
+            return rnd.choice(['true', 'False'])
+        if kind < .45:
+            return '#' + ws() + rnd.choice(['', '-', '+']) + rnd.choice(['0', '5'])
+        return concept()
+
+    def attribute_set():
+        attributes = [concept() + ws() + '=' + ws() + value() for _ in range(rnd.randint(1, 3))]
+        return (ws() + ',' + ws()).join(attributes)
+
+    def group():
+        return '{' + ws() + attribute_set() + ws() + '}'
+
+    text = (ws() + '+' + ws()).join(concept() for _ in range(rnd.randint(1, 2)))
+    if rnd.random() < .8:
+        text += ws() + ':' + ws() + (group() if rnd.random() < .5 else attribute_set())
+        text += ''.join(rnd.choice(['', ',']) + ws() + group() for _ in range(rnd.randint(0, 2)))
+
+    if depth == 0:
+        text = rnd.choice(['', '=== ', '<<<']) + ws() + text + ws()
+    return text
+
+
+class FastProcessor(unittest.TestCase):
+    def assertSameAsANTLR(self, text: str) -> None:
+        # Temporary concept identifiers are random
+        random.seed(0)
+        expected, errors = antlr_process(text)
+        self.assertEqual(errors, [], text)
+        random.seed(0)
+        self.assertEqual(signature(expression_process.FastProcessor().process(text)), signature(expected), text)
+
+    def test_examples(self):
+        for text in EXPRESSIONS:
+            self.assertSameAsANTLR(text)
+
+    def test_random_expressions(self):
+        rnd = random.Random(0)
+        for _ in range(300):
+            self.assertSameAsANTLR(random_expression(rnd))
+
+    def test_concrete_values(self):
+        pce, = expression_process.FastProcessor().process('373873005: {1142139005 = #12, 1142140007 = #0.25}, '
+                                                          '{1142141006 = "tablet"}')
+        self.assertEqual([rel.concreteValue for group in pce.relationship_groups for rel in group],
+                         [12, 0.25, 'tablet'])
+
+    def test_negative_values(self):
+        text = '373873005: 1142139005 = #-7, 1142140007 = # - 0.25, 1142141006 = #+3'
+        for processor in (expression_process.FastProcessor(), expression_process.Processor()):
+            pce, = processor.process(text)
+            self.assertEqual([rel.concreteValue for group in pce.relationship_groups for rel in group], [-7, -0.25, 3])
+
+    def test_syntax_errors(self):
+        for text, column in (('404684003:', 10), ('404684003: 363698007 = ', 23), ('404684003 123037004', 10),
+                             ('404684003: {363698007 = 123037004', 33), ('5: 363698007 = 123037004', 0)):
+            with self.assertRaises(expression_process.SNOMEDExpressionsError) as raised:
+                expression_process.FastProcessor().process(text)
+            self.assertEqual((raised.exception.line, raised.exception.column), (1, column), text)
+
+    def test_line_numbers(self):
+        with self.assertRaises(expression_process.SNOMEDExpressionsError) as raised:
+            expression_process.FastProcessor().process('404684003:\n  363698007 = x')
+        self.assertEqual((raised.exception.line, raised.exception.column), (2, 14))
+
+
+class ParseCache(unittest.TestCase):
+    def setUp(self) -> None:
+        expression_process.parse_cache.clear()
+
+    def test_key(self):
+        self.assertEqual(expression_process.cache_key('404684003 |Clinical finding| :\n  363698007 |Site| = 123037004'),
+                         expression_process.cache_key('404684003:363698007=123037004'))
+        self.assertNotEqual(expression_process.cache_key('11 22'), expression_process.cache_key('1122'))
+        self.assertEqual(expression_process.cache_key('11: 22 = "a  |b|"'), '11:22="a  |b|"')
+
+    def test_fresh_copies(self):
+        text = '404684003: 363698007 = (123037004: 272741003 = 7771000)'
+        first = expression_process.parse(text)
+        first[0].add_parent(1)
+        second = expression_process.parse('404684003 |Clinical finding|: 363698007 = (123037004: 272741003 = 7771000)')
+        self.assertEqual(len(second), 2)
+        self.assertEqual(second[0].parent_concepts, [123037004])
+        self.assertEqual(signature(second), signature(expression_process.parse(text)))
+        self.assertEqual(expression_process.parse_cache.cache_info()[:2], (2, 1))
+
+    def test_errors_not_cached(self):
+        for _ in range(2):
+            with self.assertRaises(expression_process.SNOMEDExpressionsError):
+                expression_process.parse('404684003:')
+        self.assertEqual(len(expression_process.parse_cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
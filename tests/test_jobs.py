@@ -0,0 +1,226 @@
+import datetime
+import io
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+from core import batch_classifier
+from rest_server import jobs
+from rest_server import request_model
+from rest_server import server
+from tests.test_ontology import build_test_ontology
+from tests.test_pipeline import build_test_vocabulary
+
+CSV = '''vocabulary_id,concept_code,concept_name,post_coordination_expression
+SciForce,A.01,Finding of site,"301: {363698007 = 102}"
+SciForce,A.02,Finding with morphology,"301: {363698007 = 102, 116676008 = 201}"
+SciForce,A.03,Broken,"301: {363698007 = "
+SciForce,A.04,No expression,
+'''
+
+
+def ingest_expression(expression, ont, source_id, classification, **kwargs) -> dict:
+    if classification.equivalent_to is not None:
+        return {'concept_relationship': [{'relationship_id': 'Maps to', 'concept_id_2': classification.equivalent_to}]}
+    return {'concept': [{'concept_id': 2_000_000_000 + source_id, 'concept_code': 'JCK'}],
+            'concept_relationship': [{'relationship_id': 'Is a', 'concept_id_2': p}
+                                     for p in sorted(classification.parents)]}
+
+
+class Jobs(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.ont = build_test_ontology()
+
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+
+        ids = itertools.count(1)
+        voc = mock.MagicMock()
+        voc.commit_lock = threading.RLock()
+        voc.add_source_concept.side_effect = lambda **kwargs: {'concept': [{'concept_id': next(ids)}]}
+        voc.ingest_expression.side_effect = ingest_expression
+
+        self.jack = types.SimpleNamespace(voc=voc, ont=self.ont, stateless=False,
+                                          classifier=batch_classifier.BatchClassifier(self.ont, processes=0))
+        self.jack.jobs = jobs.JobManager(self.jack, tmp.name)
+        self.addCleanup(self.jack.jobs.close)
+        self.client = server.app.test_client()
+
+    def wait(self, job_id: str) -> dict:
+        for _ in range(100):
+            status = self.client.get(f'/jackalope/v1.0/jobs/{job_id}').get_json()
+            if status['status'] in (jobs.DONE, jobs.FAILED):
+                return status
+            time.sleep(.05)
+        self.fail("Job did not finish.")
+
+    def test_csv(self):
+        with mock.patch.object(server.JackalopeREST, 'instance', self.jack):
+            response = self.client.post('/jackalope/v1.0/jobs?format=csv', data=CSV)
+            self.assertEqual(response.status_code, 202)
+            job_id = response.get_json()['job_id']
+
+            status = self.wait(job_id)
+            self.assertEqual((status['status'], status['total'], status['parsed'], status['classified'],
+                              status['mapped'], status['failed']), (jobs.DONE, 4, 3, 2, 2, 2))
+
+            results = [json.loads(line) for line in
+                       self.client.get(f'/jackalope/v1.0/jobs/{job_id}/results').get_data(as_text=True).splitlines()]
+            self.assertEqual([r['row'] for r in results], [1, 2, 3, 4])
+            self.assertEqual(results[0]['result']['mapped_concepts'], [303])
+            self.assertEqual(results[1]['result']['parent_concepts'], [303, 304])
+            self.assertIsNotNone(results[2]['error'])
+            self.assertIn('post_coordination_expression', results[3]['error'])
+
+            table = self.client.get(f'/jackalope/v1.0/jobs/{job_id}/results?format=csv').get_data(as_text=True)
+            self.assertEqual(table.splitlines()[0], ','.join(jobs.RESULT_COLUMNS))
+            self.assertEqual(table.splitlines()[2], '2,A.02,2,2000000002,JCK,303 304,,')
+
+            self.assertEqual(self.client.get('/jackalope/v1.0/jobs/0123').status_code, 404)
+
+    def test_jsonl(self):
+        lines = '\n'.join(json.dumps({'concept_code': f'B.{i}', 'concept_name': 'Finding',
+                                      'post_coordinated_expression': '301: {363698007 = 102}'}) for i in range(3))
+        status = self.jack.jobs.submit(io.BytesIO(lines.encode()), 'jsonl')
+        with mock.patch.object(server.JackalopeREST, 'instance', self.jack):
+            status = self.wait(status.job_id)
+        self.assertEqual((status['mapped'], status['failed']), (3, 0))
+
+    def test_bounded_queue(self):
+        manager = jobs.JobManager(self.jack, self.jack.jobs.path, max_queued=1)
+        self.addCleanup(manager.close)
+        # Without workers, nothing leaves the queue
+        with mock.patch.object(manager, '_start_workers'):
+            queued = manager.submit(io.BytesIO(CSV.encode()), 'csv')
+            with self.assertRaises(jobs.JobsFull):
+                manager.submit(io.BytesIO(CSV.encode()), 'csv')
+
+        manager.close()
+        self.assertEqual(manager.status(queued.job_id).status, jobs.FAILED)
+
+    def test_drain(self):
+        started, release = threading.Event(), threading.Event()
+        run = self.jack.jobs._run
+
+        def blocked_run(status):
+            started.set()
+            release.wait()
+            run(status)
+
+        stop = threading.Event()
+        with mock.patch.object(self.jack.jobs, '_run', side_effect=blocked_run):
+            running = self.jack.jobs.submit(io.BytesIO(CSV.encode()), 'csv')
+            queued = self.jack.jobs.submit(io.BytesIO(CSV.encode()), 'csv')
+            self.assertTrue(started.wait(5))
+            self.assertTrue(self.jack.jobs.busy)
+
+            drain = threading.Thread(target=self.jack.jobs.drain, args=(stop,))
+            drain.start()
+            drain.join(.2)
+            self.assertTrue(drain.is_alive())
+
+            release.set()
+            drain.join(5)
+            self.assertFalse(drain.is_alive())
+        self.assertFalse(self.jack.jobs.busy)
+        self.assertEqual(self.jack.jobs.status(running.job_id).status, jobs.DONE)
+        self.assertEqual(self.jack.jobs.status(queued.job_id).status, jobs.DONE)
+
+    def test_drain_stopped(self):
+        stop = threading.Event()
+        with mock.patch.object(self.jack.jobs, '_start_workers'):
+            self.jack.jobs.submit(io.BytesIO(CSV.encode()), 'csv')
+        stop.set()
+        # Returns although the job never runs
+        self.jack.jobs.drain(stop)
+        self.assertTrue(self.jack.jobs.busy)
+
+    def test_fail_orphaned(self):
+        # Without workers, nothing leaves the queue
+        with mock.patch.object(self.jack.jobs, '_start_workers'):
+            queued = self.jack.jobs.submit(io.BytesIO(CSV.encode()), 'csv')
+        self.assertEqual(jobs.fail_orphaned(self.jack.jobs.path, worker=os.getpid() + 1), 0)
+        self.assertEqual(self.jack.jobs.status(queued.job_id).status, jobs.QUEUED)
+
+        self.assertEqual(jobs.fail_orphaned(self.jack.jobs.path, worker=os.getpid()), 1)
+        status = self.jack.jobs.status(queued.job_id)
+        self.assertEqual(status.status, jobs.FAILED)
+        self.assertIsNotNone(status.error)
+        self.assertEqual(jobs.fail_orphaned(self.jack.jobs.path), 0)
+
+    def test_remove_expired(self):
+        manager = jobs.JobManager(self.jack, self.jack.jobs.path, retention=3600)
+        self.addCleanup(manager.close)
+        with mock.patch.object(manager, '_start_workers'):
+            queued = manager.submit(io.BytesIO(CSV.encode()), 'csv')
+            finished = manager.submit(io.BytesIO(CSV.encode()), 'csv')
+            manager._fail(finished, "Failed a day ago.")
+            self.assertEqual(jobs.remove_expired(manager.path, 3600), 0)
+
+            finished.finished -= datetime.timedelta(days=1)
+            manager._save(finished)
+            # Submitting removes expired jobs
+            manager.submit(io.BytesIO(CSV.encode()), 'csv')
+        self.assertIsNone(manager.status(finished.job_id))
+        self.assertEqual([name for name in os.listdir(manager.path) if name.startswith(finished.job_id)], [])
+        self.assertEqual(manager.status(queued.job_id).status, jobs.QUEUED)
+
+    def test_interactive_priority(self):
+        priority = jobs.InteractivePriority()
+        with priority.interactive():
+            start = time.monotonic()
+            priority.yield_to_interactive(timeout=.2)
+            self.assertGreaterEqual(time.monotonic() - start, .2)
+        start = time.monotonic()
+        priority.yield_to_interactive(timeout=5)
+        self.assertLess(time.monotonic() - start, 1)
+
+
+class SQLJobs(unittest.TestCase):
+    def test_rows_are_written(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        ont = build_test_ontology()
+        voc = build_test_vocabulary(self)
+        voc.commit_lock = threading.RLock()
+        jack = types.SimpleNamespace(voc=voc, ont=ont, stateless=False,
+                                     classifier=batch_classifier.BatchClassifier(ont, processes=0))
+        manager = jobs.JobManager(jack, tmp.name)
+        self.addCleanup(manager.close)
+
+        def run() -> request_model.JobStatus:
+            job_id = manager.submit(io.BytesIO(CSV.encode()), 'csv').job_id
+            for _ in range(100):
+                status = manager.status(job_id)
+                if status.status in (jobs.DONE, jobs.FAILED):
+                    return status
+                time.sleep(.05)
+            self.fail("Job did not finish.")
+
+        status = run()
+        self.assertEqual((status.status, status.mapped, status.failed), (jobs.DONE, 2, 2))
+
+        self.assertEqual(voc.query_table('vocabulary', vocabulary_id=[jobs.VOCABULARY_ID]).shape[0], 1)
+        concepts = voc.query_table('concept', vocabulary_id=[jobs.VOCABULARY_ID])
+        sources = dict(zip(concepts['concept_code'], concepts['concept_id'].tolist()))
+        self.assertEqual(sorted(sources), ['A.01', 'A.02'])
+        self.assertEqual(voc.get_mapping(sources['A.01']), [1303])
+        new_concept, = voc.query_table('concept', vocabulary_id=['Jackalope'])['concept_id'].tolist()
+        self.assertEqual(voc.get_mapping(sources['A.02']), [new_concept])
+
+        # The vocabulary is registered only once
+        vocabulary_concepts = voc.query_table('concept', vocabulary_id=['Vocabulary'])
+        self.assertEqual(run().status, jobs.DONE)
+        self.assertEqual(voc.query_table('concept', vocabulary_id=['Vocabulary']).shape, vocabulary_concepts.shape)
+
+
+if __name__ == '__main__':
+    unittest.main()
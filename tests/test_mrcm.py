@@ -0,0 +1,70 @@
+import gc
+import pickle
+import unittest
+import weakref
+from unittest import mock
+
+from tests.test_ontology import FINDING_SITE
+from tests.test_ontology import MORPHOLOGY
+from tests.test_ontology import build_test_ontology
+from tests.test_ontology import make_expression
+from utils.constants import CONCEPT_MODEL_ATTRIBUTE
+from validation import data_atoms
+from validation import mrcm
+
+
+def make_rule(rule_id: int, attribute_id: int, domain_id: int, cardinality: data_atoms.Cardinality,
+              in_group_cardinality: data_atoms.Cardinality = (0, None)) -> data_atoms.DomainRule:
+    return data_atoms.DomainRule(id=rule_id, attributeId=attribute_id, domainId=domain_id, grouped=True,
+                                 attribute_cardinality=cardinality,
+                                 attribute_in_group_cardinality=in_group_cardinality, mandatory=True)
+
+
+class MRCMValidator(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.ont = build_test_ontology()
+        cls.rules = [
+                make_rule(1, FINDING_SITE, 300, (1, None)),  # Clinical findings need a finding site
+                make_rule(2, CONCEPT_MODEL_ATTRIBUTE, 302, (0, 1)),  # Heart diseases have each attribute once
+                make_rule(3, MORPHOLOGY, 100, (1, 1)),  # Body structures only
+                ]
+        cls.validator = mrcm.MRCMValidator(cls.ont, domain_rules=cls.rules)
+
+    def test_valid(self):
+        self.validator.validate_expression(make_expression([303], [(FINDING_SITE, 102), (MORPHOLOGY, 201)]))
+
+    def test_missing_attribute(self):
+        with self.assertRaises(data_atoms.MRCMValidationError) as raised:
+            self.validator.validate_expression(make_expression([301], [(MORPHOLOGY, 201)]))
+        self.assertIs(raised.exception.rule, self.rules[0])
+
+    def test_subsumed_attribute_cardinality(self):
+        with self.assertRaises(data_atoms.MRCMValidationError) as raised:
+            self.validator.validate_expression(make_expression(
+                    [302], [(FINDING_SITE, 101), (FINDING_SITE, 102)], [(MORPHOLOGY, 201)]))
+        self.assertIs(raised.exception.rule, self.rules[1])
+
+    def test_rules_for_parents(self):
+        self.assertEqual(self.validator.rules_for_parents(frozenset([301])), (0,))
+        self.assertEqual(self.validator.rules_for_parents(frozenset([304, 101])), (0, 1, 2))
+        self.assertEqual(self.validator.rules_for_parents(frozenset([201])), ())
+
+    def test_memos(self):
+        validator = mrcm.MRCMValidator(self.ont, domain_rules=self.rules)
+        with mock.patch.object(mrcm, 'MEMO_SIZE', 2):
+            for parents in ([301], [302], [303]):
+                validator.rules_for_parents(frozenset(parents))
+            self.assertEqual(len(validator._parents_memo), 1)
+        self.assertEqual(validator.rules_for_attribute(FINDING_SITE), frozenset([0, 1]))
+        self.assertEqual(pickle.loads(pickle.dumps(validator))._attribute_memo, {})
+
+        # Memos do not keep the validator alive
+        released = weakref.ref(validator)
+        del validator
+        gc.collect()
+        self.assertIsNone(released())
+
+
+if __name__ == '__main__':
+    unittest.main()
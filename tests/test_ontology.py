@@ -0,0 +1,281 @@
+import gc
+import os
+import tempfile
+import unittest
+import weakref
+
+import pandas as pd
+
+from core import data_model
+from core import expression
+from core import mapped_ontology
+from core import ontology
+from utils.constants import CONCEPT_MODEL_ATTRIBUTE
+from utils.constants import DEFINED
+from utils.constants import FSN
+from utils.constants import ISA
+from utils.constants import SNOMED_ROOT
+
+PRIMITIVE = 900000000000074008
+FINDING_SITE = 363698007
+MORPHOLOGY = 116676008
+
+# Tiny SNOMED-like hierarchy: concept id -> (definition status, parents, {group: [(type, destination)]})
+CONCEPTS = {
+        SNOMED_ROOT: (PRIMITIVE, [], {}),
+        CONCEPT_MODEL_ATTRIBUTE: (PRIMITIVE, [SNOMED_ROOT], {}),
+        FINDING_SITE: (PRIMITIVE, [CONCEPT_MODEL_ATTRIBUTE], {}),
+        MORPHOLOGY: (PRIMITIVE, [CONCEPT_MODEL_ATTRIBUTE], {}),
+        100: (PRIMITIVE, [SNOMED_ROOT], {}),  # Body structure
+        101: (PRIMITIVE, [100], {}),  # Heart
+        102: (PRIMITIVE, [101], {}),  # Left ventricle
+        200: (PRIMITIVE, [SNOMED_ROOT], {}),  # Morphology
+        201: (PRIMITIVE, [200], {}),  # Lesion
+        300: (PRIMITIVE, [SNOMED_ROOT], {}),  # Clinical finding
+        301: (PRIMITIVE, [300], {}),  # Disorder
+        302: (DEFINED, [301], {1: [(FINDING_SITE, 101)]}),  # Heart disease
+        303: (DEFINED, [302], {1: [(FINDING_SITE, 102)]}),  # Left ventricle disease
+        304: (DEFINED, [302], {1: [(FINDING_SITE, 101), (MORPHOLOGY, 201)]}),  # Heart lesion
+        305: (PRIMITIVE, [301], {}),  # Unrelated disorder
+        }
+
+
+def build_test_ontology() -> ontology.Ontology:
+    concepts, descriptions, relationships = [], [], []
+    for cid, (status, parents, groups) in CONCEPTS.items():
+        concepts.append({'id': cid, 'active': 1, 'moduleId': 1, 'definitionStatusId': status})
+        descriptions.append({'conceptId': cid, 'typeId': FSN, 'term': f'Concept {cid}'})
+        for parent in parents:
+            relationships.append({'sourceId': cid, 'destinationId': parent, 'typeId': ISA, 'relationshipGroup': 0})
+        for group, rels in groups.items():
+            for type_id, destination_id in rels:
+                relationships.append({'sourceId': cid, 'destinationId': destination_id,
+                                      'typeId': type_id, 'relationshipGroup': group})
+
+    ont = ontology.Ontology()
+    ont.concept_df = pd.DataFrame(concepts)
+    ont.description_df = pd.DataFrame(descriptions)
+    ont.inferred_df = pd.DataFrame(relationships)
+    ont.concrete_df = pd.DataFrame(columns=['sourceId', 'value', 'typeId', 'relationshipGroup'])
+    ont.mrcm_domain_df = pd.DataFrame(columns=['contentTypeId'])
+    ont.mrcm_range_df = pd.DataFrame()
+    ont.module_dependency_df = pd.DataFrame()
+    ont.concept_count = len(concepts)
+    ont.version = {}
+    ont.populate()
+    return ont
+
+
+class Populate(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.ont = build_test_ontology()
+
+    def test_nodes(self):
+        self.assertEqual(set(self.ont.nodes), set(CONCEPTS))
+        self.assertEqual(self.ont.nodes[302]['full_specified_name'], 'Concept 302')
+
+    def test_hierarchy(self):
+        self.assertEqual(set(self.ont.predecessors(304)), {302})
+        self.assertEqual(set(self.ont.successors(302)), {303, 304})
+
+    def test_relationships(self):
+        self.assertEqual(self.ont.get_relationship_groups(304), (
+                data_model.RelationshipGroup(tuple()),
+                data_model.RelationshipGroup.freeze([data_model.Relationship(FINDING_SITE, 101),
+                                                     data_model.Relationship(MORPHOLOGY, 201)]),
+                ))
+        self.assertTrue(self.ont.nodes[304]['definitionStatus'])
+        self.assertFalse(self.ont.nodes[301]['definitionStatus'])
+
+    def test_primitive_parents(self):
+        self.assertEqual(self.ont.primitive_parents(303), {301})
+        self.assertEqual(self.ont.primitive_parents(304), {301})
+        self.assertEqual(self.ont.primitive_parents(305), {305})
+
+
+class OntologyBase(unittest.TestCase):
+    def test_incomplete_subclass(self):
+        class Incomplete(ontology.OntologyBase):
+            def successors(self, concept_id: int):
+                return iter(())
+
+        with self.assertRaises(TypeError):
+            Incomplete()
+
+
+class Reachability(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.ont = build_test_ontology()
+
+    def test_self(self):
+        self.assertTrue(self.ont.is_descendant(303, 303).mapped)
+
+    def test_shortest_distance(self):
+        self.assertEqual(self.ont.is_descendant(302, 301).distance, 1)
+        self.assertEqual(self.ont.is_descendant(303, 300).distance, 3)
+        self.assertEqual(self.ont.is_descendant(303, SNOMED_ROOT).distance, 4)
+
+    def test_ancestor_distances_cache(self):
+        ont = build_test_ontology()
+        self.assertEqual(ont.ancestor_distances(303)[301], 2)
+        self.assertEqual(ont.ancestor_distances(303), self.ont.ancestor_distances(303))
+        self.assertIsNot(ont.ancestor_distances(303), self.ont.ancestor_distances(303))
+
+        # Cached results do not keep the ontology alive
+        released = weakref.ref(ont)
+        del ont
+        gc.collect()
+        self.assertIsNone(released())
+
+    def test_unrelated(self):
+        self.assertFalse(self.ont.is_descendant(300, 303))
+        self.assertFalse(self.ont.is_descendant(305, 302))
+        self.assertFalse(self.ont.is_descendant(-1, 302))
+
+    def test_remove_redundant(self):
+        concepts = {300, 301, 303, 304, 305, 101, -1}
+        self.assertEqual(self.ont.remove_redundant_parents(concepts), {303, 304, 305, 101, -1})
+        self.assertEqual(self.ont.remove_redundant_children(concepts), {300, 101, -1})
+        self.assertEqual(self.ont.remove_redundant_parents(iter([302, 302])), {302})
+
+    def test_attribute_matrix(self):
+        self.assertEqual(set(self.ont.attribute_matrix.sctids.tolist()),
+                         {SNOMED_ROOT, CONCEPT_MODEL_ATTRIBUTE, FINDING_SITE, MORPHOLOGY})
+        self.assertEqual(self.ont.is_descendant(FINDING_SITE, SNOMED_ROOT).distance, 2)
+        self.assertFalse(self.ont.is_descendant(FINDING_SITE, MORPHOLOGY))
+        self.assertFalse(self.ont.is_descendant(FINDING_SITE, 101))
+
+    def test_descends_from_many(self):
+        relationship = data_model.Relationship(FINDING_SITE, 102)
+        candidates = [data_model.Relationship(MORPHOLOGY, 102), data_model.Relationship(FINDING_SITE, 100),
+                      data_model.Relationship(CONCEPT_MODEL_ATTRIBUTE, 101),
+                      data_model.ConcreteRelationship(FINDING_SITE, 102)]
+        self.assertEqual(relationship.descends_from_many(candidates, self.ont), [-1, 2, 2, -1])
+        self.assertEqual(relationship.descends_from_many(candidates, self.ont),
+                         [relationship.descends_from(c, self.ont).distance for c in candidates])
+
+
+def make_expression(parents: list[int], *groups: list[tuple[int, int]], defined: bool = True) -> expression.Expression:
+    expr = expression.Expression()
+    for parent in parents:
+        expr.add_parent(parent)
+    expr.add_relationship_group(data_model.RelationshipGroup(tuple()))
+    for group in groups:
+        expr.add_relationship_group(data_model.RelationshipGroup.freeze(
+                [data_model.Relationship(type_id, destination_id) for type_id, destination_id in group]))
+    expr.set_definition_status(defined)
+    return expr
+
+
+class ExpressionHierarchy(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.ont = build_test_ontology()
+
+    def assertHierarchy(self, expr_factory, expected: set[int]) -> None:
+        for bottom_up in (False, True):
+            self.assertEqual(self.ont.expression_hierarchy(expr_factory(), bottom_up=bottom_up), expected)
+
+    def test_refinement(self):
+        self.assertHierarchy(lambda: make_expression([301], [(FINDING_SITE, 102), (MORPHOLOGY, 201)]), {303, 304})
+
+    def test_primitive_parent_only(self):
+        self.assertHierarchy(lambda: make_expression([305], [(FINDING_SITE, 102)], defined=False), {303, 305})
+
+    def test_equivalency(self):
+        for bottom_up in (False, True):
+            with self.assertRaises(ontology.AccidentalEquivalency) as raised:
+                self.ont.expression_hierarchy(make_expression([301], [(FINDING_SITE, 102)]), bottom_up=bottom_up)
+            self.assertEqual(raised.exception.sctid, 303)
+
+    def test_subtype_of_equivalent(self):
+        self.assertHierarchy(lambda: make_expression([301], [(FINDING_SITE, 102)], defined=False), {303})
+
+
+class NormalFormCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.ont = build_test_ontology()
+
+    def test_shared(self):
+        first = make_expression([304], [(MORPHOLOGY, 201)])
+        second = make_expression([304], [(MORPHOLOGY, 201)])
+        second.concept_id = -5
+        self.assertIs(first.normal_form(self.ont).relationship_groups, second.normal_form(self.ont).relationship_groups)
+        self.assertEqual(second.normal_form(self.ont).concept_id, -5)
+        self.assertEqual(expression.normal_form_cache.cache_info()[:2], (1, 1))
+
+    def test_invalidated(self):
+        make_expression([304]).normal_form(self.ont)
+        build_test_ontology()
+        self.assertEqual(len(expression.normal_form_cache), 0)
+
+
+class AttributeIndex(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.ont = build_test_ontology()
+
+    def admitted(self, *attributes: tuple[int, int]) -> set[int]:
+        mask = self.ont.attribute_index.admitted(
+                [data_model.Relationship(type_id, destination_id) for type_id, destination_id in attributes],
+                self.ont.reachability)
+        return {concept_id for concept_id in (302, 303, 304) if mask[self.ont.reachability.position(concept_id)]}
+
+    def test_descendant_values(self):
+        self.assertEqual(self.admitted((FINDING_SITE, 102)), {302, 303})
+        self.assertEqual(self.admitted((FINDING_SITE, 102), (MORPHOLOGY, 201)), {302, 303, 304})
+
+    def test_unrelated_values(self):
+        self.assertEqual(self.admitted((FINDING_SITE, 100)), set())
+        self.assertEqual(self.admitted((MORPHOLOGY, 201)), set())
+
+    def test_unconstrained_concepts(self):
+        mask = self.ont.attribute_index.admitted([], self.ont.reachability)
+        self.assertTrue(mask[self.ont.reachability.position(305)])
+        self.assertFalse(mask[self.ont.reachability.position(302)])
+
+
+class MappedFormat(unittest.TestCase):
+    def setUp(self) -> None:
+        self.ont = build_test_ontology()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def assertSameOntology(self, mapped: mapped_ontology.MappedOntology) -> None:
+        self.assertEqual(len(mapped), len(self.ont))
+        for concept_id in CONCEPTS:
+            self.assertEqual(list(mapped.successors(concept_id)), list(self.ont.successors(concept_id)))
+            self.assertEqual(list(mapped.predecessors(concept_id)), list(self.ont.predecessors(concept_id)))
+            self.assertEqual(mapped.get_relationship_groups(concept_id), self.ont.get_relationship_groups(concept_id))
+            self.assertEqual(mapped.is_primitive(concept_id), self.ont.is_primitive(concept_id))
+            self.assertEqual(mapped.primitive_parents(concept_id), self.ont.primitive_parents(concept_id))
+            self.assertEqual(mapped.full_specified_name(concept_id), self.ont.full_specified_name(concept_id))
+            for other_id in CONCEPTS:
+                self.assertEqual(mapped.is_descendant(concept_id, other_id),
+                                 self.ont.is_descendant(concept_id, other_id))
+
+    def test_roundtrip(self):
+        path = os.path.join(self.tmp.name, 'test.jont')
+        mapped_ontology.write(self.ont, path)
+        self.assertTrue(mapped_ontology.is_mapped_file(path))
+        self.assertSameOntology(mapped_ontology.load(path))
+
+    def test_classification(self):
+        path = os.path.join(self.tmp.name, 'test.jont')
+        mapped_ontology.write(self.ont, path)
+        mapped = mapped_ontology.load(path)
+        expr = make_expression([301], [(FINDING_SITE, 102), (MORPHOLOGY, 201)])
+        self.assertEqual(mapped.expression_hierarchy(expr), self.ont.expression_hierarchy(expr))
+
+    def test_convert(self):
+        ont_path, mapped_path = os.path.join(self.tmp.name, 'test.ont'), os.path.join(self.tmp.name, 'test.jont')
+        build_test_ontology().dump(ont_path)
+        self.assertFalse(mapped_ontology.is_mapped_file(ont_path))
+        mapped_ontology.convert(ont_path, mapped_path)
+        self.assertSameOntology(mapped_ontology.load(mapped_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
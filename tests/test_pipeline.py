@@ -0,0 +1,80 @@
+import io
+import os
+import tempfile
+import unittest
+
+from core import batch_classifier
+from core import pipeline
+from tests.test_ontology import CONCEPTS
+from tests.test_ontology import build_test_ontology
+from vocab_backend import sql_backend
+
+# Rows 2 and 4 create the same concept, rows 3 and 5 are equivalent to an existing one
+CSV = '''concept_code,concept_name,post_coordination_expression
+A.01,Broken,"301: {363698007 = "
+A.02,Lesion of left ventricle,"301: {363698007 = 102, 116676008 = 201}"
+A.03,Left ventricle disease,"301: {363698007 = 102}"
+A.04,Left ventricular lesion,"301: {116676008 = 201, 363698007 = 102}"
+A.05,Left ventricle disorder,"303"
+'''
+
+
+def build_test_vocabulary(test: unittest.TestCase) -> sql_backend.OmopVocabularySQL:
+    """Opens a vocabulary in a temporary SQLite database, holding the concepts of the test ontology,
+    each mapped to itself. Concept ids are SCTIDs plus 1000."""
+    tmp = tempfile.TemporaryDirectory()
+    test.addCleanup(tmp.cleanup)
+    voc = sql_backend.OmopVocabularySQL(clean=True, protocol='sqlite', db_user='', db_password='',
+                                        db_address='', db_port=0, db_name=os.path.join(tmp.name, 'cdm.sqlite'))
+    test.addCleanup(voc.close_connection)
+
+    shared = {'valid_start_date': '19700101', 'valid_end_date': '20991231', 'invalid_reason': None}
+    voc.execute_inserts({
+            'concept': [{'concept_id': 1000 + sctid, 'concept_name': f'Concept {sctid}', 'domain_id': 'Condition',
+                         'vocabulary_id': 'SNOMED', 'concept_class_id': 'Clinical Finding',
+                         'concept_code': str(sctid), 'standard_concept': 'S', **shared} for sctid in CONCEPTS],
+            'concept_relationship': [{'concept_id_1': 1000 + sctid, 'concept_id_2': 1000 + sctid,
+                                      'relationship_id': 'Maps to', **shared} for sctid in CONCEPTS],
+            'concept_ancestor': [{'ancestor_concept_id': 1000 + sctid, 'descendant_concept_id': 1000 + sctid,
+                                  'min_levels_of_separation': 0, 'max_levels_of_separation': 0}
+                                 for sctid in CONCEPTS],
+            })
+    return voc
+
+
+class Pipeline(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.ont = build_test_ontology()
+        cls.classifier = batch_classifier.BatchClassifier(cls.ont, processes=0)
+
+    def run_pipeline(self, transaction_size: int) -> tuple[pipeline.PipelineStats, sql_backend.OmopVocabularySQL]:
+        voc = build_test_vocabulary(self)
+        stats = pipeline.Pipeline(voc, self.ont, self.classifier, transaction_size=transaction_size).run(
+                pipeline.read_rows(io.StringIO(CSV)))
+        return stats, voc
+
+    def test_rows(self):
+        stats, voc = self.run_pipeline(transaction_size=100)
+        self.assertEqual(stats, pipeline.PipelineStats(rows=5, mapped=4, created=1, failed=1))
+
+        concepts = voc.query_table('concept', vocabulary_id=['SciForce'])
+        sources = dict(zip(concepts['concept_code'], concepts['concept_id'].tolist()))
+        self.assertEqual(sorted(sources), ['A.02', 'A.03', 'A.04', 'A.05'])
+        new_concept, = voc.query_table('concept', vocabulary_id=['Jackalope'])['concept_id'].tolist()
+        self.assertEqual(voc.get_mapping(sources['A.02']), [new_concept])
+        self.assertEqual(voc.get_mapping(sources['A.04']), [new_concept])
+        self.assertEqual(voc.get_mapping(sources['A.03']), [1303])
+        self.assertEqual(voc.get_mapping(sources['A.05']), [1303])
+
+    def test_transaction_size(self):
+        def tables(voc: sql_backend.OmopVocabularySQL) -> list[list[tuple]]:
+            return [sorted(map(tuple, voc.query_table(table).astype(str).values.tolist()))
+                    for table in ('concept', 'concept_relationship')]
+
+        self.assertEqual(tables(self.run_pipeline(transaction_size=1)[1]),
+                         tables(self.run_pipeline(transaction_size=3)[1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
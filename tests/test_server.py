@@ -0,0 +1,187 @@
+import json
+import os
+import signal
+import socket
+import tempfile
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+from core import batch_classifier
+from rest_server import jobs
+from rest_server import prefork
+from rest_server import server
+from tests.test_ontology import build_test_ontology
+from tests.test_pipeline import build_test_vocabulary
+
+# Lines 1 and 4 are equivalent to an existing concept, 2 and 5 create the same concept
+BATCH = [
+        {'post_coordinated_expression': '301: {363698007 = 102}', 'source_id': 10},
+        {'post_coordinated_expression': '301: {363698007 = 102, 116676008 = 201}', 'source_id': 11,
+         'given_name': 'Lesion of left ventricle'},
+        {'post_coordinated_expression': '301: {363698007 = ', 'source_id': 12},
+        {'post_coordinated_expression': '303', 'source_id': 13},
+        {'post_coordinated_expression': '301: {116676008 = 201, 363698007 = 102}', 'source_id': 14,
+         'given_name': 'Left ventricular lesion'},
+        ]
+
+
+class Readiness(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+
+    def test_ready_file(self):
+        path = os.path.join(self.dir, 'jackalope.ready')
+        with mock.patch.dict(os.environ, clear=True):
+            server.signal_ready(path)
+        with open(path) as f:
+            self.assertEqual(f.read(), str(os.getpid()))
+
+        server.clear_ready(path)
+        self.assertFalse(os.path.exists(path))
+        server.clear_ready(path)
+        server.clear_ready(None)
+
+    def test_notify_socket(self):
+        address = os.path.join(self.dir, 'notify')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as listener:
+            listener.bind(address)
+            with mock.patch.dict(os.environ, {'NOTIFY_SOCKET': address}):
+                server.signal_ready(None)
+            self.assertEqual(listener.recv(64), b'READY=1')
+
+
+class AddPCEBatch(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.ont = build_test_ontology()
+        cls.classifier = batch_classifier.BatchClassifier(cls.ont, processes=0)
+
+    def post(self, stateless: bool, lines: list[str]) -> list[dict]:
+        voc = build_test_vocabulary(self)
+        voc.commit_lock = threading.RLock()
+        # Source concepts the expressions are mapped from
+        voc.execute_inserts({'concept': [
+                {'concept_id': item['source_id'], 'concept_name': f'Source {item["source_id"]}', 'domain_id': 'Condition',
+                 'vocabulary_id': 'SciForce', 'concept_class_id': 'ICD10 code', 'concept_code': str(item['source_id']),
+                 'standard_concept': None, 'valid_start_date': '19700101', 'valid_end_date': '20991231',
+                 'invalid_reason': None} for item in BATCH]})
+        jack = types.SimpleNamespace(voc=voc, ont=self.ont, classifier=self.classifier, stateless=stateless)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        jack.jobs = jobs.JobManager(jack, tmp.name)
+
+        with mock.patch.object(server.JackalopeREST, 'instance', jack):
+            response = server.app.test_client().post('/jackalope/v1.0/add/pce_batch', data='\n'.join(lines))
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            self.voc = voc
+            return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    def test_results(self):
+        results = self.post(False, [json.dumps(item) for item in BATCH])
+        self.assertEqual([r['line'] for r in results], [1, 2, 3, 4, 5])
+        self.assertEqual(results[0]['result']['mapped_concepts'], [1303])
+        self.assertEqual(results[3]['result']['mapped_concepts'], [1303])
+        self.assertIsNotNone(results[2]['error'])
+        self.assertIsNone(results[2]['result'])
+
+        # The second equivalent expression finds the concept written for the first one
+        new_concept = results[1]['result']['concept_id']
+        self.assertIsNotNone(new_concept)
+        self.assertEqual(results[4]['result']['mapped_concepts'], [new_concept])
+        self.assertEqual(self.voc.get_mapping(11), [new_concept])
+        self.assertEqual(self.voc.get_mapping(14), [new_concept])
+
+    def test_invalid_lines(self):
+        results = self.post(False, [json.dumps(BATCH[0]), '', '{"source_id": 1}', 'not json', json.dumps(BATCH[3])])
+        self.assertEqual([r['line'] for r in results], [1, 3, 4, 5])
+        self.assertEqual([r['error'] is None for r in results], [True, False, False, True])
+        self.assertIn('post_coordinated_expression', results[1]['error'])
+
+    def test_stateless(self):
+        results = self.post(True, [json.dumps(item) for item in BATCH[:2]])
+        self.assertEqual([r['result'] for r in results], [None, None])
+        self.assertIn({'concept_id_1': 10, 'concept_id_2': 1303, 'relationship_id': 'Maps to'},
+                      [{key: r[key] for key in ('concept_id_1', 'concept_id_2', 'relationship_id')}
+                       for r in results[0]['inserts']['concept_relationship']])
+        self.assertIn('concept', results[1]['inserts'])
+        # Nothing is written
+        self.assertEqual(self.voc.query_table('concept', vocabulary_id=['Jackalope']).shape[0], 0)
+        self.assertEqual(self.voc.query_table('concept_relationship', concept_id_1=[10, 11]).shape[0], 0)
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), "Requires fork")
+class Prefork(unittest.TestCase):
+    def setUp(self) -> None:
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+
+    @mock.patch.object(prefork, 'MAX_STARTUP_FAILURES', 3)
+    def test_workers_failing_to_start(self):
+        def attach() -> None:
+            raise RuntimeError("Broken worker")
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        jack = types.SimpleNamespace(workers=2, backend='sql', stateless=True, host='127.0.0.1', port=0,
+                                     ready_file=None, jobs_path=tmp.name, startup=lambda: None, detach=lambda: None,
+                                     attach=attach)
+        master = prefork.PreforkServer(jack)
+        with self.assertRaises(prefork.WorkersFailing):
+            master.run()
+        self.assertEqual(master.workers, {})
+
+    def start_worker(self, busy: bool) -> tuple[int, str]:
+        """Forks a worker whose jobs run until the returned file is created"""
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        release = os.path.join(tmp.name, 'release')
+
+        def drain(stop: threading.Event) -> None:
+            while not os.path.exists(release) and not stop.wait(.05):
+                pass
+
+        jack = types.SimpleNamespace(workers=1, host='127.0.0.1', port=0, max_requests=0, jobs_path=tmp.name,
+                                     attach=lambda: None, detach=lambda: None,
+                                     jobs=types.SimpleNamespace(busy=busy, drain=drain))
+        master = prefork.PreforkServer(jack)
+        master._socket = socket.create_server(('127.0.0.1', 0))
+        self.addCleanup(master._socket.close)
+        master._ready_pipe = os.pipe()
+        self.addCleanup(os.close, master._ready_pipe[0])
+        master._spawn()
+        os.close(master._ready_pipe[1])
+        self.assertEqual(os.read(master._ready_pipe[0], 1), b'.')
+        return next(iter(master.workers)), release
+
+    def wait_exit(self, pid: int) -> int:
+        for _ in range(100):
+            reaped, status = os.waitpid(pid, os.WNOHANG)
+            if reaped:
+                return status
+            time.sleep(.05)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        self.fail("Worker did not exit.")
+
+    def test_recycle_waits_for_jobs(self):
+        pid, release = self.start_worker(busy=True)
+        os.kill(pid, signal.SIGHUP)
+        time.sleep(.5)
+        self.assertEqual(os.waitpid(pid, os.WNOHANG), (0, 0))
+
+        open(release, 'w').close()
+        self.assertEqual(self.wait_exit(pid), 0)
+
+    def test_stop_interrupts_jobs(self):
+        pid, _ = self.start_worker(busy=True)
+        os.kill(pid, signal.SIGTERM)
+        self.assertEqual(self.wait_exit(pid), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import sqlalchemy as sa
+
+from vocab_backend import sql_backend
+
+SHARED = {'valid_start_date': '19700101', 'valid_end_date': '20991231', 'invalid_reason': None}
+
+
+def relationship(concept_id_1: int, concept_id_2: int, relationship_id: str, **values) -> dict:
+    return {'concept_id_1': concept_id_1, 'concept_id_2': concept_id_2, 'relationship_id': relationship_id,
+            **SHARED, **values}
+
+
+def sqlite_options(directory: str) -> dict:
+    return dict(protocol='sqlite', db_user='', db_password='', db_address='', db_port=0,
+                db_name=os.path.join(directory, 'cdm.sqlite'))
+
+
+class ExecuteInserts(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.voc = sql_backend.OmopVocabularySQL(clean=True, **sqlite_options(tmp.name))
+        self.addCleanup(self.voc.close_connection)
+
+    def relationships(self) -> set[tuple]:
+        table = self.voc.query_table('concept_relationship')
+        if table.empty:
+            return set()
+        return set(zip(table['concept_id_1'], table['concept_id_2'], table['relationship_id'],
+                       table['valid_end_date'].astype(str)))
+
+    def test_multiple_rows(self):
+        self.voc.execute_inserts({
+                'concept_relationship': [relationship(1, 2, 'Is a'), relationship(2, 1, 'Subsumes')],
+                'concept_ancestor': [{'ancestor_concept_id': 2, 'descendant_concept_id': 1,
+                                      'min_levels_of_separation': 1, 'max_levels_of_separation': 1}],
+                })
+        self.assertEqual(self.relationships(), {(1, 2, 'Is a', '2099-12-31'), (2, 1, 'Subsumes', '2099-12-31')})
+        self.assertEqual(len(self.voc.query_table('concept_ancestor')), 1)
+
+    def test_relationship_ids_are_keys(self):
+        self.voc.execute_inserts({'concept_relationship': [relationship(1, 1, 'Maps to'),
+                                                           relationship(1, 1, 'Mapped from')]})
+        self.assertEqual(self.relationships(), {(1, 1, 'Maps to', '2099-12-31'), (1, 1, 'Mapped from', '2099-12-31')})
+
+    def test_replace_existing(self):
+        self.voc.execute_inserts({'concept_relationship': [relationship(1, 2, 'Is a'), relationship(1, 3, 'Is a')]})
+        self.voc.execute_inserts({'concept_relationship': [relationship(1, 2, 'Is a', valid_end_date='20221231')]})
+        self.assertEqual(self.relationships(), {(1, 2, 'Is a', '2022-12-31'), (1, 3, 'Is a', '2099-12-31')})
+
+    def test_repeated_and_conflicting_rows(self):
+        self.voc.execute_inserts({'concept_relationship': [relationship(1, 2, 'Is a'), relationship(1, 2, 'Is a')]})
+        self.assertEqual(self.relationships(), {(1, 2, 'Is a', '2099-12-31')})
+
+        with self.assertRaises(ValueError):
+            self.voc.execute_inserts({'concept_relationship': [
+                    relationship(1, 3, 'Is a'),
+                    relationship(1, 4, 'Is a'),
+                    relationship(1, 4, 'Is a', valid_end_date='20221231'),
+                    ]})
+        # Nothing of the failed call is written
+        self.assertEqual(self.relationships(), {(1, 2, 'Is a', '2099-12-31')})
+
+    def test_chunks(self):
+        rows = [relationship(i, i + 1, 'Is a') for i in range(sql_backend._BULK_PARAMETER_LIMIT + 100)]
+        self.voc.execute_inserts({'concept_relationship': rows})
+        with mock.patch.object(sql_backend, '_BULK_PARAMETER_LIMIT', 10):
+            self.voc.execute_inserts({'concept_relationship': [
+                    relationship(i, i + 1, 'Is a', valid_end_date='20221231') for i in range(0, len(rows), 2)]})
+
+        relationships = self.relationships()
+        self.assertEqual(len(relationships), len(rows))
+        self.assertEqual(sum(end == '2022-12-31' for *_, end in relationships), (len(rows) + 1) // 2)
+
+
+class ForwardedEngine(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.options = sqlite_options(tmp.name)
+        self.engine = sql_backend.ForwardedEngine(**self.options, resolve_metadata=True)
+        self.addCleanup(self.engine.dispose)
+
+    def count(self) -> int:
+        with self.engine.session_scope() as session:
+            return session.execute(sa.select(sa.func.count()).select_from(sql_backend.IdLease.__table__)).scalar()
+
+    def test_engine_is_shared(self):
+        self.assertIs(self.engine.start(), self.engine.start())
+        self.engine.dispose()
+        self.assertIsNone(self.engine.engine)
+        # Disposed engines are started again on demand
+        self.assertEqual(self.count(), 0)
+        self.assertIsNotNone(self.engine.engine)
+
+    def test_concurrent_start(self):
+        create_engine = sa.create_engine
+
+        def slow_create_engine(*args, **kwargs):
+            # Gives other threads time to find no engine yet
+            time.sleep(.05)
+            return create_engine(*args, **kwargs)
+
+        with mock.patch.object(sql_backend.sa, 'create_engine', side_effect=slow_create_engine) as created:
+            engines = []
+            threads = [threading.Thread(target=lambda: engines.append(self.engine.start())) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(created.call_count, 1)
+        self.assertEqual(len(set(map(id, engines))), 1)
+
+    def test_session_scope(self):
+        with self.engine.session_scope() as session:
+            session.execute(sql_backend.IdLease.__table__.insert().values(sequence_name='a', next_value=1))
+        self.assertEqual(self.count(), 1)
+
+        with self.assertRaises(RuntimeError):
+            with self.engine.session_scope() as session:
+                session.execute(sql_backend.IdLease.__table__.insert().values(sequence_name='b', next_value=1))
+                raise RuntimeError()
+        self.assertEqual(self.count(), 1)
+
+    def test_close_connection_once(self):
+        voc = sql_backend.OmopVocabularySQL(clean=True, **self.options)
+        with self.assertLogs(voc.logger) as logs:
+            voc.close_connection()
+            voc.close_connection()
+            voc.logger.info("Closed.")
+        self.assertEqual(sum('Closing' in line for line in logs.output), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+import os
+import pickle
+import sys
+import tempfile
+import threading
+import unittest
+
+from core import vocab
+from utils.constants import JACKALOPE_SPACE
+from vocab_backend import sql_backend
+
+
+class SctidReplacements(unittest.TestCase):
+    def setUp(self) -> None:
+        self.replacements = vocab.SctidReplacements()
+
+    def test_chained(self):
+        self.replacements.add(-1, -2)
+        self.replacements.add(-2, 100)
+        self.assertEqual(self.replacements.get(-1), 100)
+        self.assertIsNone(self.replacements.get(-3))
+
+    def test_latest_wins(self):
+        self.replacements.add(-1, 100)
+        self.replacements.add(-1, 200)
+        self.assertEqual(self.replacements.get(-1), 200)
+        self.assertEqual(len(self.replacements), 1)
+
+    def test_bounded(self):
+        self.replacements.limit = 3
+        for i in range(1, 6):
+            self.replacements.add(-i, i)
+        self.assertEqual(list(self.replacements), [-3, -4, -5])
+
+    def test_scope(self):
+        self.replacements.add(-1, 100)
+        with self.replacements.scope():
+            self.replacements.add(-1, 200)
+            self.replacements.add(-2, 300)
+            self.assertEqual(self.replacements.get(-1), 200)
+        self.assertEqual(dict(self.replacements), {-1: 100})
+
+    def test_scope_is_private_to_thread(self):
+        seen = []
+
+        def ingest_batch() -> None:
+            with self.replacements.scope():
+                self.replacements.add(-1, 300)
+                seen.append(self.replacements.get(-1))
+
+        with self.replacements.scope():
+            self.replacements.add(-1, 200)
+            thread = threading.Thread(target=ingest_batch)
+            thread.start()
+            thread.join()
+            self.assertEqual(self.replacements.get(-1), 200)
+        self.assertEqual(seen, [300])
+        self.assertEqual(len(self.replacements), 0)
+
+    def test_get_while_adding(self):
+        # Outside scope(), threads share the map, and adding evicts old replacements all the time
+        self.replacements.limit = 10
+        # Switching threads often makes it likely that an entry is evicted between two lookups
+        self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+        sys.setswitchinterval(1e-6)
+        errors = []
+        done = threading.Event()
+
+        def add() -> None:
+            try:
+                for i in range(100_000):
+                    self.replacements.add(-(i % 20) - 1, -(i % 20) - 2)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                done.set()
+
+        def get() -> None:
+            try:
+                while not done.is_set():
+                    for i in range(1, 21):
+                        self.replacements.get(-i)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=add), threading.Thread(target=add), threading.Thread(target=get)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_pickle(self):
+        self.replacements.add(-1, 100)
+        restored = pickle.loads(pickle.dumps(self.replacements))
+        self.assertEqual(dict(restored), {-1: 100})
+        with restored.scope():
+            restored.add(-2, 200)
+        self.assertEqual(dict(restored), {-1: 100})
+
+
+class IdAllocator(unittest.TestCase):
+    def test_blocks(self):
+        leases = []
+
+        def lease(sequence: str, count: int) -> int:
+            leases.append(sequence)
+            return 1000 * len(leases)
+
+        allocator = vocab.IdAllocator(lease)
+        allocator.block_size = 2
+        self.assertEqual([allocator.next('a') for _ in range(3)], [1000, 1001, 2000])
+        self.assertEqual(allocator.next('b'), 3000)
+        self.assertEqual(leases, ['a', 'a', 'b'])
+
+
+class SQLIdLeases(unittest.TestCase):
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.options = dict(protocol='sqlite', db_user='', db_password='', db_address='', db_port=0,
+                            db_name=os.path.join(tmp.name, 'cdm.sqlite'))
+
+    def open(self, clean: bool = False) -> sql_backend.OmopVocabularySQL:
+        voc = sql_backend.OmopVocabularySQL(clean=clean, **self.options)
+        self.addCleanup(voc.close_connection)
+        return voc
+
+    def test_concurrent_instances(self):
+        first, second = self.open(clean=True), self.open()
+        allocated = []
+
+        def allocate(voc: sql_backend.OmopVocabularySQL) -> None:
+            allocated.extend(voc.next_jackalope_id() for _ in range(250))
+
+        threads = [threading.Thread(target=allocate, args=(voc,)) for voc in (first, second, first, second)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(allocated)), 1000)
+        self.assertTrue(all(JACKALOPE_SPACE[0] < i < JACKALOPE_SPACE[1] for i in allocated))
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "Requires fork")
+    def test_forked_processes(self):
+        voc = self.open(clean=True)
+        allocated = [voc.next_jackalope_id()]
+        # As the pre-forked server does, connections are released before forking
+        voc.close_connection()
+
+        pipes = []
+        for _ in range(2):
+            read, write = os.pipe()
+            if os.fork() == 0:
+                os.close(read)
+                status = 1
+                try:
+                    ids = [voc.next_jackalope_id() for _ in range(10)]
+                    os.write(write, ' '.join(map(str, ids)).encode())
+                    status = 0
+                finally:
+                    os._exit(status)
+            os.close(write)
+            pipes.append(read)
+
+        for read in pipes:
+            with os.fdopen(read) as f:
+                allocated.extend(map(int, f.read().split()))
+        for _ in range(2):
+            _, status = os.wait()
+            self.assertEqual(status, 0)
+        allocated.extend(voc.next_jackalope_id() for _ in range(10))
+
+        self.assertEqual(len(allocated), 31)
+        self.assertEqual(len(set(allocated)), 31)
+
+    def test_unused_blocks_are_skipped(self):
+        self.assertEqual(self.open(clean=True).next_omop_code(), 'OMOP1')
+        # Instance restarted without inserting anything does not reuse the leased block
+        self.assertEqual(self.open().next_omop_code(), f'OMOP{vocab.IdAllocator.block_size + 1}')
+
+
+if __name__ == '__main__':
+    unittest.main()
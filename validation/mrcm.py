@@ -1,6 +1,8 @@
 # Copyrigt 2022 Sciforce
 from __future__ import annotations
 
+from typing import Iterable
+
 from core import data_model
 from core.expression import Expression
 from utils.constants import ALLOW_NONRECOMMENDED
@@ -10,6 +12,9 @@ import validation.data_atoms
 
 _logger = logger.jacka_logger.getChild('MRCMValidation')
 
+# Number of parent sets and of attributes whose applicable rules are remembered
+MEMO_SIZE = 10_000
+
 
 def _parse_cardinality(cardinality: str) -> validation.data_atoms.Cardinality:
     if cardinality == '0..1':
@@ -28,10 +33,24 @@ def _parse_cardinality(cardinality: str) -> validation.data_atoms.Cardinality:
 
 class MRCMValidator:
 
-    def __init__(self, ont: data_model.OntologyInterface) -> None:
+    def __init__(self, ont: data_model.OntologyInterface,
+                 domain_rules: Iterable[validation.data_atoms.DomainRule] | None = None) -> None:
         self.domain_rules: list[validation.data_atoms.DomainRule] = []
         self._snomed = ont
 
+        # Rules may be restored from an ontology cache that no longer holds the raw MRCM frames
+        if domain_rules is not None:
+            self.domain_rules.extend(domain_rules)
+        else:
+            self._parse_domain_rules(ont)
+
+        self._index_rules()
+
+        _logger.info(f'Loaded {len(self.domain_rules)} MRCM domain rules')
+        _logger.debug(f'Mandatory rule count: {len([r for r in self.domain_rules if r.mandatory])}')
+        _logger.debug(f'Optional rule count: {len([r for r in self.domain_rules if not r.mandatory])}')
+
+    def _parse_domain_rules(self, ont: data_model.OntologyInterface) -> None:
         for _, row in ont.mrcm_domain_df.iterrows():
 
             # Check if rule applies to PCEs:
@@ -49,26 +68,83 @@ class MRCMValidator:
                     )
 
             self.domain_rules.append(rule)
-        _logger.info(f'Loaded {len(self.domain_rules)} MRCM domain rules')
-        _logger.debug(f'Mandatory rule count: {len([r for r in self.domain_rules if r.mandatory])}')
-        _logger.debug(f'Optional rule count: {len([r for r in self.domain_rules if not r.mandatory])}')
+
+    def _index_rules(self) -> None:
+        """Indexes positions of the rules by their domain and attribute concepts"""
+        self._rules_by_domain: dict[int, list[int]] = {}
+        self._rules_by_attribute: dict[int, list[int]] = {}
+        for position, rule in enumerate(self.domain_rules):
+            self._rules_by_domain.setdefault(rule.domainId, []).append(position)
+            self._rules_by_attribute.setdefault(rule.attributeId, []).append(position)
+
+        # Kept by the instance, so that they neither outlive it nor keep its ontology alive
+        self._parents_memo: dict[frozenset[int], tuple[int, ...]] = {}
+        self._attribute_memo: dict[int, frozenset[int]] = {}
+
+    def __getstate__(self) -> dict:
+        # Memos are filled again on demand
+        return {**self.__dict__, '_parents_memo': {}, '_attribute_memo': {}}
+
+    @staticmethod
+    def _remember(memo: dict, key, value):
+        # Clearing is safe while other threads read the memo, unlike evicting single entries
+        if len(memo) >= MEMO_SIZE:
+            memo.clear()
+        memo[key] = value
+        return value
+
+    def rules_for_parents(self, parents: frozenset[int]) -> tuple[int, ...]:
+        """Returns positions of the rules with a domain subsuming any of the parents, in the order of the rules"""
+        try:
+            return self._parents_memo[parents]
+        except KeyError:
+            pass
+
+        positions = set()
+        for parent in parents:
+            for ancestor in self._snomed.ancestor_distances(parent):
+                positions.update(self._rules_by_domain.get(ancestor, ()))
+        return self._remember(self._parents_memo, parents, tuple(sorted(positions)))
+
+    def rules_for_attribute(self, attribute_id: int) -> frozenset[int]:
+        """Returns positions of the rules for the attribute or any of its ancestors"""
+        try:
+            return self._attribute_memo[attribute_id]
+        except KeyError:
+            pass
+
+        positions = set()
+        for ancestor in self._snomed.ancestor_distances(attribute_id):
+            positions.update(self._rules_by_attribute.get(ancestor, ()))
+        return self._remember(self._attribute_memo, attribute_id, frozenset(positions))
 
     def validate_expression(self, e: Expression) -> None:
         # Count all attribute types and groups
         attr_types = e.get_attribute_counts(use_ontology=self._snomed)
         group_counts = {k: v for k, v in attr_types.items() if k > 0}
-        parents = e.parent_concepts
 
-        # Test if all mandatory attributes are present
-        for rule in self.domain_rules:
-            # Test if rule applies to expression parents
-            if not any(self._snomed.is_descendant(p, rule.domainId) for p in parents):
-                continue
+        # Only rules with a domain subsuming the expression parents apply
+        applicable = self.rules_for_parents(frozenset(e.parent_concepts))
+        if not applicable:
+            return
+
+        # Attributes of the expression under each rule, in the order of the expression
+        total_matches: dict[int, list[tuple[int, int]]] = {}
+        for attr, total_count in attr_types[-1].items():
+            for position in self.rules_for_attribute(attr):
+                total_matches.setdefault(position, []).append((attr, total_count))
+
+        group_matches: dict[int, list[tuple[int, int, int]]] = {}
+        for group, group_attrs in group_counts.items():
+            for attr, group_count in group_attrs.items():
+                for position in self.rules_for_attribute(attr):
+                    group_matches.setdefault(position, []).append((group, attr, group_count))
+
+        for position in applicable:
+            rule = self.domain_rules[position]
 
             # Test if mandatory attribute is absent
-            if rule.attribute_cardinality[0] > 0 and not any(self._snomed.is_descendant(a, rule.attributeId)
-                                                             for a
-                                                             in attr_types[-1]):
+            if rule.attribute_cardinality[0] > 0 and position not in total_matches:
                 err_msg = f'Obligatory attribute {rule.attributeId} is missing from expression {e}.'
                 if rule.mandatory or not ALLOW_NONRECOMMENDED:
                     raise validation.data_atoms.MRCMValidationError(err_msg, rule)
@@ -77,21 +153,7 @@ class MRCMValidator:
                     continue
 
             # Test total counts:
-            for attr, total_count in attr_types[-1].items():
-
-                # Test if rule applies to attribute
-                if not self._snomed.is_descendant(attr, rule.attributeId):
-                    continue
-
-                # Test if attribute can belong to expression parents
-                if not any(self._snomed.is_descendant(p, rule.domainId) for p in parents):
-                    err_msg = f'Attribute {attr} is not allowed in expression {e}. ' \
-                              f'Choose another attribute or add the expression parents.'
-                    if rule.mandatory or not ALLOW_NONRECOMMENDED:
-                        raise validation.data_atoms.MRCMValidationError(err_msg, rule)
-                    else:
-                        _logger.warning(err_msg)
-                        continue
+            for attr, total_count in total_matches.get(position, ()):
 
                 # Test if attribute count is outside of cardinality
                 if (rule.attribute_cardinality[1] is not None and total_count > rule.attribute_cardinality[1]) or \
@@ -105,22 +167,17 @@ class MRCMValidator:
                         continue
 
             # Test in group counts:
-            for group, group_attrs in group_counts.items():
-                for attr, group_count in group_attrs.items():
+            for group, attr, group_count in group_matches.get(position, ()):
 
-                    # Test if rule applies to attribute
-                    if not self._snomed.is_descendant(attr, rule.attributeId):
+                # Test if attribute count is outside of cardinality
+                if (rule.attribute_in_group_cardinality[1] is not None and
+                    group_count > rule.attribute_in_group_cardinality[1]) or group_count < \
+                        rule.attribute_in_group_cardinality[0]:
+                    err_msg = f'Attribute {attr} has {group_count} values in group {group}, but should have ' \
+                              f'between {rule.attribute_in_group_cardinality[0]} and ' \
+                              f'{rule.attribute_in_group_cardinality[1] or "*"} values.'
+                    if rule.mandatory or not ALLOW_NONRECOMMENDED:
+                        raise validation.data_atoms.MRCMValidationError(err_msg, rule)
+                    else:
+                        _logger.warning(err_msg)
                         continue
-
-                    # Test if attribute count is outside of cardinality
-                    if (rule.attribute_in_group_cardinality[1] is not None and
-                        group_count > rule.attribute_in_group_cardinality[1]) or group_count < \
-                            rule.attribute_in_group_cardinality[0]:
-                        err_msg = f'Attribute {attr} has {group_count} values in group {group}, but should have ' \
-                                  f'between {rule.attribute_in_group_cardinality[0]} and ' \
-                                  f'{rule.attribute_in_group_cardinality[1] or "*"} values.'
-                        if rule.mandatory or not ALLOW_NONRECOMMENDED:
-                            raise validation.data_atoms.MRCMValidationError(err_msg, rule)
-                        else:
-                            _logger.warning(err_msg)
-                            continue
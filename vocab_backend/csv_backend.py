@@ -74,9 +74,6 @@ class OmopVocabularyCSV(core.vocab.OmopVocabulary):
 
         self.vocabulary = pd.read_csv(os.path.join(path, 'VOCABULARY.csv'), sep='\t')
 
-        # Conversion for concept_id replacements for nested expressions
-        self.sctid_replacements = list()
-
         super(OmopVocabularyCSV, self).__init__(path, source_concept_id)
 
     def execute_inserts(self, inserts_dict: core.vocab.VocabularyInsert) -> None:
@@ -96,6 +93,8 @@ class OmopVocabularyCSV(core.vocab.OmopVocabulary):
             df.to_csv(output_path, mode='a', header=not os.path.exists(output_path), **self._CSV_OPTIONS)
             # It's up to user to manage and merge these tables, as we expect them to be further fed to an SQL database
 
+        self._update_mirror(inserts_dict)
+
     def dump(self, filepath: str):
 
         if not filepath[-4].lower().endswith('.omp'):
@@ -110,6 +109,19 @@ class OmopVocabularyCSV(core.vocab.OmopVocabulary):
 
         with open(filepath, 'rb') as f:
             loaded = pickle.load(f)
+
+            # Caches dumped by older versions stored replacements as a list of pairs
+            if isinstance(loaded.sctid_replacements, list):
+                replacements = core.vocab.SctidReplacements()
+                for old_sctid, new_sctid in loaded.sctid_replacements:
+                    replacements.add(old_sctid, new_sctid)
+                loaded.sctid_replacements = replacements
+
+            # Older caches kept plain counters seeded on creation
+            if not hasattr(loaded, 'id_allocator'):
+                loaded._leased_ids = dict()
+                loaded.id_allocator = core.vocab.IdAllocator(loaded._lease_ids)
+
             cls.logger.info(f"Loaded {cls} object containing "
                             f"{len(loaded.concept)} concept entries.")
 
@@ -147,7 +159,7 @@ class OmopVocabularyCSV(core.vocab.OmopVocabulary):
             idx = self.concept['concept_id'] >= range_start
 
         if idx.any():
-            return self.concept['concept_id'][idx].min()
+            return self.concept['concept_id'][idx].max()
 
         return range_start
 
@@ -1,14 +1,16 @@
 from __future__ import annotations
 
+import contextlib
+import datetime
+import threading
 from getpass import getpass
-from typing import Type, TypeVar, Any
+from typing import Any, ContextManager, Iterator, Type, TypeVar
 
 import sqlalchemy as sa
 import sshtunnel
 from sqlalchemy.orm import Session
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy.inspection import inspect
 import core.vocab
 
 import pandas as pd
@@ -17,6 +19,9 @@ import utils.constants
 
 _LOCALHOST = '127.0.0.1'
 
+# Bound parameters per bulk statement; SQLite builds before 3.32 only allow 999
+_BULK_PARAMETER_LIMIT = 900
+
 _OMOP_metadata = sa.MetaData()
 _Base = declarative_base(metadata=_OMOP_metadata)
 _omr_concept = TypeVar("_omr_concept", bound=_Base)
@@ -35,7 +40,8 @@ def get_mapper_class(tablename: str) -> Type[_omr_concept]:
 
 
 class ForwardedEngine:
-    """Creates a SQLAlchemy engine that forwards a local port to a remote port."""
+    """Creates a pooled SQLAlchemy engine, optionally forwarding a local port to a remote port through SSH.
+    The tunnel and the engine are started once and shared by all sessions until disposed."""
 
     def __init__(
             self,
@@ -52,8 +58,13 @@ class ForwardedEngine:
             metadata: sa.MetaData = _OMOP_metadata,
             resolve_metadata: bool = False,
             permanent_connection: bool = False,
-            schema: str = None
+            schema: str = None,
+            pool_size: int = 5,
+            max_overflow: int = 10,
+            pool_pre_ping: bool = True,
+            pool_recycle: int = 3600,
             ) -> None:
+        self._protocol = protocol
         self._db_address = db_address, db_port
         self._resolve_metadata = resolve_metadata
 
@@ -71,61 +82,83 @@ class ForwardedEngine:
             self.ssh_forwarder = None
 
         # Deter creation of engine until port is open
-        self.engine = None
+        self.engine: sa.engine.Engine | None = None
+        # Request threads may all try to start the engine on first use
+        self._lock = threading.Lock()
         self.metadata: sa.MetaData = metadata
-        self._session: Session | None = None
         self._schema = schema
 
-        self._url_template = (f"{protocol}://"f"{db_user}{':'+db_password if db_password else ''}@"
-                              "{ip}:{port}"  # Will be replaced with address
-                              f"/{db_name}")
-
-        # If permanent connection is requested, open it now
-        self.permanent_connection = permanent_connection
-        if self.permanent_connection:
-            self._session = self.__enter__(resolve_metadata=self._resolve_metadata)
-
-    def __enter__(self, resolve_metadata: bool = False) -> Session:
-        if self.permanent_connection and self._session is not None:
-            self._session.execute('SET CONSTRAINTS ALL DEFERRED;')
-            return self._session
-
-        if self.ssh_forwarder is not None:
-            self.ssh_forwarder.start()
-            self.engine = sa.create_engine(self._url_template.format(
-                    ip=_LOCALHOST,
-                    port=str(self.ssh_forwarder.local_bind_port),
-                    ))
+        if protocol.startswith('sqlite'):
+            # File based databases only have a path; they also do not need a connection pool
+            self._url_template = f"{protocol}:///{db_name}"
+            self._pool_options = dict()
         else:
-            self.engine = sa.create_engine(self._url_template.format(
-                    ip=self._db_address[0], port=self._db_address[1],
-                    ),
-                execution_options={"schema_translate_map": {None: self._schema}})
-
-        self.metadata.bind = self.engine
-
-        # If metadata resolution is pending, execute it
-        if self._resolve_metadata:
-            self.metadata.create_all()
-            self._resolve_metadata = False
+            self._url_template = (f"{protocol}://"f"{db_user}{':'+db_password if db_password else ''}@"
+                                  "{ip}:{port}"  # Will be replaced with address
+                                  f"/{db_name}")
+            self._pool_options = dict(
+                    pool_size=pool_size,
+                    max_overflow=max_overflow,
+                    pool_pre_ping=pool_pre_ping,
+                    pool_recycle=pool_recycle,
+                    )
 
-        self._session = Session(self.engine)
-        return self._session
+        # Pooled connections are always kept open now; option is accepted for compatibility with old configs
+        self.permanent_connection = permanent_connection
 
-    def __exit__(self, exception_type, *_) -> None:
-        if self.permanent_connection:
-            # Don't close permanent connection
-            self._session.commit()
-            return
+    def start(self) -> sa.engine.Engine:
+        """Opens the tunnel and creates the engine, if it was not done before"""
+        engine = self.engine
+        if engine is not None:
+            return engine
+
+        with self._lock:
+            if self.engine is not None:
+                return self.engine
+
+            if self.ssh_forwarder is not None:
+                self.ssh_forwarder.start()
+                url = self._url_template.format(ip=_LOCALHOST, port=str(self.ssh_forwarder.local_bind_port))
+            else:
+                url = self._url_template.format(ip=self._db_address[0], port=self._db_address[1])
+
+            engine = sa.create_engine(
+                    url,
+                    execution_options={"schema_translate_map": {None: self._schema}},
+                    **self._pool_options,
+                    )
 
-        if self._session is not None:
+            # If metadata resolution is pending, execute it
+            if self._resolve_metadata:
+                self.metadata.create_all(engine)
+                self._resolve_metadata = False
+
+            # Published last, so that other threads never use an engine whose tables are not created yet
+            self.engine = engine
+            return engine
+
+    @contextlib.contextmanager
+    def session_scope(self) -> Iterator[Session]:
+        """Checks out a session for a single unit of work. Commits it on success, rolls back on error."""
+        session = Session(self.start())
+        try:
+            yield session
+            session.commit()
+        except BaseException:
+            session.rollback()
+            raise
+        finally:
+            session.close()
 
-            if exception_type is None:
-                self._session.commit()
-            self._session.close()
+    def dispose(self) -> None:
+        """Closes all pooled connections and the tunnel"""
+        with self._lock:
+            if self.engine is not None:
+                self.engine.dispose()
+                self.engine = None
 
-        if self.ssh_forwarder is not None:
-            self.ssh_forwarder.stop()
+            if self.ssh_forwarder is not None and self.ssh_forwarder.is_active:
+                self.ssh_forwarder.stop()
 
 
 # Data tables
@@ -229,7 +262,8 @@ class ConceptRelationship(_Base):
                              sa.ForeignKey("concept.concept_id"),
                              primary_key=True)
     relationship_id = sa.Column(sa.String(20),
-                                sa.ForeignKey("relationship.relationship_id"))
+                                sa.ForeignKey("relationship.relationship_id"),
+                                primary_key=True)
     valid_start_date = sa.Column(sa.Date)
     valid_end_date = sa.Column(sa.Date)
     invalid_reason = sa.Column(sa.String(1), nullable=True)
@@ -304,6 +338,17 @@ class PackContent(_Base):
                 f"{self.drug_concept_id})")
 
 
+# Service tables
+class IdLease(_Base):
+    """Blocks of identifiers reserved by the running vocabulary instances, one row per sequence"""
+    __tablename__ = "jackalope_id_lease"
+    sequence_name = sa.Column(sa.String(20), primary_key=True)
+    next_value = sa.Column(sa.BigInteger, nullable=False)  # First identifier that was not leased yet
+
+    def __repr__(self) -> str:
+        return f"IdLease ({self.sequence_name} from {self.next_value})"
+
+
 # Add additional relationships after all classses are defined.
 # CONCEPT
 Concept.domain = relationship("Domain", foreign_keys='Concept.domain_id')
@@ -351,7 +396,7 @@ ConceptSynonym.language = relationship(
 class OmopVocabularySQL(core.vocab.OmopVocabulary):
     """SQL-Alchemy powered backend to read and write changes to SQL-hosted OMOP database."""
 
-    _stored_engine: ForwardedEngine | None = None
+    _engine: ForwardedEngine | None = None
     logger = core.vocab.vocabulary_logger.getChild('SQL')
 
     def __init__(self, clean: bool = True, **engine_options) -> None:
@@ -362,13 +407,12 @@ class OmopVocabularySQL(core.vocab.OmopVocabulary):
         if 'ssh_address' in self.engine_options and 'ssh_password' not in self.engine_options:
             self.engine_options['ssh_password'] = _get_ssh_pass()  # type: ignore
 
-        # Create a static engine if specified:
-        if engine_options.get('permanent_connection', False):
-            self._stored_engine = self.start_session(resolve_metadata=engine_options.get('resolve_metadata', None))
+        # A single pooled engine (and tunnel) serves the whole lifetime of the vocabulary
+        self._engine = ForwardedEngine(**{**self.engine_options, 'resolve_metadata': True})
 
         # test connection:
         self.logger.info("Ensuring remote table metadata aligns with the model...")
-        with self.start_session(resolve_metadata=True):
+        with self.start_session():
             self.logger.info(f"{self} initialized successfully.")
 
         if clean is True:
@@ -378,10 +422,9 @@ class OmopVocabularySQL(core.vocab.OmopVocabulary):
 
         super(OmopVocabularySQL, self).__init__(clean, **engine_options)
 
-    def start_session(self, resolve_metadata: bool = False) -> ForwardedEngine:
-        if self._stored_engine is not None:
-            return self._stored_engine
-        return ForwardedEngine(**self.engine_options, resolve_metadata=resolve_metadata)
+    def start_session(self) -> ContextManager[Session]:
+        """Returns a context manager with a new session from the shared engine"""
+        return self._engine.session_scope()
 
     def _find_concepts(self, **conditions) -> list[int]:
         stmt = sa.select(Concept.concept_id)
@@ -403,35 +446,79 @@ class OmopVocabularySQL(core.vocab.OmopVocabulary):
             result = session.execute(stmt)
             return pd.DataFrame(result.fetchall())
 
+    def _snomed_slice(self) -> tuple[pd.DataFrame, pd.DataFrame]:
+        concepts_stmt = sa.select(Concept.__table__).where(Concept.vocabulary_id == 'SNOMED')
+        mappings_stmt = (sa.select(ConceptRelationship.concept_id_1, ConceptRelationship.concept_id_2)
+                         .join(Concept, Concept.concept_id == ConceptRelationship.concept_id_1)
+                         .where(Concept.vocabulary_id == 'SNOMED',
+                                ConceptRelationship.relationship_id == 'Maps to'))
+
+        with self.start_session() as session:
+            concepts = pd.DataFrame(session.execute(concepts_stmt).fetchall())
+            mappings = pd.DataFrame(session.execute(mappings_stmt).fetchall(), columns=['concept_id_1', 'concept_id_2'])
+        return concepts, mappings
+
     def _get_concept_attribute(self, concept_id: int, attribute: str):
         column = getattr(Concept, attribute)
         stmt = sa.select(column).where(Concept.concept_id == concept_id)
         with self.start_session() as session:
             return session.execute(stmt).fetchone()[attribute]
 
+    @staticmethod
+    def _defer_constraints(session: Session) -> None:
+        """Work around circular foreign keys. Only PostgreSQL supports deferring constraints on demand."""
+        if session.get_bind().dialect.name == 'postgresql':
+            session.execute('SET CONSTRAINTS ALL DEFERRED;')
+
+    @staticmethod
+    def _prepare_rows(table: sa.Table, inserts: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        """Drops repeated rows and converts dates given as YYYYMMDD strings, as not every DBAPI driver accepts those
+        for DATE columns.
+        @raise ValueError: if different rows share a primary key, as only one of them could be written"""
+        date_columns = [c.name for c in table.columns if isinstance(c.type, sa.Date)]
+        pk_names = [c.name for c in table.primary_key.columns]
+
+        rows = dict()
+        for insert in inserts:
+            row = dict(insert)
+            for name in date_columns:
+                if isinstance(row.get(name), str):
+                    row[name] = datetime.datetime.strptime(row[name], '%Y%m%d').date()
+            key = tuple(row[name] for name in pk_names)
+            if rows.setdefault(key, row) != row:
+                raise ValueError(f"Conflicting {table.name} rows for primary key {key}: {rows[key]} and {row}")
+        return list(rows.values())
+
     def execute_inserts(self, inserts_dict: core.vocab.VocabularyInsert) -> None:
-        """Loads existing content if it matches, deletes it; then, performs insert.
+        """Deletes existing rows matching inserts on primary key; then, performs insert.
+        Every table is written with a few multi-row DELETE statements and a single executemany INSERT.
         Since we are only expected to work with the local instance of CDM, we do not manage deprecation."""
         with self.start_session() as session:
-            with session.no_autoflush:
-                # Work around circular foreign keys
-                session.execute('SET CONSTRAINTS ALL DEFERRED')
-                for tablename, inserts in inserts_dict.items():
-                    table_class = get_mapper_class(tablename)
-                    primary_keys = inspect(table_class).primary_key
-
-                    for insert in inserts:
-                        # Delete existing rows matching inserts on primary key
-                        condition = {pk.name: insert[pk.name] for pk in primary_keys}
-                        deletable_row_stmt = sa.delete(table_class)
-                        for col, val in condition.items():
-                            deletable_row_stmt = deletable_row_stmt.where(getattr(table_class, col) == val)
-                        session.execute(deletable_row_stmt)
-
-                        # Perform insert
-                        new = table_class(**insert)
-                        session.add(new)
-                session.commit()
+            self._defer_constraints(session)
+            for tablename, inserts in inserts_dict.items():
+                if not inserts:
+                    continue
+
+                table = get_mapper_class(tablename).__table__
+                pk_columns = list(table.primary_key.columns)
+                rows = self._prepare_rows(table, inserts)
+
+                # Delete existing rows matching inserts on primary key; keep bound parameter count reasonable
+                keys = [tuple(row[pk.name] for pk in pk_columns) for row in rows]
+                chunk_size = _BULK_PARAMETER_LIMIT // len(pk_columns)
+                for start in range(0, len(keys), chunk_size):
+                    chunk = keys[start:start + chunk_size]
+                    if len(pk_columns) == 1:
+                        condition = pk_columns[0].in_([key for key, in chunk])
+                    else:
+                        condition = sa.tuple_(*pk_columns).in_(chunk)
+                    session.execute(sa.delete(table).where(condition))
+
+                # Perform insert
+                session.execute(table.insert(), rows)
+            session.commit()
+
+        self._update_mirror(inserts_dict)
 
     def cleanup(self) -> None:
         """Removes all custom and generated concepts and other entries"""
@@ -445,8 +532,7 @@ class OmopVocabularySQL(core.vocab.OmopVocabulary):
 
         with self.start_session() as session:
             with session.no_autoflush:
-                # Work around circular foreign keys
-                session.execute('SET CONSTRAINTS ALL DEFERRED;')
+                self._defer_constraints(session)
                 for cls, cid_keys in affected_classes.items():
                     deleted_rows = 0
                     for key in cid_keys:
@@ -467,10 +553,38 @@ class OmopVocabularySQL(core.vocab.OmopVocabulary):
                             raise
                     self.logger.debug(f"Deleted {deleted_rows} from {cls.__tablename__}...")
 
+            # Sequences start over from the remaining concepts
+            session.execute(sa.delete(IdLease))
+
+    def _lease_ids(self, sequence: str, count: int) -> int:
+        """Reserves identifiers in the lease table, so that any number of threads, processes and hosts can allocate
+        from the same sequence. The UPDATE locks the row (or, in SQLite, the database) until the reservation
+        is committed; identifiers of a block that a crashed instance did not use are never reused."""
+        lease = IdLease.__table__
+        for _ in range(2):
+            try:
+                with self.start_session() as session:
+                    reserved = session.execute(sa.update(lease)
+                                               .where(lease.c.sequence_name == sequence)
+                                               .values(next_value=lease.c.next_value + count)).rowcount
+                    if reserved:
+                        next_value = session.execute(sa.select(lease.c.next_value)
+                                                     .where(lease.c.sequence_name == sequence)).scalar_one()
+                        return next_value - count
+
+                    # First reservation ever made in the sequence
+                    first = self._first_free_id(sequence)
+                    session.execute(lease.insert().values(sequence_name=sequence, next_value=first + count))
+                    return first
+
+            except sa.exc.IntegrityError:
+                # Another instance has created the row in the meantime
+                continue
+
+        raise RuntimeError(f"Could not lease identifiers from sequence {sequence}.")
+
     def _last_omop_code(self) -> int:
-        subquery = (sa.select(Concept
-                              .concept_code
-                              .regexp_replace("^OMOP", "")
+        subquery = (sa.select(sa.func.substr(Concept.concept_code, len('OMOP') + 1)
                               .cast(sa.Integer)
                               .label('int_code')
                               ).where(Concept.concept_code.regexp_match("^OMOP\\d+$")))
@@ -479,7 +593,7 @@ class OmopVocabularySQL(core.vocab.OmopVocabulary):
             return session.execute(query).fetchone()[0]
 
     def _last_id_in_range(self, range_start: int = 0, range_end: int | None = None) -> int:
-        query = sa.select(Concept.concept_id).order_by(Concept.concept_id).limit(1)
+        query = sa.select(Concept.concept_id).order_by(Concept.concept_id.desc()).limit(1)
         if range_end is not None:
             query = query.where(Concept.concept_id.between(range_start, range_end - 1))
         else:
@@ -503,10 +617,10 @@ class OmopVocabularySQL(core.vocab.OmopVocabulary):
                 )
 
     def close_connection(self) -> None:
-        if self._stored_engine is not None:
+        # The engine is started again on next use, so it is only closed if it is running
+        if self._engine is not None and self._engine.engine is not None:
             self.logger.info("Closing database connection.")
-            self._stored_engine.permanent_connection = False
-            self._stored_engine.__exit__(None)
+            self._engine.dispose()
 
     def unmap(self, concept_id) -> bool:
         changes = False
@@ -541,6 +655,8 @@ class OmopVocabularySQL(core.vocab.OmopVocabulary):
                 deleted = session.execute(delete)
                 if deleted.rowcount > 0:
                     changes = True
+
+        self._forget_in_mirror(concept_id)
         return changes
 
     def _set_concept_atrr(self, concept_id: int, attribute: str, value: Any):
@@ -550,6 +666,8 @@ class OmopVocabularySQL(core.vocab.OmopVocabulary):
             session.execute(stmt)
             session.commit()
 
+        self._forget_in_mirror(concept_id)
+
     def drop_vocabulary(self, vocabulary_id) -> None:
         # List all concepts belonging to the vocabulary
         doomed_concept_ids = self._find_concepts(vocabulary_id=[vocabulary_id])
@@ -569,8 +687,7 @@ class OmopVocabularySQL(core.vocab.OmopVocabulary):
 
         with self.start_session() as session:
             with session.no_autoflush:
-                # Work around circular foreign keys
-                session.execute('SET CONSTRAINTS ALL DEFERRED;')
+                self._defer_constraints(session)
                 for cls, cid_keys in affected_classes.items():
                     deleted_rows = 0
                     for key in cid_keys:
@@ -580,4 +697,7 @@ class OmopVocabularySQL(core.vocab.OmopVocabulary):
                         deleted_rows += deleted.rowcount
                     self.logger.debug(f"Deleted {deleted_rows} from {cls.__tablename__}...")
 
+        for concept_id in doomed_concept_ids:
+            self._forget_in_mirror(concept_id)
+
         self.logger.info(f"Deleted '{vocabulary_id}'.")